@@ -0,0 +1,173 @@
+import asyncio
+import contextvars
+import os
+import threading
+import time
+from contextlib import contextmanager
+from typing import Any, AsyncIterator, Awaitable, Callable, Dict, Iterator, Optional, TypeVar
+
+import anyio
+from starlette.requests import Request
+
+# How often a blocking endpoint checks whether its client is still connected
+POLL_INTERVAL = float(os.getenv("QAI_DISCONNECT_POLL", "0.5"))
+
+T = TypeVar("T")
+_DONE = object()
+
+
+class RequestCancelled(Exception):
+    """Raised inside LLM work whose client has gone away"""
+
+
+class CancelToken:
+    def __init__(self):
+        self._event = threading.Event()
+
+    @property
+    def cancelled(self) -> bool:
+        return self._event.is_set()
+
+    def cancel(self):
+        self._event.set()
+
+    def wait(self, timeout: float) -> bool:
+        return self._event.wait(timeout)
+
+
+_current: contextvars.ContextVar[Optional[CancelToken]] = contextvars.ContextVar("qai_cancel_token", default=None)
+
+
+class CancellationTracker:
+    """
+    Ties LLM work to the HTTP request (or background job) that asked for it.
+    Work runs under a CancelToken that worker threads inherit through
+    contextvars, so pipeline fan-out children share their parent's token.
+    The token trips when the client disconnects or the job is cancelled; the LLM layer checks it
+    before each provider call, while waiting for a rate-limit slot or backoff,
+    and between streamed chunks, where closing the stream aborts the
+    provider's HTTP request.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.counters = {"guarded": 0, "disconnects": 0, "calls_aborted": 0}
+
+    def active(self) -> bool:
+        return _current.get() is not None
+
+    def check(self):
+        token = _current.get()
+        if token is not None and token.cancelled:
+            self._count("calls_aborted")
+            raise RequestCancelled("客户端已断开，生成已取消")
+
+    def sleep(self, delay: float):
+        """time.sleep that wakes up (and raises) as soon as the request is cancelled"""
+        token = _current.get()
+        if token is None:
+            time.sleep(delay)
+            return
+        token.wait(delay)
+        self.check()
+
+    def wait_for(self, event: threading.Event):
+        """event.wait() that gives up once the request is cancelled"""
+        if _current.get() is None:
+            event.wait()
+            return
+        while not event.wait(POLL_INTERVAL):
+            self.check()
+
+    def poll_interval(self, wait: float) -> float:
+        """Cap a blocking wait so cancellation is noticed within POLL_INTERVAL"""
+        return min(wait, POLL_INTERVAL) if _current.get() is not None else wait
+
+    async def run(self, request: Request, fn: Callable[..., T], *args: Any) -> T:
+        """Run a blocking call in the threadpool, cancelling its LLM work if the client disconnects"""
+        return await self.guard(request, lambda: anyio.to_thread.run_sync(contextvars.copy_context().run, fn, *args))
+
+    async def guard(self, request: Request, make: Callable[[], Awaitable[T]]) -> T:
+        """Await make() under a fresh token; its tasks and threads inherit it via the copied context"""
+        token = CancelToken()
+        reset = _current.set(token)
+        try:
+            work = asyncio.ensure_future(make())
+        finally:
+            _current.reset(reset)
+        self._count("guarded")
+        watcher = asyncio.ensure_future(self._watch(request, token, work))
+        try:
+            # Not cancelled on disconnect: the work notices the token and stops on its own
+            return await work
+        finally:
+            watcher.cancel()
+            if not work.done():
+                token.cancel()
+
+    async def _watch(self, request: Request, token: CancelToken, work: asyncio.Future):
+        while not work.done():
+            if await request.is_disconnected():
+                self._disconnected(token)
+                return
+            await asyncio.wait({work}, timeout=POLL_INTERVAL)
+
+    async def stream(self, items: Iterator[T]) -> AsyncIterator[T]:
+        """
+        Iterate a blocking generator for StreamingResponse. Starlette cancels the
+        response when the client disconnects; the pending next() is abandoned and
+        the token makes the generator stop at its next chunk.
+        """
+        token = CancelToken()
+        ctx = contextvars.copy_context()
+        ctx.run(_current.set, token)
+        self._count("guarded")
+        try:
+            while True:
+                item = await anyio.to_thread.run_sync(ctx.run, next, items, _DONE, abandon_on_cancel=True)
+                if item is _DONE:
+                    return
+                yield item
+        except (asyncio.CancelledError, GeneratorExit):
+            self._disconnected(token)
+            raise
+
+    @contextmanager
+    def scope(self) -> Iterator[CancelToken]:
+        """Token for async generators; trips if the generator is cancelled or closed early"""
+        token = CancelToken()
+        reset = _current.set(token)
+        self._count("guarded")
+        try:
+            yield token
+        except (asyncio.CancelledError, GeneratorExit):
+            self._disconnected(token)
+            raise
+        finally:
+            _current.reset(reset)
+
+    @contextmanager
+    def bind(self, token: CancelToken) -> Iterator[CancelToken]:
+        """Run blocking work under a token the caller trips itself (e.g. JobService.cancel)"""
+        reset = _current.set(token)
+        self._count("guarded")
+        try:
+            yield token
+        finally:
+            _current.reset(reset)
+
+    def _disconnected(self, token: CancelToken):
+        if not token.cancelled:
+            token.cancel()
+            self._count("disconnects")
+
+    def _count(self, key: str):
+        with self._lock:
+            self.counters[key] += 1
+
+    def stats(self) -> Dict[str, int]:
+        with self._lock:
+            return dict(self.counters)
+
+
+cancellation = CancellationTracker()
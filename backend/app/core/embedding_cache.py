@@ -0,0 +1,153 @@
+import hashlib
+import os
+import sqlite3
+import threading
+import time
+from typing import TYPE_CHECKING, Any, Callable, Dict, List, Optional
+
+from app.core.database import BASE_DIR
+
+if TYPE_CHECKING:
+    # Imported on first use, like chromadb: not needed to serve CRUD requests
+    import numpy as np
+
+EMBED_CACHE_ENABLED = os.getenv("QAI_EMBED_CACHE", "1").lower() in ("1", "true", "yes")
+EMBED_CACHE_PATH = os.getenv("QAI_EMBED_CACHE_PATH", os.path.join(BASE_DIR, "embedding_cache.db"))
+EMBED_CACHE_MAX_BYTES = int(float(os.getenv("QAI_EMBED_CACHE_MAX_MB", "256")) * 1024 * 1024)
+
+
+class EmbeddingCache:
+    """
+    Persistent text-hash -> embedding cache in a local SQLite file.
+    Keys are a hash of (embedding model, text), so switching models never
+    serves stale vectors. Vectors are stored as float32 blobs; once they
+    exceed max_bytes the least recently used entries are evicted.
+    """
+
+    def __init__(self, path: str = EMBED_CACHE_PATH, max_bytes: int = EMBED_CACHE_MAX_BYTES, enabled: bool = EMBED_CACHE_ENABLED):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.enabled = enabled
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._lock = threading.Lock()
+        self._conn: Optional[sqlite3.Connection] = None
+
+    def _db(self) -> sqlite3.Connection:
+        if self._conn is None:
+            conn = sqlite3.connect(self.path, check_same_thread=False)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS embedding_cache ("
+                " key TEXT PRIMARY KEY, vector BLOB NOT NULL, size INTEGER NOT NULL, last_access REAL NOT NULL)"
+            )
+            conn.execute("CREATE INDEX IF NOT EXISTS ix_embedding_cache_last_access ON embedding_cache(last_access)")
+            conn.commit()
+            self._conn = conn
+        return self._conn
+
+    @staticmethod
+    def make_key(model: str, text: str) -> str:
+        return hashlib.sha256(f"{model}\0{text}".encode("utf-8")).hexdigest()
+
+    def embed(self, model: str, texts: List[str], compute: Callable[[List[str]], List[Any]]) -> List["np.ndarray"]:
+        """Embeddings for texts, calling compute() only for the ones not cached (once per distinct text)"""
+        import numpy as np
+        if not self.enabled:
+            return [np.asarray(v, dtype=np.float32) for v in compute(texts)]
+        keys = [self.make_key(model, t) for t in texts]
+        found = self._get_many(set(keys))
+        missing: Dict[str, str] = {}
+        for key, text in zip(keys, texts):
+            if key not in found:
+                missing.setdefault(key, text)
+        if missing:
+            vectors = compute(list(missing.values()))
+            computed = {key: np.asarray(v, dtype=np.float32) for key, v in zip(missing, vectors)}
+            self._set_many(computed)
+            found.update(computed)
+        with self._lock:
+            self.hits += len(texts) - len(missing)
+            self.misses += len(missing)
+        return [found[key] for key in keys]
+
+    def _get_many(self, keys: set) -> Dict[str, "np.ndarray"]:
+        if not keys:
+            return {}
+        import numpy as np
+        now = time.time()
+        found: Dict[str, "np.ndarray"] = {}
+        with self._lock:
+            try:
+                db = self._db()
+                key_list = list(keys)
+                # Stay under SQLite's bound-parameter limit
+                for i in range(0, len(key_list), 500):
+                    chunk = key_list[i:i + 500]
+                    marks = ",".join("?" * len(chunk))
+                    for key, blob in db.execute(f"SELECT key, vector FROM embedding_cache WHERE key IN ({marks})", chunk):
+                        found[key] = np.frombuffer(blob, dtype=np.float32)
+                if found:
+                    db.executemany("UPDATE embedding_cache SET last_access = ? WHERE key = ?", [(now, k) for k in found])
+                    db.commit()
+            except sqlite3.Error as e:
+                print(f"Embedding cache read failed: {e}")
+        return found
+
+    def _set_many(self, vectors: Dict[str, "np.ndarray"]):
+        import numpy as np
+        now = time.time()
+        rows = []
+        for key, v in vectors.items():
+            blob = v.astype(np.float32).tobytes()
+            rows.append((key, blob, len(blob), now))
+        with self._lock:
+            try:
+                db = self._db()
+                db.executemany(
+                    "INSERT OR REPLACE INTO embedding_cache (key, vector, size, last_access) VALUES (?, ?, ?, ?)", rows
+                )
+                self._evict(db)
+                db.commit()
+            except sqlite3.Error as e:
+                print(f"Embedding cache write failed: {e}")
+
+    def _evict(self, db: sqlite3.Connection):
+        total = db.execute("SELECT COALESCE(SUM(size), 0) FROM embedding_cache").fetchone()[0]
+        if total <= self.max_bytes:
+            return
+        to_delete = []
+        for key, size in db.execute("SELECT key, size FROM embedding_cache ORDER BY last_access ASC"):
+            if total <= self.max_bytes:
+                break
+            to_delete.append((key,))
+            total -= size
+        db.executemany("DELETE FROM embedding_cache WHERE key = ?", to_delete)
+        self.evictions += len(to_delete)
+
+    def clear(self):
+        with self._lock:
+            if self._conn is None and not os.path.exists(self.path):
+                return
+            db = self._db()
+            db.execute("DELETE FROM embedding_cache")
+            db.commit()
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            entries, size = 0, 0
+            if self._conn is not None:
+                entries, size = self._conn.execute("SELECT COUNT(*), COALESCE(SUM(size), 0) FROM embedding_cache").fetchone()
+            return {
+                "enabled": self.enabled,
+                "entries": entries,
+                "bytes": size,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+            }
+
+
+embedding_cache = EmbeddingCache()
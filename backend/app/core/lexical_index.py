@@ -0,0 +1,225 @@
+import math
+import os
+import re
+import threading
+import time
+from collections import Counter
+from typing import Any, Callable, Dict, Iterable, List, Optional, Tuple
+from sqlmodel import Session, select
+from app.core.database import engine
+from app.models.models import KnowledgeItem
+
+# BM25 parameters: term-frequency saturation and document-length normalisation
+BM25_K1 = float(os.getenv("QAI_BM25_K1", "1.2"))
+BM25_B = float(os.getenv("QAI_BM25_B", "0.75"))
+
+# Identifiers and codes: user_id, order.status, ERR-1001, 404 (original case kept for camelCase)
+_ASCII = re.compile(r"[A-Za-z0-9_]+(?:[.\-][A-Za-z0-9_]+)*")
+_CJK = re.compile(r"[\u3400-\u4dbf\u4e00-\u9fff\uf900-\ufaff]+")
+_CAMEL = re.compile(r"[a-z][A-Z]")
+
+
+def tokenize(text: str) -> List[str]:
+    """
+    Lower-cased ASCII words plus overlapping character bigrams of CJK runs
+    (a lone CJK character is kept as a unigram). Bigrams need no dictionary
+    and match Chinese terms of any length without segmentation errors.
+    """
+    tokens = [m.group().lower() for m in _ASCII.finditer(text)]
+    for run in _CJK.findall(text):
+        if len(run) == 1:
+            tokens.append(run)
+        else:
+            tokens.extend(run[i:i + 2] for i in range(len(run) - 1))
+    return tokens
+
+
+def exact_terms(text: str) -> List[str]:
+    """Query words that look like field names or error codes, where a lexical hit is decisive"""
+    terms = []
+    for m in _ASCII.finditer(text):
+        word = m.group()
+        if len(word) >= 3 and (any(c.isdigit() or c in "_.-" for c in word) or _CAMEL.search(word)):
+            terms.append(word.lower())
+    return terms
+
+
+def matches_where(metadata: Dict[str, Any], where: Optional[Dict[str, Any]]) -> bool:
+    """Evaluate the subset of Chroma's metadata filter syntax we use ($eq/$ne/$in/$nin/$and/$or)"""
+    if not where:
+        return True
+    for key, cond in where.items():
+        if key == "$and":
+            if not all(matches_where(metadata, c) for c in cond):
+                return False
+        elif key == "$or":
+            if not any(matches_where(metadata, c) for c in cond):
+                return False
+        else:
+            value = metadata.get(key)
+            if not isinstance(cond, dict):
+                cond = {"$eq": cond}
+            for op, expected in cond.items():
+                if op == "$eq" and value != expected:
+                    return False
+                if op == "$ne" and value == expected:
+                    return False
+                if op == "$in" and value not in expected:
+                    return False
+                if op == "$nin" and value in expected:
+                    return False
+    return True
+
+
+class LexicalIndex:
+    """
+    In-memory BM25 inverted index. Filled lazily from `loader` on first use
+    (the source of truth stays in Chroma / SQLite) and then kept current by
+    the same write paths that update the source, so no rebuilds are needed.
+    """
+
+    def __init__(self, name: str, loader: Callable[[], Iterable[Tuple[str, str, Dict[str, Any]]]]):
+        self.name = name
+        self._loader = loader
+        self._loaded = False
+        self._lock = threading.RLock()
+        # term -> {doc_id: term frequency}
+        self._postings: Dict[str, Dict[str, int]] = {}
+        # doc_id -> (text, metadata, term counts, length in tokens)
+        self._docs: Dict[str, Tuple[str, Dict[str, Any], Counter, int]] = {}
+        self._total_length = 0
+        self.searches = 0
+        self.search_seconds = 0.0
+        self.load_seconds = 0.0
+
+    @property
+    def loaded(self) -> bool:
+        return self._loaded
+
+    def load(self):
+        """Fill the index from the source now (otherwise it happens on the first search)"""
+        if self._loaded:
+            return
+        with self._lock:
+            if self._loaded:
+                return
+            start = time.perf_counter()
+            try:
+                for doc_id, text, metadata in self._loader():
+                    self._add(doc_id, text, metadata)
+            except Exception as e:
+                # Retried on the next lookup; searches meanwhile see what was loaded
+                print(f"Load lexical index '{self.name}' failed: {e}")
+                return
+            self._loaded = True
+            self.load_seconds = time.perf_counter() - start
+            print(f"Lexical index '{self.name}' loaded: {len(self._docs)} documents in {self.load_seconds:.2f}s")
+
+    def upsert(self, doc_id: str, text: str, metadata: Optional[Dict[str, Any]] = None):
+        with self._lock:
+            # Not loaded yet: the loader will read this write from the source
+            if self._loaded:
+                self._remove(doc_id)
+                self._add(doc_id, text, metadata or {})
+
+    def update_metadata(self, doc_id: str, metadata: Dict[str, Any]):
+        """Merge like Chroma's update: None values drop the key"""
+        with self._lock:
+            doc = self._docs.get(doc_id)
+            if doc is None:
+                return
+            merged = {**doc[1], **metadata}
+            self._docs[doc_id] = (doc[0], {k: v for k, v in merged.items() if v is not None}, doc[2], doc[3])
+
+    def remove(self, doc_ids: Iterable[str]):
+        with self._lock:
+            for doc_id in doc_ids:
+                self._remove(doc_id)
+
+    def reset(self):
+        """Drop everything; the next lookup reloads from the source"""
+        with self._lock:
+            self._postings, self._docs, self._total_length = {}, {}, 0
+            self._loaded = False
+
+    def _add(self, doc_id: str, text: str, metadata: Dict[str, Any]):
+        counts = Counter(tokenize(text or ""))
+        length = sum(counts.values())
+        # Like Chroma, None-valued keys are not stored
+        metadata = {k: v for k, v in (metadata or {}).items() if v is not None}
+        self._docs[doc_id] = (text, metadata, counts, length)
+        self._total_length += length
+        for term, tf in counts.items():
+            self._postings.setdefault(term, {})[doc_id] = tf
+
+    def _remove(self, doc_id: str):
+        doc = self._docs.pop(doc_id, None)
+        if doc is None:
+            return
+        self._total_length -= doc[3]
+        for term in doc[2]:
+            posting = self._postings.get(term)
+            if posting is not None:
+                posting.pop(doc_id, None)
+                if not posting:
+                    del self._postings[term]
+
+    def search(self, query: str, n_results: int = 3, where: Optional[Dict[str, Any]] = None) -> List[Dict[str, Any]]:
+        """Top documents by BM25, as {"id", "content", "metadata", "score"}"""
+        self.load()
+        start = time.perf_counter()
+        terms = set(tokenize(query))
+        with self._lock:
+            n_docs = len(self._docs)
+            avg_length = self._total_length / n_docs if n_docs else 0.0
+            scores: Dict[str, float] = {}
+            for term in terms:
+                posting = self._postings.get(term)
+                if not posting:
+                    continue
+                idf = math.log(1 + (n_docs - len(posting) + 0.5) / (len(posting) + 0.5))
+                for doc_id, tf in posting.items():
+                    norm = BM25_K1 * (1 - BM25_B + BM25_B * self._docs[doc_id][3] / avg_length) if avg_length else BM25_K1
+                    scores[doc_id] = scores.get(doc_id, 0.0) + idf * tf * (BM25_K1 + 1) / (tf + norm)
+            results = []
+            for doc_id, score in sorted(scores.items(), key=lambda kv: kv[1], reverse=True):
+                text, metadata = self._docs[doc_id][:2]
+                if not matches_where(metadata, where):
+                    continue
+                results.append({"id": doc_id, "content": text, "metadata": dict(metadata), "score": round(score, 4)})
+                if len(results) >= n_results:
+                    break
+            self.searches += 1
+            self.search_seconds += time.perf_counter() - start
+        return results
+
+    def contains_all(self, doc_id: str, terms: Iterable[str]) -> bool:
+        with self._lock:
+            doc = self._docs.get(doc_id)
+            return doc is not None and all(t in doc[2] for t in terms)
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            return {
+                "loaded": self._loaded,
+                "documents": len(self._docs),
+                "terms": len(self._postings),
+                "searches": self.searches,
+                "search_latency_ms_avg": round(self.search_seconds / self.searches * 1000, 3) if self.searches else 0.0,
+                "load_seconds": round(self.load_seconds, 3),
+            }
+
+
+def knowledge_doc(item: KnowledgeItem) -> Tuple[str, str, Dict[str, Any]]:
+    """(doc_id, text, metadata) of a knowledge item: content and tags are searchable"""
+    return str(item.id), f"{item.content}\n{item.tags or ''}", {"category": item.category, "knowledge_id": item.id}
+
+
+def _load_knowledge_items() -> Iterable[Tuple[str, str, Dict[str, Any]]]:
+    with Session(engine) as session:
+        items = session.exec(select(KnowledgeItem)).all()
+    return [knowledge_doc(item) for item in items]
+
+
+# Knowledge base rules and notes (SQL table); requirement documents are indexed by the vector store
+knowledge_index = LexicalIndex("knowledge", _load_knowledge_items)
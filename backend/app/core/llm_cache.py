@@ -0,0 +1,146 @@
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+from typing import Dict, Optional, Any
+
+from app.core.database import BASE_DIR
+
+CACHE_ENABLED = os.getenv("QAI_LLM_CACHE", "0").lower() in ("1", "true", "yes")
+CACHE_PATH = os.getenv("QAI_LLM_CACHE_PATH", os.path.join(BASE_DIR, "llm_cache.db"))
+CACHE_MAX_BYTES = int(float(os.getenv("QAI_LLM_CACHE_MAX_MB", "64")) * 1024 * 1024)
+CACHE_TTL_SECONDS = float(os.getenv("QAI_LLM_CACHE_TTL", str(7 * 24 * 3600)))
+
+
+class LLMResponseCache:
+    """
+    Content-addressed cache of LLM completions stored in a local SQLite file.
+    Keys are a hash of (model, system prompt, user prompt, temperature).
+    Entries expire after ttl seconds; once the stored payload exceeds max_bytes
+    the least recently used entries are evicted.
+    """
+
+    def __init__(
+        self,
+        path: str = CACHE_PATH,
+        max_bytes: int = CACHE_MAX_BYTES,
+        ttl: float = CACHE_TTL_SECONDS,
+        enabled: bool = CACHE_ENABLED,
+    ):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.enabled = enabled
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._lock = threading.Lock()
+        self._conn: Optional[sqlite3.Connection] = None
+
+    def _db(self) -> sqlite3.Connection:
+        # Opened lazily so a disabled cache never touches the disk
+        if self._conn is None:
+            conn = sqlite3.connect(self.path, check_same_thread=False)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS llm_cache ("
+                " key TEXT PRIMARY KEY, content TEXT NOT NULL, size INTEGER NOT NULL,"
+                " created_at REAL NOT NULL, last_access REAL NOT NULL)"
+            )
+            conn.execute("CREATE INDEX IF NOT EXISTS ix_llm_cache_last_access ON llm_cache(last_access)")
+            conn.commit()
+            self._conn = conn
+        return self._conn
+
+    def should_use(self, use_cache: Optional[bool]) -> bool:
+        """Per-request override: None follows the server default, False bypasses"""
+        return self.enabled if use_cache is None else use_cache
+
+    @staticmethod
+    def make_key(model: str, system_prompt: str, user_prompt: str, temperature: Any) -> str:
+        payload = json.dumps([model, system_prompt, user_prompt, temperature], ensure_ascii=False)
+        return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+    def get(self, key: str) -> Optional[str]:
+        now = time.time()
+        with self._lock:
+            try:
+                db = self._db()
+                row = db.execute("SELECT content, created_at FROM llm_cache WHERE key = ?", (key,)).fetchone()
+                if row and now - row[1] > self.ttl:
+                    db.execute("DELETE FROM llm_cache WHERE key = ?", (key,))
+                    db.commit()
+                    self.evictions += 1
+                    row = None
+                if not row:
+                    self.misses += 1
+                    return None
+                db.execute("UPDATE llm_cache SET last_access = ? WHERE key = ?", (now, key))
+                db.commit()
+                self.hits += 1
+                return row[0]
+            except sqlite3.Error as e:
+                print(f"LLM cache read failed: {e}")
+                self.misses += 1
+                return None
+
+    def set(self, key: str, content: str):
+        now = time.time()
+        size = len(content.encode("utf-8"))
+        if size > self.max_bytes:
+            return
+        with self._lock:
+            try:
+                db = self._db()
+                db.execute(
+                    "INSERT OR REPLACE INTO llm_cache (key, content, size, created_at, last_access) VALUES (?, ?, ?, ?, ?)",
+                    (key, content, size, now, now),
+                )
+                self._evict(db, now)
+                db.commit()
+            except sqlite3.Error as e:
+                print(f"LLM cache write failed: {e}")
+
+    def _evict(self, db: sqlite3.Connection, now: float):
+        cur = db.execute("DELETE FROM llm_cache WHERE created_at < ?", (now - self.ttl,))
+        self.evictions += max(cur.rowcount, 0)
+        total = db.execute("SELECT COALESCE(SUM(size), 0) FROM llm_cache").fetchone()[0]
+        if total <= self.max_bytes:
+            return
+        # Walk from least recently used until we are back under budget
+        to_delete = []
+        for key, size in db.execute("SELECT key, size FROM llm_cache ORDER BY last_access ASC"):
+            if total <= self.max_bytes:
+                break
+            to_delete.append((key,))
+            total -= size
+        db.executemany("DELETE FROM llm_cache WHERE key = ?", to_delete)
+        self.evictions += len(to_delete)
+
+    def clear(self):
+        with self._lock:
+            if self._conn is None and not os.path.exists(self.path):
+                return
+            db = self._db()
+            db.execute("DELETE FROM llm_cache")
+            db.commit()
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            entries, size = 0, 0
+            if self._conn is not None:
+                entries, size = self._conn.execute("SELECT COUNT(*), COALESCE(SUM(size), 0) FROM llm_cache").fetchone()
+            return {
+                "enabled": self.enabled,
+                "entries": entries,
+                "bytes": size,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+            }
+
+
+llm_cache = LLMResponseCache()
@@ -0,0 +1,197 @@
+import hashlib
+import os
+import threading
+import time
+import weakref
+from collections import OrderedDict
+from typing import TYPE_CHECKING, Dict, List, Optional, Tuple
+
+import httpx
+
+if TYPE_CHECKING:
+    # Imported on first use: langchain_openai alone takes ~2s to import
+    from langchain_openai import ChatOpenAI
+
+# Pool sizing can be tuned per deployment without code changes
+MAX_CLIENTS = int(os.getenv("QAI_LLM_MAX_CLIENTS", "32"))
+IDLE_TTL_SECONDS = float(os.getenv("QAI_LLM_IDLE_TTL", "600"))
+MAX_CONNECTIONS = int(os.getenv("QAI_LLM_MAX_CONNECTIONS", "50"))
+MAX_KEEPALIVE = int(os.getenv("QAI_LLM_MAX_KEEPALIVE", "20"))
+KEEPALIVE_EXPIRY = float(os.getenv("QAI_LLM_KEEPALIVE_EXPIRY", "60"))
+REQUEST_TIMEOUT = float(os.getenv("QAI_LLM_TIMEOUT", "120"))
+# Ask for a final usage chunk on streams (cache-hit accounting); disable for providers that reject stream_options
+STREAM_USAGE = os.getenv("QAI_LLM_STREAM_USAGE", "1").lower() in ("1", "true", "yes")
+
+ClientKey = Tuple[str, str, str]
+
+
+class _HttpPool:
+    """
+    Sync + async httpx clients shared by every model on one base_url.
+    refs counts pooled ChatOpenAI entries, live counts ChatOpenAI objects still
+    alive (pooled or held by a caller mid-call). Once no entry is pooled the
+    pool is retired, but it is only closed when the last live client is gone.
+    close() may run from a GC finalizer on any thread, so it only closes the
+    sync client; the async client is closed by LLMClientPool.aclose() at shutdown.
+    """
+
+    def __init__(self):
+        limits = httpx.Limits(
+            max_connections=MAX_CONNECTIONS,
+            max_keepalive_connections=MAX_KEEPALIVE,
+            keepalive_expiry=KEEPALIVE_EXPIRY,
+        )
+        timeout = httpx.Timeout(REQUEST_TIMEOUT, connect=10.0)
+        self.sync_client = httpx.Client(limits=limits, timeout=timeout)
+        self.async_client = httpx.AsyncClient(limits=limits, timeout=timeout)
+        self.refs = 0
+        self.live = 0
+        self.retired = False
+        self.closed = False
+
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        try:
+            self.sync_client.close()
+        except Exception as e:
+            print(f"Close http client failed: {e}")
+
+    async def aclose(self):
+        self.close()
+        try:
+            await self.async_client.aclose()
+        except Exception as e:
+            print(f"Close async http client failed: {e}")
+
+
+class LLMClientPool:
+    """
+    Registry of reusable ChatOpenAI clients.
+    Entries are keyed by (base_url, model, api_key hash), evicted after being idle
+    for IDLE_TTL_SECONDS and capped at MAX_CLIENTS (least recently used goes first).
+    All models on the same base_url share one keep-alive connection pool.
+    """
+
+    def __init__(self, max_clients: int = MAX_CLIENTS, idle_ttl: float = IDLE_TTL_SECONDS):
+        self.max_clients = max_clients
+        self.idle_ttl = idle_ttl
+        self._clients: "OrderedDict[ClientKey, Tuple[ChatOpenAI, float]]" = OrderedDict()
+        self._http: Dict[str, _HttpPool] = {}
+        # Closed (sync side) pools whose async client waits for aclose() at shutdown
+        self._retired: List[_HttpPool] = []
+        # Reentrant: a GC finalizer can run (and release a pool) while this thread holds it
+        self._lock = threading.RLock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    @staticmethod
+    def _key(api_key: Optional[str], base_url: Optional[str], model: str) -> ClientKey:
+        key_hash = hashlib.sha256((api_key or "").encode("utf-8")).hexdigest()[:16]
+        return (base_url or "", model, key_hash)
+
+    def warm_up(self):
+        """Import the client library ahead of the first LLM call"""
+        import langchain_openai  # noqa: F401
+        import langchain_core.messages  # noqa: F401
+
+    def get(self, api_key: Optional[str], base_url: Optional[str], model: str) -> "ChatOpenAI":
+        key = self._key(api_key, base_url, model)
+        now = time.monotonic()
+        with self._lock:
+            self._evict_idle(now)
+            entry = self._clients.get(key)
+            if entry:
+                self.hits += 1
+                self._clients[key] = (entry[0], now)
+                self._clients.move_to_end(key)
+                return entry[0]
+
+            self.misses += 1
+            http = self._http.get(key[0])
+            if http is None:
+                http = _HttpPool()
+                self._http[key[0]] = http
+            http.refs += 1
+
+            from langchain_openai import ChatOpenAI
+            llm = ChatOpenAI(
+                model=model,
+                openai_api_key=api_key if api_key else "sk-placeholder", # Some local LLMs need non-empty key
+                openai_api_base=base_url,
+                temperature=0.7,
+                max_retries=0,  # Retries and backoff are handled by llm_limiter
+                stream_usage=STREAM_USAGE,
+                http_client=http.sync_client,
+                http_async_client=http.async_client,
+            )
+            http.live += 1
+            # Callers may still be using an evicted client; its pool stays open until it is collected
+            weakref.finalize(llm, self._collected, http)
+            self._clients[key] = (llm, now)
+            while len(self._clients) > self.max_clients:
+                old_key, _ = self._clients.popitem(last=False)
+                self._release(old_key)
+            return llm
+
+    def _evict_idle(self, now: float):
+        # OrderedDict is kept in last-used order, so stale entries sit at the front
+        while self._clients:
+            old_key, (_, last_used) = next(iter(self._clients.items()))
+            if now - last_used < self.idle_ttl:
+                break
+            self._clients.popitem(last=False)
+            self._release(old_key)
+
+    def _release(self, key: ClientKey):
+        self.evictions += 1
+        http = self._http.get(key[0])
+        if http is None:
+            return
+        http.refs -= 1
+        if http.refs <= 0:
+            del self._http[key[0]]
+            http.retired = True
+            self._close_if_unused(http)
+
+    def _collected(self, http: _HttpPool):
+        with self._lock:
+            http.live -= 1
+            self._close_if_unused(http)
+
+    def _close_if_unused(self, http: _HttpPool):
+        if http.retired and http.live <= 0 and not http.closed:
+            http.close()
+            self._retired.append(http)
+
+    def stats(self) -> Dict[str, int]:
+        with self._lock:
+            return {
+                "clients": len(self._clients),
+                "http_pools": len(self._http),
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+            }
+
+    def close(self):
+        """Close the sync clients (for callers without an event loop, e.g. scripts)"""
+        with self._lock:
+            for http in self._http.values():
+                http.close()
+            self._retired.extend(self._http.values())
+            self._http.clear()
+            self._clients.clear()
+
+    async def aclose(self):
+        """Close every sync and async client; called from the app's lifespan shutdown"""
+        self.close()
+        with self._lock:
+            pools, self._retired = self._retired, []
+        for http in pools:
+            await http.aclose()
+
+
+llm_client_pool = LLMClientPool()
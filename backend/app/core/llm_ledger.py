@@ -0,0 +1,253 @@
+import contextvars
+import json
+import os
+import queue
+import threading
+import time
+from contextlib import contextmanager
+from datetime import datetime
+from typing import Any, Dict, Iterator, List, Optional
+from sqlalchemy import case, func
+from sqlmodel import Session, select
+from app.core.database import engine
+from app.models.models import LLMCallLog, ProjectVersion, Requirement
+
+FLUSH_INTERVAL = float(os.getenv("QAI_LEDGER_FLUSH_INTERVAL", "1.0"))
+BATCH_SIZE = int(os.getenv("QAI_LEDGER_BATCH_SIZE", "200"))
+QUEUE_SIZE = int(os.getenv("QAI_LEDGER_QUEUE_SIZE", "10000"))
+# Prices per 1M tokens as {"model": {"input": x, "cached_input": y, "output": z}}; models
+# without a price are reported with cost null. Defaults: DeepSeek list prices (CNY).
+DEFAULT_PRICES = {
+    "deepseek-chat": {"input": 2.0, "cached_input": 0.2, "output": 3.0},
+    "deepseek-reasoner": {"input": 2.0, "cached_input": 0.2, "output": 3.0},
+}
+PRICES: Dict[str, Dict[str, float]] = {**DEFAULT_PRICES, **json.loads(os.getenv("QAI_LLM_PRICES", "{}") or "{}")}
+
+GROUP_COLUMNS = {
+    "project": LLMCallLog.project_id,
+    "version": LLMCallLog.version_id,
+    "stage": LLMCallLog.stage,
+    "model": LLMCallLog.model,
+    "provider": LLMCallLog.provider,
+}
+
+# Attribution for calls made inside a request or job
+_attribution: contextvars.ContextVar[Dict[str, Optional[int]]] = contextvars.ContextVar("qai_ledger_attribution", default={})
+
+
+def call_cost(model: Optional[str], prompt_tokens: int, completion_tokens: int, cache_hit_tokens: int) -> Optional[float]:
+    price = PRICES.get(model or "")
+    if not price:
+        return None
+    miss = max(prompt_tokens - cache_hit_tokens, 0)
+    cached_price = price.get("cached_input", price["input"])
+    return (miss * price["input"] + cache_hit_tokens * cached_price + completion_tokens * price["output"]) / 1_000_000
+
+
+class LLMLedger:
+    """
+    Collects one row per LLM call and appends them to the llm_call_log table.
+    record() only enqueues; a background thread inserts in batches so the
+    request path never waits on SQLite. Rows are dropped (and counted) if
+    the queue is full rather than blocking callers.
+    """
+
+    def __init__(self):
+        self._queue: "queue.Queue[Optional[Dict[str, Any]]]" = queue.Queue(maxsize=QUEUE_SIZE)
+        self._thread: Optional[threading.Thread] = None
+        self._lock = threading.Lock()
+        self.written = 0
+        self.dropped = 0
+        self.batches = 0
+
+    @contextmanager
+    def attribute(self, requirement_id: Optional[int] = None, version_id: Optional[int] = None, project_id: Optional[int] = None,
+                  resolve: bool = True):
+        """
+        Tag calls made in this context; missing version/project ids are looked up from the requirement.
+        The lookup queries SQLite: on the event loop, resolve() in the threadpool first and pass resolve=False.
+        """
+        scope = self.resolve(requirement_id, version_id, project_id) if resolve else {
+            "requirement_id": requirement_id, "version_id": version_id, "project_id": project_id,
+        }
+        token = _attribution.set(scope)
+        try:
+            yield scope
+        finally:
+            _attribution.reset(token)
+
+    def attributed(self, items: Iterator[Any], requirement_id: Optional[int] = None, version_id: Optional[int] = None,
+                   project_id: Optional[int] = None, resolve: bool = True) -> Iterator[Any]:
+        """attribute() for sync generators consumed step by step (e.g. by StreamingResponse in a threadpool)"""
+        scope = self.resolve(requirement_id, version_id, project_id) if resolve else {
+            "requirement_id": requirement_id, "version_id": version_id, "project_id": project_id,
+        }
+        while True:
+            token = _attribution.set(scope)
+            try:
+                item = next(items)
+            except StopIteration:
+                return
+            finally:
+                _attribution.reset(token)
+            yield item
+
+    def resolve(self, requirement_id: Optional[int] = None, version_id: Optional[int] = None,
+                project_id: Optional[int] = None) -> Dict[str, Optional[int]]:
+        """Fill in version/project ids from the requirement / version (blocking DB lookup)"""
+        if (requirement_id and not version_id) or (version_id and not project_id):
+            try:
+                with Session(engine) as session:
+                    if requirement_id and not version_id:
+                        requirement = session.get(Requirement, requirement_id)
+                        version_id = requirement.version_id if requirement else None
+                    if version_id and not project_id:
+                        version = session.get(ProjectVersion, version_id)
+                        project_id = version.project_id if version else None
+            except Exception as e:
+                print(f"Resolve ledger attribution failed: {e}")
+        return {"requirement_id": requirement_id, "version_id": version_id, "project_id": project_id}
+
+    def record(self, stage: str, model: Optional[str], provider: Optional[str], usage: Dict[str, int],
+               latency: float, status: str = "ok", parse_ok: Optional[bool] = None,
+               cached: bool = False, streamed: bool = False):
+        row = {
+            "created_at": datetime.now(),
+            "stage": stage,
+            "model": model,
+            "provider": provider,
+            "prompt_tokens": usage.get("prompt_tokens", 0),
+            "completion_tokens": usage.get("completion_tokens", 0),
+            "cache_hit_tokens": usage.get("cache_hit_tokens", 0),
+            "latency_ms": int(latency * 1000),
+            "streamed": streamed,
+            "cached": cached,
+            "parse_ok": parse_ok,
+            "status": status,
+            # Every row carries all three keys: the batch goes out as one executemany,
+            # which takes its columns from the first row
+            "requirement_id": None,
+            "version_id": None,
+            "project_id": None,
+            **_attribution.get(),
+        }
+        self._ensure_started()
+        try:
+            self._queue.put_nowait(row)
+        except queue.Full:
+            with self._lock:
+                self.dropped += 1
+
+    def _ensure_started(self):
+        if self._thread is not None:
+            return
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name="qai-ledger", daemon=True)
+                self._thread.start()
+
+    def _run(self):
+        stopping = False
+        while not stopping:
+            rows: List[Dict[str, Any]] = []
+            deadline = time.monotonic() + FLUSH_INTERVAL
+            while len(rows) < BATCH_SIZE:
+                try:
+                    row = self._queue.get(timeout=max(deadline - time.monotonic(), 0.001))
+                except queue.Empty:
+                    break
+                if row is None:
+                    stopping = True
+                    break
+                rows.append(row)
+            if rows:
+                self._write(rows)
+
+    def _write(self, rows: List[Dict[str, Any]]):
+        try:
+            with engine.begin() as conn:
+                conn.execute(LLMCallLog.__table__.insert(), rows)
+            with self._lock:
+                self.written += len(rows)
+                self.batches += 1
+        except Exception as e:
+            print(f"Write LLM ledger batch failed ({len(rows)} rows): {e}")
+            with self._lock:
+                self.dropped += len(rows)
+
+    def close(self):
+        """Flush what is queued and stop the writer (called on shutdown)"""
+        with self._lock:
+            thread, self._thread = self._thread, None
+        if thread is not None:
+            self._queue.put(None)
+            thread.join(timeout=10)
+
+    def summary(self, session: Session, group_by: List[str], project_id: Optional[int] = None,
+                version_id: Optional[int] = None, since: Optional[datetime] = None) -> List[Dict[str, Any]]:
+        """Tokens, cost, latency, errors and parse failures per group_by key combination"""
+        keys = [k for k in group_by if k in GROUP_COLUMNS]
+        # Cost depends on the model, so aggregate per model even when not asked to
+        model_index = keys.index("model") if "model" in keys else len(keys)
+        columns = [GROUP_COLUMNS[k] for k in keys] + ([] if "model" in keys else [LLMCallLog.model])
+        query = select(
+            *columns,
+            func.count(),
+            func.sum(LLMCallLog.prompt_tokens),
+            func.sum(LLMCallLog.completion_tokens),
+            func.sum(LLMCallLog.cache_hit_tokens),
+            func.sum(LLMCallLog.latency_ms),
+            func.max(LLMCallLog.latency_ms),
+            func.sum(case((LLMCallLog.cached == True, 1), else_=0)),  # noqa: E712
+            func.sum(case((LLMCallLog.status != "ok", 1), else_=0)),
+            func.sum(case((LLMCallLog.parse_ok == False, 1), else_=0)),  # noqa: E712
+        ).group_by(*columns)
+        if project_id:
+            query = query.where(LLMCallLog.project_id == project_id)
+        if version_id:
+            query = query.where(LLMCallLog.version_id == version_id)
+        if since:
+            query = query.where(LLMCallLog.created_at >= since)
+
+        groups: Dict[tuple, Dict[str, Any]] = {}
+        for row in session.exec(query).all():
+            values = tuple(row[:len(keys)])
+            model = row[model_index]
+            calls, prompt, completion, hits, latency_sum, latency_max, cached, errors, parse_failures = [v or 0 for v in row[len(columns):]]
+            g = groups.get(values)
+            if g is None:
+                g = groups[values] = {
+                    **dict(zip(keys, values)),
+                    "calls": 0, "prompt_tokens": 0, "completion_tokens": 0, "cache_hit_tokens": 0,
+                    "latency_ms_total": 0, "latency_ms_max": 0, "cached_calls": 0, "errors": 0,
+                    "parse_failures": 0, "cost": 0.0, "unpriced_calls": 0,
+                }
+            g["calls"] += calls
+            g["prompt_tokens"] += prompt
+            g["completion_tokens"] += completion
+            g["cache_hit_tokens"] += hits
+            g["latency_ms_total"] += latency_sum
+            g["latency_ms_max"] = max(g["latency_ms_max"], latency_max)
+            g["cached_calls"] += cached
+            g["errors"] += errors
+            g["parse_failures"] += parse_failures
+            cost = call_cost(model, prompt, completion, hits)
+            if cost is None:
+                g["unpriced_calls"] += calls
+            else:
+                g["cost"] += cost
+
+        results = []
+        for g in groups.values():
+            g["latency_ms_avg"] = round(g.pop("latency_ms_total") / g["calls"], 1) if g["calls"] else 0
+            g["cost"] = round(g["cost"], 6)
+            results.append(g)
+        results.sort(key=lambda g: g["cost"], reverse=True)
+        return results
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            return {"written": self.written, "batches": self.batches, "dropped": self.dropped, "queued": self._queue.qsize()}
+
+
+llm_ledger = LLMLedger()
@@ -0,0 +1,298 @@
+import json
+import os
+import random
+import sys
+import threading
+import time
+from contextlib import closing
+from typing import Any, Callable, Dict, Iterator, Optional
+
+import httpx
+
+from app.core.cancellation import RequestCancelled, cancellation
+
+DEFAULT_RPM = float(os.getenv("QAI_PROVIDER_RPM", "0"))  # 0 = unlimited
+DEFAULT_TPM = float(os.getenv("QAI_PROVIDER_TPM", "0"))
+DEFAULT_MAX_CONCURRENCY = int(os.getenv("QAI_PROVIDER_MAX_CONCURRENCY", "16"))
+DEFAULT_INITIAL_CONCURRENCY = int(os.getenv("QAI_PROVIDER_INITIAL_CONCURRENCY", "4"))
+CALL_DEADLINE_SECONDS = float(os.getenv("QAI_LLM_DEADLINE", "180"))
+MAX_ATTEMPTS = int(os.getenv("QAI_LLM_MAX_ATTEMPTS", "4"))
+BACKOFF_BASE = float(os.getenv("QAI_LLM_BACKOFF_BASE", "0.5"))
+BACKOFF_CAP = float(os.getenv("QAI_LLM_BACKOFF_CAP", "20"))
+# Per-provider overrides, matched by substring of base_url, e.g.
+# QAI_PROVIDER_LIMITS='{"deepseek": {"rpm": 60, "tpm": 200000, "max_concurrency": 32}}'
+PROVIDER_OVERRIDES: Dict[str, Dict[str, float]] = json.loads(os.getenv("QAI_PROVIDER_LIMITS", "{}") or "{}")
+
+
+class LLMCallError(Exception):
+    """A provider call that failed after retries; carries the HTTP status to report"""
+
+    def __init__(self, message: str, status_code: int = 502, kind: str = "error"):
+        super().__init__(message)
+        self.status_code = status_code
+        self.kind = kind
+
+
+_KIND_STATUS = {"rate_limited": 429, "timeout": 504, "server": 502, "fatal": 502}
+_KIND_LABEL = {
+    "rate_limited": "模型服务限流 (429)",
+    "timeout": "模型服务超时",
+    "server": "模型服务暂时不可用",
+    "fatal": "模型调用失败",
+}
+
+
+def classify_error(e: Exception) -> str:
+    """rate_limited / timeout / server are retried; fatal (auth, bad request) is not"""
+    if isinstance(e, LLMCallError):
+        return e.kind
+    # Not imported here (it takes ~0.7s); an openai exception means the client already loaded it
+    openai = sys.modules.get("openai")
+    if openai is not None:
+        if isinstance(e, openai.RateLimitError):
+            return "rate_limited"
+        if isinstance(e, openai.APITimeoutError):
+            return "timeout"
+        if isinstance(e, openai.APIConnectionError):
+            return "server"
+        if isinstance(e, openai.APIStatusError):
+            status = e.status_code
+            if status == 429:
+                return "rate_limited"
+            if status in (408, 409) or status >= 500:
+                return "server"
+            return "fatal"
+    if isinstance(e, httpx.TimeoutException):
+        return "timeout"
+    if isinstance(e, (httpx.NetworkError, httpx.RemoteProtocolError)):
+        return "server"
+    return "fatal"
+
+
+def _retry_after(e: Exception) -> Optional[float]:
+    response = getattr(e, "response", None)
+    headers = getattr(response, "headers", None)
+    if not headers:
+        return None
+    try:
+        return float(headers.get("retry-after"))
+    except (TypeError, ValueError):
+        return None
+
+
+def to_call_error(e: Exception, provider: str, attempts: int) -> LLMCallError:
+    if isinstance(e, LLMCallError):
+        return e
+    kind = classify_error(e)
+    return LLMCallError(
+        f"{_KIND_LABEL[kind]}: {provider} ({attempts} 次尝试) - {e}",
+        status_code=_KIND_STATUS[kind], kind=kind
+    )
+
+
+class TokenBucket:
+    """Refills continuously at `per_minute`; a rate of 0 means unlimited"""
+
+    def __init__(self, per_minute: float):
+        self.rate = per_minute / 60.0
+        self.capacity = per_minute
+        self.tokens = per_minute
+        self.updated = time.monotonic()
+
+    def _refill(self, now: float):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def wait_time(self, amount: float, now: float) -> float:
+        if self.rate <= 0:
+            return 0.0
+        self._refill(now)
+        need = min(amount, self.capacity)
+        return 0.0 if self.tokens >= need else (need - self.tokens) / self.rate
+
+    def take(self, amount: float):
+        # A negative amount refunds an over-estimate, but never past a full bucket
+        if self.rate > 0:
+            self.tokens = min(self.capacity, self.tokens - amount)
+
+
+class ProviderLimiter:
+    """
+    Token-bucket RPM/TPM limits plus an AIMD concurrency window for one provider.
+    The window grows by ~1 per window of successes, halves on 429s and shrinks
+    when latency jumps well above its moving average.
+    """
+
+    def __init__(self, name: str, rpm: float, tpm: float, max_concurrency: int, initial_concurrency: int):
+        self.name = name
+        self.rpm = TokenBucket(rpm)
+        self.tpm = TokenBucket(tpm)
+        self.max_concurrency = max(1, max_concurrency)
+        self.limit = float(max(1, min(initial_concurrency, self.max_concurrency)))
+        self.inflight = 0
+        self.ewma_latency: Optional[float] = None
+        self._cond = threading.Condition()
+        self.counters = {"calls": 0, "succeeded": 0, "retries": 0, "rate_limited": 0, "timeouts": 0, "errors": 0}
+
+    def acquire(self, tokens: float, deadline: float):
+        with self._cond:
+            while True:
+                cancellation.check()
+                now = time.monotonic()
+                if now >= deadline:
+                    raise LLMCallError(f"等待模型服务配额超时: {self.name}", status_code=503, kind="timeout")
+                if self.inflight < int(self.limit):
+                    wait = max(self.rpm.wait_time(1, now), self.tpm.wait_time(tokens, now))
+                    if wait <= 0:
+                        self.rpm.take(1)
+                        self.tpm.take(tokens)
+                        self.inflight += 1
+                        self.counters["calls"] += 1
+                        return
+                else:
+                    wait = deadline - now  # Woken by release()
+                self._cond.wait(cancellation.poll_interval(min(wait, deadline - now)))
+
+    def release(self, outcome: str, latency: float, extra_tokens: float = 0):
+        with self._cond:
+            self.inflight -= 1
+            if extra_tokens:
+                self.tpm.take(extra_tokens)
+            if outcome == "ok":
+                self.counters["succeeded"] += 1
+                slow = self.ewma_latency is not None and latency > 3 * self.ewma_latency
+                self.ewma_latency = latency if self.ewma_latency is None else 0.8 * self.ewma_latency + 0.2 * latency
+                if slow:
+                    self.limit = max(1.0, self.limit * 0.9)
+                else:
+                    self.limit = min(float(self.max_concurrency), self.limit + 1.0 / self.limit)
+            elif outcome == "rate_limited":
+                self.counters["rate_limited"] += 1
+                self.limit = max(1.0, self.limit / 2)
+            elif outcome == "timeout":
+                self.counters["timeouts"] += 1
+                self.limit = max(1.0, self.limit * 0.75)
+            elif outcome != "cancelled":
+                self.counters["errors"] += 1
+            self._cond.notify_all()
+
+    def stats(self) -> Dict[str, Any]:
+        with self._cond:
+            return {
+                "concurrency_limit": round(self.limit, 2),
+                "inflight": self.inflight,
+                "ewma_latency_ms": round(self.ewma_latency * 1000, 1) if self.ewma_latency else None,
+                **self.counters,
+            }
+
+
+class RateLimiter:
+    """Registry of ProviderLimiters keyed by base_url, plus retrying call helpers"""
+
+    def __init__(self):
+        self._providers: Dict[str, ProviderLimiter] = {}
+        self._lock = threading.Lock()
+
+    def provider(self, base_url: Optional[str]) -> ProviderLimiter:
+        key = base_url or "default"
+        with self._lock:
+            limiter = self._providers.get(key)
+            if limiter is None:
+                cfg = {"rpm": DEFAULT_RPM, "tpm": DEFAULT_TPM,
+                       "max_concurrency": DEFAULT_MAX_CONCURRENCY,
+                       "initial_concurrency": DEFAULT_INITIAL_CONCURRENCY}
+                for pattern, override in PROVIDER_OVERRIDES.items():
+                    if pattern in key:
+                        cfg.update(override)
+                limiter = ProviderLimiter(
+                    key, float(cfg["rpm"]), float(cfg["tpm"]),
+                    int(cfg["max_concurrency"]), int(cfg["initial_concurrency"])
+                )
+                self._providers[key] = limiter
+            return limiter
+
+    def call(self, base_url: Optional[str], fn: Callable[[], Any], est_tokens: float = 0,
+             deadline: Optional[float] = None, attempts: Optional[int] = None) -> Any:
+        """Run fn under the provider's limits, retrying 429/timeouts/5xx with jittered backoff"""
+        limiter = self.provider(base_url)
+        deadline = deadline or time.monotonic() + CALL_DEADLINE_SECONDS
+        attempts = attempts or MAX_ATTEMPTS
+        attempt = 0
+        while True:
+            attempt += 1
+            limiter.acquire(est_tokens, deadline)
+            start = time.monotonic()
+            try:
+                result = fn()
+            except RequestCancelled:
+                limiter.release("cancelled", time.monotonic() - start)
+                raise
+            except Exception as e:
+                kind = classify_error(e)
+                limiter.release(kind, time.monotonic() - start)
+                self._backoff_or_raise(limiter, e, kind, attempt, attempts, deadline)
+                continue
+            # Settle the estimate against real usage; without usage the estimate stands
+            actual = _actual_tokens(result)
+            limiter.release("ok", time.monotonic() - start, actual - est_tokens if est_tokens and actual is not None else 0)
+            return result
+
+    def stream(self, base_url: Optional[str], open_stream: Callable[[], Iterator[Any]], est_tokens: float = 0,
+               deadline: Optional[float] = None, attempts: Optional[int] = None) -> Iterator[Any]:
+        """Like call() for token streams; only retried while nothing has been yielded yet"""
+        limiter = self.provider(base_url)
+        deadline = deadline or time.monotonic() + CALL_DEADLINE_SECONDS
+        attempts = attempts or MAX_ATTEMPTS
+        attempt = 0
+        while True:
+            attempt += 1
+            limiter.acquire(est_tokens, deadline)
+            start = time.monotonic()
+            emitted = False
+            outcome = "cancelled"
+            try:
+                with closing(open_stream()) as chunks:
+                    for chunk in chunks:
+                        # Raising here closes the stream, which aborts the provider request
+                        cancellation.check()
+                        emitted = True
+                        yield chunk
+                outcome = "ok"
+                return
+            except (GeneratorExit, RequestCancelled):
+                raise
+            except Exception as e:
+                outcome = classify_error(e)
+                if emitted:
+                    raise to_call_error(e, limiter.name, attempt)
+                error = e
+            finally:
+                limiter.release(outcome, time.monotonic() - start)
+            self._backoff_or_raise(limiter, error, outcome, attempt, attempts, deadline)
+
+    def _backoff_or_raise(self, limiter: ProviderLimiter, e: Exception, kind: str, attempt: int, attempts: int, deadline: float):
+        if kind == "fatal" or attempt >= attempts:
+            raise to_call_error(e, limiter.name, attempt)
+        # Full jitter, but never sooner than the provider's Retry-After
+        delay = random.uniform(0, min(BACKOFF_CAP, BACKOFF_BASE * (2 ** attempt)))
+        delay = max(delay, _retry_after(e) or 0)
+        if time.monotonic() + delay >= deadline:
+            raise to_call_error(e, limiter.name, attempt)
+        with limiter._cond:
+            limiter.counters["retries"] += 1
+        print(f"LLM call to {limiter.name} failed ({kind}), retry {attempt} in {delay:.1f}s: {e}")
+        cancellation.sleep(delay)
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            providers = dict(self._providers)
+        return {name: p.stats() for name, p in providers.items()}
+
+
+def _actual_tokens(result: Any) -> Optional[float]:
+    usage = getattr(result, "usage_metadata", None) or {}
+    total = usage.get("total_tokens")
+    return float(total) if total else None
+
+
+rate_limiter = RateLimiter()
@@ -0,0 +1,289 @@
+import contextvars
+import json
+import os
+import threading
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from typing import Any, Callable, Dict, Iterator, List, Optional
+
+from app.core.cancellation import RequestCancelled
+from app.core.llm_limiter import LLMCallError, to_call_error
+
+# Pool of equivalent providers, as a JSON list (inline or in a file):
+# [{"name": "deepseek", "base_url": "https://api.deepseek.com", "model": "deepseek-chat", "api_key_env": "DEEPSEEK_API_KEY"},
+#  {"name": "local", "base_url": "http://127.0.0.1:8001/v1", "model": "qwen2.5-14b"}]
+PROVIDERS_JSON = os.getenv("QAI_LLM_PROVIDERS", "")
+PROVIDERS_FILE = os.getenv("QAI_LLM_PROVIDERS_FILE", "")
+# Attempts per provider before failing over to the next one
+ROUTED_ATTEMPTS = int(os.getenv("QAI_ROUTER_ATTEMPTS", "2"))
+BREAKER_FAILURES = int(os.getenv("QAI_BREAKER_FAILURES", "3"))
+BREAKER_COOLDOWN = float(os.getenv("QAI_BREAKER_COOLDOWN", "30"))
+# Hedging: after max(HEDGE_MIN, HEDGE_FACTOR x expected latency) fire the same call at the runner-up
+HEDGE_ENABLED = os.getenv("QAI_LLM_HEDGE", "0").lower() in ("1", "true", "yes")
+HEDGE_FACTOR = float(os.getenv("QAI_LLM_HEDGE_FACTOR", "2.0"))
+HEDGE_MIN = float(os.getenv("QAI_LLM_HEDGE_MIN", "1.0"))
+EWMA_ALPHA = 0.2
+
+ROUTE_AUTO = "auto"
+
+
+class ProviderConfig:
+    def __init__(self, name: str, base_url: str, model: str, api_key: str = ""):
+        self.name = name
+        self.base_url = base_url
+        self.model = model
+        self.api_key = api_key
+
+
+class ProviderHealth:
+    """EWMA latency per stage, EWMA error rate and a closed/open/half_open breaker"""
+
+    def __init__(self):
+        self.latency: Dict[str, float] = {}
+        self.error_rate = 0.0
+        self.consecutive_failures = 0
+        self.state = "closed"
+        self.opened_at = 0.0
+        self.probing = False
+        self.calls = 0
+        self.failures = 0
+
+    def expected_latency(self, stage: str) -> float:
+        if stage in self.latency:
+            return self.latency[stage]
+        # Unknown stage: use the provider's mean, or 0 so untried providers get explored
+        return sum(self.latency.values()) / len(self.latency) if self.latency else 0.0
+
+    def score(self, stage: str) -> float:
+        return self.expected_latency(stage) * (1 + 4 * self.error_rate)
+
+
+class ProviderRouter:
+    """
+    Routes each call to the fastest healthy provider for its stage.
+    Failures trip a per-provider circuit breaker; after BREAKER_COOLDOWN one
+    probe call is let through (half-open) and a success closes it again.
+    Failed calls fail over to the next candidate; with hedging enabled, a slow
+    blocking call is duplicated on the runner-up and the first answer wins.
+    """
+
+    def __init__(self, providers: Optional[List[ProviderConfig]] = None):
+        self.providers = providers if providers is not None else _load_providers()
+        self._health = {p.name: ProviderHealth() for p in self.providers}
+        self._lock = threading.Lock()
+        self._executor: Optional[ThreadPoolExecutor] = None
+        self.counters = {"routed": 0, "failovers": 0, "hedges": 0, "hedge_wins": 0, "rejected": 0}
+
+    @property
+    def enabled(self) -> bool:
+        return bool(self.providers)
+
+    def wants_routing(self, api_key: Optional[str], base_url: Optional[str]) -> bool:
+        """Explicit base_url="auto", or no credentials at all while a pool is configured"""
+        if not self.enabled:
+            return False
+        return base_url == ROUTE_AUTO or (not api_key and not base_url)
+
+    def candidates(self, stage: str) -> List[ProviderConfig]:
+        now = time.monotonic()
+        probes, healthy = [], []
+        with self._lock:
+            for p in self.providers:
+                h = self._health[p.name]
+                if h.state == "open" and now - h.opened_at >= BREAKER_COOLDOWN:
+                    h.state = "half_open"
+                    h.probing = False
+                if h.state == "half_open" and not h.probing:
+                    probes.append(p)
+                elif h.state == "closed":
+                    healthy.append(p)
+            healthy.sort(key=lambda p: self._health[p.name].score(stage))
+        # A recovering provider gets one real call; failover still covers it
+        return probes[:1] + healthy
+
+    def record(self, name: str, stage: str, latency: float, ok: bool):
+        with self._lock:
+            h = self._health[name]
+            h.calls += 1
+            h.error_rate = (1 - EWMA_ALPHA) * h.error_rate + EWMA_ALPHA * (0.0 if ok else 1.0)
+            if ok:
+                previous = h.latency.get(stage)
+                h.latency[stage] = latency if previous is None else (1 - EWMA_ALPHA) * previous + EWMA_ALPHA * latency
+                h.consecutive_failures = 0
+                h.state = "closed"
+            else:
+                h.failures += 1
+                h.consecutive_failures += 1
+                if h.state == "half_open" or h.consecutive_failures >= BREAKER_FAILURES:
+                    if h.state != "open":
+                        print(f"Circuit opened for LLM provider {name} after {h.consecutive_failures} failures")
+                    h.state = "open"
+                    h.opened_at = time.monotonic()
+            h.probing = False
+
+    def call(self, stage: str, fn: Callable[[ProviderConfig], Any]) -> Any:
+        """Run fn(provider) on the best candidate, failing over (and optionally hedging)"""
+        candidates = self._route(stage)
+        if HEDGE_ENABLED and len(candidates) > 1:
+            return self._hedged(stage, candidates, fn)
+        error: Optional[LLMCallError] = None
+        for i, provider in enumerate(candidates):
+            if i:
+                self._count("failovers")
+            try:
+                return self._attempt(provider, stage, fn)
+            except LLMCallError as e:
+                print(f"LLM provider {provider.name} failed for {stage}: {e}")
+                error = e
+        raise error
+
+    def stream(self, stage: str, open_stream: Callable[[ProviderConfig], Iterator[Any]]) -> Iterator[Any]:
+        """Streaming variant of call(): fails over only until the first chunk is yielded"""
+        candidates = self._route(stage)
+        error: Optional[LLMCallError] = None
+        for i, provider in enumerate(candidates):
+            if i:
+                self._count("failovers")
+            self._mark_probe(provider)
+            start = time.monotonic()
+            emitted = False
+            try:
+                for chunk in open_stream(provider):
+                    emitted = True
+                    yield chunk
+            except (GeneratorExit, RequestCancelled):
+                raise
+            except Exception as e:
+                self.record(provider.name, stage, time.monotonic() - start, ok=False)
+                error = to_call_error(e, provider.name, 1)
+                if emitted:
+                    raise error
+                print(f"LLM provider {provider.name} failed for {stage} stream: {error}")
+                continue
+            self.record(provider.name, stage, time.monotonic() - start, ok=True)
+            return
+        raise error
+
+    def _route(self, stage: str) -> List[ProviderConfig]:
+        candidates = self.candidates(stage)
+        if not candidates:
+            self._count("rejected")
+            raise LLMCallError("所有模型服务均处于熔断状态，请稍后重试", status_code=503, kind="server")
+        self._count("routed")
+        return candidates
+
+    def _attempt(self, provider: ProviderConfig, stage: str, fn: Callable[[ProviderConfig], Any]) -> Any:
+        self._mark_probe(provider)
+        start = time.monotonic()
+        try:
+            result = fn(provider)
+        except RequestCancelled:
+            # The client went away; says nothing about the provider's health
+            raise
+        except Exception as e:
+            self.record(provider.name, stage, time.monotonic() - start, ok=False)
+            raise to_call_error(e, provider.name, 1)
+        self.record(provider.name, stage, time.monotonic() - start, ok=True)
+        return result
+
+    def _hedged(self, stage: str, candidates: List[ProviderConfig], fn: Callable[[ProviderConfig], Any]) -> Any:
+        executor = self._get_executor()
+        pending = list(candidates)
+        primary = pending.pop(0)
+        # Copies of the caller's context carry usage scope, ledger attribution and cancellation
+        futures = {executor.submit(contextvars.copy_context().run, self._attempt, primary, stage, fn): primary}
+        with self._lock:
+            expected = self._health[primary.name].expected_latency(stage)
+        done, _ = wait(futures, timeout=max(HEDGE_MIN, HEDGE_FACTOR * expected))
+        if not done and pending:
+            # Primary is slower than usual: race it against the runner-up
+            self._count("hedges")
+            backup = pending.pop(0)
+            futures[executor.submit(contextvars.copy_context().run, self._attempt, backup, stage, fn)] = backup
+
+        error: Optional[LLMCallError] = None
+        while futures:
+            done, _ = wait(futures, return_when=FIRST_COMPLETED)
+            for future in done:
+                provider = futures.pop(future)
+                try:
+                    result = future.result()
+                except LLMCallError as e:
+                    error = e
+                    if not futures and pending:
+                        self._count("failovers")
+                        nxt = pending.pop(0)
+                        futures[executor.submit(contextvars.copy_context().run, self._attempt, nxt, stage, fn)] = nxt
+                    continue
+                if provider is not primary:
+                    self._count("hedge_wins")
+                # The loser keeps running in the background; its timing still feeds the EWMA
+                return result
+        raise error
+
+    def _mark_probe(self, provider: ProviderConfig):
+        with self._lock:
+            h = self._health[provider.name]
+            if h.state == "half_open":
+                h.probing = True
+
+    def _count(self, key: str):
+        with self._lock:
+            self.counters[key] += 1
+
+    def _get_executor(self) -> ThreadPoolExecutor:
+        with self._lock:
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(max_workers=32, thread_name_prefix="qai-hedge")
+            return self._executor
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            return {
+                "enabled": self.enabled,
+                "hedging": HEDGE_ENABLED,
+                **self.counters,
+                "providers": {
+                    p.name: {
+                        "base_url": p.base_url,
+                        "model": p.model,
+                        "state": self._health[p.name].state,
+                        "error_rate": round(self._health[p.name].error_rate, 3),
+                        "latency_ms": {s: round(v * 1000, 1) for s, v in self._health[p.name].latency.items()},
+                        "calls": self._health[p.name].calls,
+                        "failures": self._health[p.name].failures,
+                    }
+                    for p in self.providers
+                },
+            }
+
+
+def _load_providers() -> List[ProviderConfig]:
+    raw = PROVIDERS_JSON
+    if not raw and PROVIDERS_FILE:
+        try:
+            with open(PROVIDERS_FILE, encoding="utf-8") as f:
+                raw = f.read()
+        except OSError as e:
+            print(f"Load LLM providers file failed: {e}")
+            return []
+    if not raw.strip():
+        return []
+    try:
+        entries = json.loads(raw)
+    except ValueError as e:
+        print(f"Invalid QAI_LLM_PROVIDERS: {e}")
+        return []
+    providers = []
+    for i, entry in enumerate(entries):
+        api_key = entry.get("api_key") or os.getenv(entry.get("api_key_env", ""), "")
+        providers.append(ProviderConfig(
+            name=entry.get("name") or f"provider{i}",
+            base_url=entry["base_url"],
+            model=entry["model"],
+            api_key=api_key,
+        ))
+    return providers
+
+
+provider_router = ProviderRouter()
@@ -0,0 +1,95 @@
+import contextvars
+import threading
+from contextlib import contextmanager
+from typing import Any, Dict, Iterator, Optional
+
+_FIELDS = ("calls", "prompt_tokens", "completion_tokens", "cache_hit_tokens")
+
+
+def extract_usage(message: Any) -> Dict[str, int]:
+    """
+    Normalise token usage from a chat response or final stream chunk.
+    Cache hits are reported differently per provider: DeepSeek uses
+    prompt_cache_hit_tokens, OpenAI prompt_tokens_details.cached_tokens and
+    Moonshot a top-level cached_tokens; streamed chunks only carry the
+    OpenAI-style figure (as usage_metadata cache_read).
+    """
+    if message is None:
+        return {}
+    raw = (getattr(message, "response_metadata", None) or {}).get("token_usage") or {}
+    meta = getattr(message, "usage_metadata", None) or {}
+    if not raw and not meta:
+        return {}
+    hit = raw.get("prompt_cache_hit_tokens")
+    if hit is None:
+        hit = (raw.get("prompt_tokens_details") or {}).get("cached_tokens")
+    if hit is None:
+        hit = raw.get("cached_tokens")
+    if hit is None:
+        hit = (meta.get("input_token_details") or {}).get("cache_read")
+    return {
+        "prompt_tokens": int(raw.get("prompt_tokens") or meta.get("input_tokens") or 0),
+        "completion_tokens": int(raw.get("completion_tokens") or meta.get("output_tokens") or 0),
+        "cache_hit_tokens": int(hit or 0),
+    }
+
+
+class UsageTotals:
+    def __init__(self):
+        self.values = {f: 0 for f in _FIELDS}
+        self._lock = threading.Lock()
+
+    def add(self, usage: Dict[str, int]):
+        with self._lock:
+            self.values["calls"] += 1
+            for field in _FIELDS[1:]:
+                self.values[field] += usage.get(field, 0)
+
+    def snapshot(self) -> Dict[str, Any]:
+        with self._lock:
+            data = dict(self.values)
+        data["cache_hit_ratio"] = round(data["cache_hit_tokens"] / data["prompt_tokens"], 3) if data["prompt_tokens"] else 0.0
+        return data
+
+
+_scope: contextvars.ContextVar[Optional[UsageTotals]] = contextvars.ContextVar("qai_usage_scope", default=None)
+
+
+class UsageMeter:
+    """
+    Process-wide token usage per provider, plus optional per-run scopes.
+    A scope (e.g. one wizard run) sums the calls made inside it; worker threads
+    see it when they run with a copy of the caller's context.
+    """
+
+    def __init__(self):
+        self._providers: Dict[str, UsageTotals] = {}
+        self._lock = threading.Lock()
+
+    def record(self, provider: Optional[str], usage: Dict[str, int]):
+        if not usage:
+            return
+        key = provider or "default"
+        with self._lock:
+            totals = self._providers.setdefault(key, UsageTotals())
+        totals.add(usage)
+        scope = _scope.get()
+        if scope is not None:
+            scope.add(usage)
+
+    @contextmanager
+    def scope(self) -> Iterator[UsageTotals]:
+        totals = UsageTotals()
+        token = _scope.set(totals)
+        try:
+            yield totals
+        finally:
+            _scope.reset(token)
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            providers = dict(self._providers)
+        return {name: totals.snapshot() for name, totals in providers.items()}
+
+
+usage_meter = UsageMeter()
@@ -0,0 +1,70 @@
+import copy
+import threading
+from typing import Any, Callable, Dict, Hashable, Optional
+
+from app.core.cancellation import RequestCancelled, cancellation
+
+
+class _Call:
+    def __init__(self):
+        self.done = threading.Event()
+        self.result: Any = None
+        self.error: Optional[BaseException] = None
+        self.waiters = 0
+
+
+class SingleFlight:
+    """
+    Collapses concurrent calls with the same key into one execution.
+    The first caller runs fn; callers arriving while it is in flight wait for
+    it and receive a copy of its result (or its exception). Nothing is kept
+    once the call finishes, so this is not a cache.
+    """
+
+    def __init__(self, name: str):
+        self.name = name
+        self._calls: Dict[Hashable, _Call] = {}
+        self._lock = threading.Lock()
+        self.executed = 0
+        self.coalesced = 0
+
+    def do(self, key: Hashable, fn: Callable[[], Any]) -> Any:
+        while True:
+            with self._lock:
+                call = self._calls.get(key)
+                leader = call is None
+                if leader:
+                    call = _Call()
+                    self._calls[key] = call
+                    self.executed += 1
+                else:
+                    call.waiters += 1
+                    self.coalesced += 1
+            if leader:
+                break
+
+            cancellation.wait_for(call.done)
+            if isinstance(call.error, RequestCancelled):
+                # The leader's client went away, not ours: run it again
+                continue
+            if call.error is not None:
+                raise call.error
+            # Callers may mutate what they get back; never hand out the shared object
+            return copy.deepcopy(call.result)
+
+        try:
+            call.result = fn()
+        except BaseException as e:
+            call.error = e
+            raise
+        finally:
+            with self._lock:
+                self._calls.pop(key, None)
+                shared = call.waiters > 0
+            call.done.set()
+        return copy.deepcopy(call.result) if shared else call.result
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            inflight = len(self._calls)
+        return {"executed": self.executed, "coalesced": self.coalesced, "inflight": inflight}
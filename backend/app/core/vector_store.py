@@ -1,36 +1,375 @@
-import chromadb
-from chromadb.config import Settings
+import copy
+import json
 import os
-from typing import List, Dict, Any
+import threading
+import time
+from collections import OrderedDict
+from typing import List, Dict, Any, Optional, Tuple
+from app.core.singleflight import SingleFlight
+from app.core.embedding_cache import embedding_cache
+from app.core.lexical_index import LexicalIndex, exact_terms
+
+COLLECTION_NAME = "qai_knowledge_base"
+# The live collection is renamed to this while a rebuilt one is swapped in
+RETIRED_COLLECTION_NAME = COLLECTION_NAME + "__old"
+
+# Documents embedded per upsert call (Chroma embeds each call's documents in one pass)
+EMBED_BATCH_SIZE = int(os.getenv("QAI_EMBED_BATCH_SIZE", "64"))
+# query_similar results kept per (query, n_results, filters); 0 disables
+RETRIEVAL_CACHE_SIZE = int(os.getenv("QAI_RETRIEVAL_CACHE_SIZE", "512"))
+# hybrid: BM25 + vector fused by reciprocal rank (lexical-only when exact terms hit); vector | lexical: one ranker
+RETRIEVAL_MODE = os.getenv("QAI_RETRIEVAL_MODE", "hybrid").lower()
+# Reciprocal rank fusion constant: larger values flatten the advantage of top ranks
+RRF_K = int(os.getenv("QAI_RRF_K", "60"))
+
+
+class RetrievalCache:
+    """
+    LRU of query results tagged with the index generation they were read at.
+    Any write to the collection bumps the generation, so entries from before
+    it are treated as misses instead of being tracked down individually.
+    """
+
+    def __init__(self, max_entries: int = RETRIEVAL_CACHE_SIZE):
+        self.max_entries = max_entries
+        self._entries: "OrderedDict[Tuple, Tuple[int, List[Dict[str, Any]]]]" = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.stale = 0
+        self.hit_seconds = 0.0
+        self.miss_seconds = 0.0
+
+    def get(self, key: Tuple, generation: int) -> Optional[List[Dict[str, Any]]]:
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[0] != generation:
+                del self._entries[key]
+                self.stale += 1
+                entry = None
+            if entry is None:
+                return None
+            self._entries.move_to_end(key)
+            return entry[1]
+
+    def put(self, key: Tuple, generation: int, results: List[Dict[str, Any]]):
+        if self.max_entries <= 0:
+            return
+        with self._lock:
+            self._entries[key] = (generation, results)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def observe(self, hit: bool, seconds: float):
+        with self._lock:
+            if hit:
+                self.hits += 1
+                self.hit_seconds += seconds
+            else:
+                self.misses += 1
+                self.miss_seconds += seconds
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "entries": len(self._entries),
+                "hits": self.hits,
+                "misses": self.misses,
+                "stale": self.stale,
+                "hit_rate": round(self.hits / lookups, 3) if lookups else 0.0,
+                "hit_latency_ms_avg": round(self.hit_seconds / self.hits * 1000, 3) if self.hits else 0.0,
+                "miss_latency_ms_avg": round(self.miss_seconds / self.misses * 1000, 3) if self.misses else 0.0,
+            }
+
 
 class VectorStoreService:
+    """
+    Chroma collection plus the retrieval layers in front of it.
+    Importing chromadb, opening the PersistentClient and loading the ONNX
+    embedding model take seconds, so none of it happens at import time:
+    `client`, `collection` and `embedding_function` open on first use, and
+    warm_up() (started from main's lifespan) does it ahead of the first query.
+    """
+
     def __init__(self):
         # Use a persistent storage path
         self.persist_directory = os.path.join(os.getcwd(), "chroma_db")
-        self.client = chromadb.PersistentClient(path=self.persist_directory)
-        
-        # Create or get collection
-        # We use the default embedding function (all-MiniLM-L6-v2) built into Chroma for simplicity
-        self.collection = self.client.get_or_create_collection(name="qai_knowledge_base")
+        self._client = None
+        self._collection = None
+        self._embedding_function = None
+        self._model_loaded = False
+        self._open_lock = threading.Lock()
+        # cold -> warming -> ready | failed; opened lazily without warm_up() it stays cold
+        self.warm_state = "cold"
+        self.warm_error: Optional[str] = None
+        self.warm_seconds: Dict[str, float] = {}
+        # Identical queries already running (embedding + ANN search) are shared
+        self.flights = SingleFlight("retrieval")
+        self.counters = {"embedded": 0, "metadata_only": 0, "lexical": 0, "lexical_fast_path": 0, "fused": 0, "vector": 0}
+        # Bumped after every write; cached query results from older generations are ignored
+        self.generation = 0
+        self._generation_lock = threading.Lock()
+        self.retrieval_cache = RetrievalCache()
+        # BM25 over the same documents; loaded from the collection on first lookup, then updated on every write
+        self.lexical = LexicalIndex("requirements", self._iter_documents)
+
+    @property
+    def client(self):
+        if self._client is None:
+            self._open()
+        return self._client
+
+    @property
+    def collection(self):
+        if self._client is None:
+            self._open()
+        return self._collection
+
+    @property
+    def embedding_function(self):
+        if self._embedding_function is None:
+            with self._open_lock:
+                if self._embedding_function is None:
+                    start = time.perf_counter()
+                    from chromadb.utils import embedding_functions
+                    # We use the default embedding function (all-MiniLM-L6-v2) built into Chroma for simplicity
+                    self._embedding_function = embedding_functions.DefaultEmbeddingFunction()
+                    self.warm_seconds["embedding_function"] = round(time.perf_counter() - start, 3)
+        return self._embedding_function
+
+    def _open(self):
+        with self._open_lock:
+            if self._client is not None:
+                return
+            start = time.perf_counter()
+            import chromadb
+            client = chromadb.PersistentClient(path=self.persist_directory)
+            names = {c.name for c in client.list_collections()}
+            if COLLECTION_NAME not in names and RETIRED_COLLECTION_NAME in names:
+                # A swap was interrupted between its two renames: roll back to the old collection
+                client.get_collection(RETIRED_COLLECTION_NAME).modify(name=COLLECTION_NAME)
+                print("Restored vector store collection after an interrupted swap")
+            # Create or get collection
+            self._collection = client.get_or_create_collection(name=COLLECTION_NAME)
+            # Published last: other threads only check _client
+            self._client = client
+            self.warm_seconds["client"] = round(time.perf_counter() - start, 3)
+            print(f"Vector store opened in {self.warm_seconds['client']:.2f}s")
+
+    def staging_collection(self, name: str):
+        """Collection outside the live path (e.g. a reindex target); writes to it skip caches and the lexical index"""
+        return self.client.get_or_create_collection(name=name)
+
+    def drop_collection(self, name: str):
+        if name in {c.name for c in self.client.list_collections()}:
+            self.client.delete_collection(name)
+
+    def swap_collection(self, staging_name: str):
+        """
+        Make a fully built staging collection the live one. The live collection is
+        renamed aside first, so a crash in between is rolled back by _open(); this
+        process switches handles in one assignment and drops the old collection.
+        """
+        client = self.client
+        with self._open_lock:
+            staged = client.get_collection(staging_name)
+            names = {c.name for c in client.list_collections()}
+            if RETIRED_COLLECTION_NAME in names:
+                client.delete_collection(RETIRED_COLLECTION_NAME)
+            if COLLECTION_NAME in names:
+                client.get_collection(COLLECTION_NAME).modify(name=RETIRED_COLLECTION_NAME)
+            staged.modify(name=COLLECTION_NAME)
+            self._collection = staged
+            if COLLECTION_NAME in names:
+                client.delete_collection(RETIRED_COLLECTION_NAME)
+        self._bump_generation()
+        # Rebuilt from the new collection on the next lookup
+        self.lexical.reset()
+        print(f"Swapped collection '{staging_name}' in as '{COLLECTION_NAME}'")
+
+    def warm_up(self):
+        """Open the client, load the embedding model and the lexical index ahead of the first query"""
+        self.warm_state = "warming"
+        start = time.perf_counter()
+        try:
+            self._open()
+            model_start = time.perf_counter()
+            # The ONNX session is created on the first call, not by the constructor
+            self._compute(["warm-up"])
+            self.warm_seconds["model"] = round(time.perf_counter() - model_start, 3)
+            self.lexical.load()
+        except Exception as e:
+            self.warm_state = "failed"
+            self.warm_error = str(e)
+            print(f"Vector store warm-up failed: {e}")
+            return
+        self.warm_seconds["total"] = round(time.perf_counter() - start, 3)
+        self.warm_state = "ready"
+        print(f"Vector store warm in {self.warm_seconds['total']:.2f}s")
+
+    def status(self) -> Dict[str, Any]:
+        return {
+            "state": self.warm_state,
+            "client_open": self._client is not None,
+            "model_loaded": self._model_loaded,
+            "lexical_loaded": self.lexical.loaded,
+            "seconds": dict(self.warm_seconds),
+            "error": self.warm_error,
+        }
 
     def add_document(self, doc_id: str, text: str, metadata: Dict[str, Any]):
         """
         Add a document to the vector store.
         """
-        self.collection.upsert(
-            documents=[text],
-            metadatas=[metadata],
-            ids=[doc_id]
-        )
-        print(f"Upserted document {doc_id} to vector store.")
+        self.add_documents([{"id": doc_id, "text": text, "metadata": metadata}])
 
-    def query_similar(self, query_text: str, n_results: int = 3) -> List[Dict[str, Any]]:
+    def add_documents(self, docs: List[Dict[str, Any]], batch_size: Optional[int] = None) -> int:
         """
-        Query for similar documents.
+        Upsert many {"id", "text", "metadata"} documents, embedding them
+        batch_size at a time (one embedding pass and one write per batch).
         """
+        if not docs:
+            return 0
+        # Last write wins when an id appears twice in one call
+        unique = list({d["id"]: d for d in docs}.values())
+        size = max(1, min(batch_size or EMBED_BATCH_SIZE, self.client.get_max_batch_size()))
+        embedded = 0
+        for start in range(0, len(unique), size):
+            batch = unique[start:start + size]
+            stored = self.collection.get(ids=[d["id"] for d in batch], include=["documents"])
+            current = dict(zip(stored["ids"], stored["documents"]))
+            # Same text already stored: only the metadata (e.g. cases_json) changed
+            same = [d for d in batch if current.get(d["id"]) == d["text"]]
+            changed = [d for d in batch if current.get(d["id"]) != d["text"]]
+            if same:
+                self.update_metadata([d["id"] for d in same], [d["metadata"] for d in same])
+            if changed:
+                self.collection.upsert(
+                    ids=[d["id"] for d in changed],
+                    documents=[d["text"] for d in changed],
+                    metadatas=[d["metadata"] for d in changed],
+                    embeddings=self.embed([d["text"] for d in changed])
+                )
+                for d in changed:
+                    self.lexical.upsert(d["id"], d["text"], d["metadata"])
+                self._bump_generation()
+                embedded += len(changed)
+        self.counters["embedded"] += embedded
+        print(f"Upserted {len(unique)} documents to vector store ({embedded} with new text).")
+        return len(unique)
+
+    def update_metadata(self, ids: List[str], metadatas: List[Dict[str, Any]]):
+        """Metadata-only update of existing documents; nothing is re-embedded"""
+        self.collection.update(ids=ids, metadatas=metadatas)
+        for doc_id, metadata in zip(ids, metadatas):
+            self.lexical.update_metadata(doc_id, metadata)
+        self._bump_generation()
+        self.counters["metadata_only"] += len(ids)
+
+    def delete_documents(self, ids: List[str]):
+        self.collection.delete(ids=ids)
+        self.lexical.remove(ids)
+        self._bump_generation()
+
+    def _bump_generation(self):
+        with self._generation_lock:
+            self.generation += 1
+
+    def _iter_documents(self, page_size: int = 500):
+        offset = 0
+        while True:
+            page = self.collection.get(limit=page_size, offset=offset, include=["documents", "metadatas"])
+            if not page["ids"]:
+                return
+            offset += len(page["ids"])
+            for doc_id, text, metadata in zip(page["ids"], page["documents"], page["metadatas"]):
+                yield doc_id, text or "", metadata or {}
+
+    def embed(self, texts: List[str]) -> List[Any]:
+        return embedding_cache.embed(self.embedding_function.name(), texts, self._compute)
+
+    def _compute(self, texts: List[str]) -> List[Any]:
+        vectors = self.embedding_function(texts)
+        self._model_loaded = True
+        return vectors
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            **self.counters,
+            "generation": self.generation,
+            "cache": embedding_cache.stats(),
+            "retrieval_cache": self.retrieval_cache.stats(),
+            "retrieval_mode": RETRIEVAL_MODE,
+            "lexical_index": self.lexical.stats(),
+            "warm": self.status(),
+        }
+
+    def query_similar(
+        self, query_text: str, n_results: int = 3, where: Optional[Dict[str, Any]] = None, mode: Optional[str] = None
+    ) -> List[Dict[str, Any]]:
+        """
+        Query for similar documents, optionally restricted by a Chroma metadata filter.
+        mode overrides QAI_RETRIEVAL_MODE (hybrid / vector / lexical).
+        """
+        start = time.perf_counter()
+        mode = (mode or RETRIEVAL_MODE).lower()
+        key = (query_text, n_results, json.dumps(where, sort_keys=True) if where else None, mode)
+        # Read before querying: a write landing mid-query leaves this entry already stale
+        generation = self.generation
+        cached = self.retrieval_cache.get(key, generation)
+        if cached is not None:
+            self.retrieval_cache.observe(True, time.perf_counter() - start)
+            return copy.deepcopy(cached)
+        results = self.flights.do(key + (generation,), lambda: self._retrieve(query_text, n_results, where, mode))
+        self.retrieval_cache.put(key, generation, copy.deepcopy(results))
+        self.retrieval_cache.observe(False, time.perf_counter() - start)
+        return results
+
+    def _retrieve(self, query_text: str, n_results: int, where: Optional[Dict[str, Any]], mode: str) -> List[Dict[str, Any]]:
+        if mode == "vector":
+            self.counters["vector"] += 1
+            return self._query(query_text, n_results, where)
+        if mode == "lexical":
+            self.counters["lexical"] += 1
+            return [self._strip(d) for d in self.lexical.search(query_text, n_results, where)]
+        # Each ranker contributes a few times more candidates than requested, so fusion can reorder
+        pool = max(n_results * 4, 10)
+        lexical = self.lexical.search(query_text, pool, where)
+        terms = exact_terms(query_text)
+        if lexical and terms and self.lexical.contains_all(lexical[0]["id"], terms):
+            # Field names / error codes found verbatim: no embedding pass needed
+            self.counters["lexical_fast_path"] += 1
+            return [self._strip(d) for d in lexical[:n_results]]
+        vector = self._query(query_text, pool, where)
+        if not lexical:
+            self.counters["vector"] += 1
+            return vector[:n_results]
+        self.counters["fused"] += 1
+        return self._fuse([lexical, vector], n_results)
+
+    @staticmethod
+    def _fuse(rankings: List[List[Dict[str, Any]]], n_results: int) -> List[Dict[str, Any]]:
+        """Reciprocal rank fusion: scores from BM25 and cosine distance are not comparable, ranks are"""
+        scores: Dict[str, float] = {}
+        docs: Dict[str, Dict[str, Any]] = {}
+        for ranking in rankings:
+            for rank, doc in enumerate(ranking):
+                scores[doc["id"]] = scores.get(doc["id"], 0.0) + 1.0 / (RRF_K + rank + 1)
+                docs.setdefault(doc["id"], doc)
+        ranked = sorted(scores, key=lambda doc_id: scores[doc_id], reverse=True)
+        return [VectorStoreService._strip(docs[doc_id]) for doc_id in ranked[:n_results]]
+
+    @staticmethod
+    def _strip(doc: Dict[str, Any]) -> Dict[str, Any]:
+        return {"content": doc["content"], "metadata": doc["metadata"], "id": doc["id"]}
+
+    def _query(self, query_text: str, n_results: int, where: Optional[Dict[str, Any]] = None) -> List[Dict[str, Any]]:
         results = self.collection.query(
-            query_texts=[query_text],
-            n_results=n_results
+            query_embeddings=self.embed([query_text]),
+            n_results=n_results,
+            where=where
         )
         
         # Format results
@@ -109,3 +109,43 @@ class TestCaseUpdate(SQLModel):
     priority: Optional[str] = None
     actual_result: Optional[str] = None
     remark: Optional[str] = None
+
+class JobBase(SQLModel):
+    kind: str = Field(index=True) # generate_cases, pipeline
+    status: str = Field(default="queued", index=True) # queued, running, succeeded, failed, cancelled
+    requirement_id: Optional[int] = Field(default=None, index=True)
+    progress: float = 0.0
+    progress_message: Optional[str] = None
+    error: Optional[str] = None
+    attempts: int = 0
+    cancel_requested: bool = False
+    created_at: datetime = Field(default_factory=datetime.now)
+    started_at: Optional[datetime] = None
+    finished_at: Optional[datetime] = None
+
+class Job(JobBase, table=True):
+    id: Optional[int] = Field(default=None, primary_key=True)
+    payload: str = "{}" # JSON request parameters
+    result: Optional[str] = None # JSON result once succeeded
+
+class JobRead(JobBase):
+    id: int
+
+class LLMCallLog(SQLModel, table=True):
+    """Append-only ledger row per LLM call (written in batches by app.core.llm_ledger)"""
+    id: Optional[int] = Field(default=None, primary_key=True)
+    created_at: datetime = Field(default_factory=datetime.now, index=True)
+    stage: str = Field(index=True) # modules, scenarios, cases, script, script_batch
+    model: Optional[str] = None
+    provider: Optional[str] = None # base_url
+    project_id: Optional[int] = Field(default=None, index=True)
+    version_id: Optional[int] = Field(default=None, index=True)
+    requirement_id: Optional[int] = None
+    prompt_tokens: int = 0
+    completion_tokens: int = 0
+    cache_hit_tokens: int = 0
+    latency_ms: int = 0
+    streamed: bool = False
+    cached: bool = False # served from the local response cache
+    parse_ok: Optional[bool] = None # None for free-text answers
+    status: str = "ok" # ok, error
@@ -1,14 +1,39 @@
-from fastapi import APIRouter, HTTPException
+from fastapi import APIRouter, Depends, HTTPException, Request
+from fastapi.concurrency import run_in_threadpool
+from fastapi.responses import StreamingResponse
 from pydantic import BaseModel
+from sqlmodel import Session, select
 from typing import List, Dict, Any, Optional
+import io
+import json
+import zipfile
+from datetime import datetime, timedelta
+from app.core.database import engine, get_session
+from app.core.sse import sse_event, SSE_HEADERS
+from app.models.models import Requirement, TestCase, JobRead, LLMCallLog
 from app.services.llm_service import llm_service
+from app.services.pipeline_service import pipeline_service
+from app.services.job_service import job_service
+from app.services.kb_sync_service import kb_sync
+from app.core.llm_clients import llm_client_pool
+from app.core.llm_cache import llm_cache
+from app.core.vector_store import vector_store
+from app.core.lexical_index import knowledge_index
+from app.core.llm_limiter import LLMCallError, rate_limiter
+from app.core.llm_router import provider_router
+from app.core.llm_usage import usage_meter
+from app.core.llm_ledger import llm_ledger, GROUP_COLUMNS
+from app.core.cancellation import cancellation
 
 router = APIRouter()
 
 class AIConfig(BaseModel):
     api_key: Optional[str] = None
-    base_url: Optional[str] = None
+    base_url: Optional[str] = None # "auto" (or no key/base_url) = route across QAI_LLM_PROVIDERS
     model: Optional[str] = "deepseek-chat"
+    use_cache: Optional[bool] = None # None = server default, False = bypass the response cache
+    requirement_id: Optional[int] = None # Attributes LLM ledger rows to the requirement's project/version
+    project_id: Optional[int] = None # Retrieval scope (and ledger project) when there is no requirement_id
 
 class AnalyzeRequest(AIConfig):
     requirement_content: str
@@ -25,21 +50,277 @@ class CaseRequest(AIConfig):
 class ScriptRequest(AIConfig):
     test_case: Dict[str, Any]
 
+class ScriptBatchRequest(AIConfig):
+    case_ids: Optional[List[int]] = None
+    requirement_id: Optional[int] = None
+    version_id: Optional[int] = None
+    format: str = "jsonl" # jsonl | zip
+    max_concurrency: Optional[int] = None
+
+class PromptPreviewRequest(AIConfig):
+    requirement_content: str
+    module: Optional[str] = None
+    scenario: Optional[str] = None
+
+class PipelineRequest(AIConfig):
+    requirement_id: Optional[int] = None
+    requirement_content: Optional[str] = None
+    modules: Optional[List[str]] = None # Skip stage 1 when the user already picked modules
+    max_concurrency: Optional[int] = None
+    persist: bool = True
+
+def _scope(req: AIConfig, requirement_id: Optional[int] = None) -> Dict[str, Optional[int]]:
+    """Ledger attribution, which also scopes knowledge-base retrieval to the project/version"""
+    return {
+        "requirement_id": requirement_id or req.requirement_id,
+        "version_id": getattr(req, "version_id", None),
+        "project_id": req.project_id,
+    }
+
+async def _resolve_scope(scope: Dict[str, Optional[int]]) -> Dict[str, Optional[int]]:
+    """llm_ledger.resolve() for async handlers: its DB lookup must not run on the event loop"""
+    return await run_in_threadpool(llm_ledger.resolve, **scope)
+
+async def _run_llm(request: Request, scope: Dict[str, Optional[int]], fn, *args, **kwargs):
+    """Blocking LLM work off the event loop, attributed in the ledger (scope already resolved) and cancelled if the client disconnects"""
+    def work():
+        with llm_ledger.attribute(**scope, resolve=False):
+            return fn(*args, **kwargs)
+    return await cancellation.run(request, work)
+
+def _retrieval(scope: Dict[str, Optional[int]]) -> Dict[str, Optional[int]]:
+    """Knowledge-base retrieval scope: the same project/version the ledger rows are attributed to"""
+    return {"project_id": scope["project_id"], "version_id": scope["version_id"]}
+
 @router.post("/analyze_modules")
-def analyze_modules(req: AnalyzeRequest):
-    return llm_service.analyze_modules(req.requirement_content, req.api_key, req.base_url, req.model)
+async def analyze_modules(req: AnalyzeRequest, request: Request):
+    return await _run_llm(
+        request, await _resolve_scope(_scope(req)), llm_service.analyze_modules,
+        req.requirement_content, req.api_key, req.base_url, req.model, req.use_cache
+    )
 
 @router.post("/generate_scenarios")
-def generate_scenarios(req: ScenarioRequest):
-    return llm_service.generate_scenarios(req.requirement_content, req.module, req.api_key, req.base_url, req.model)
+async def generate_scenarios(req: ScenarioRequest, request: Request):
+    return await _run_llm(
+        request, await _resolve_scope(_scope(req)), llm_service.generate_scenarios,
+        req.requirement_content, req.module, req.api_key, req.base_url, req.model, req.use_cache
+    )
 
 @router.post("/generate_cases")
-def generate_cases(req: CaseRequest):
-    return llm_service.generate_test_cases_rag(
-        req.requirement_content, req.module, req.scenario, 
-        req.api_key, req.base_url, req.model
+async def generate_cases(req: CaseRequest, request: Request):
+    scope = await _resolve_scope(_scope(req))
+    return await _run_llm(
+        request, scope, llm_service.generate_test_cases_rag,
+        req.requirement_content, req.module, req.scenario,
+        req.api_key, req.base_url, req.model, req.use_cache, **_retrieval(scope)
     )
 
+@router.post("/generate_cases/stream")
+def generate_cases_stream(req: CaseRequest):
+    """SSE variant of /generate_cases: one `case` event per completed test case"""
+    # Sync handler: runs in the threadpool, so the lookup is fine here
+    scope = llm_ledger.resolve(**_scope(req))
+
+    def events():
+        count = 0
+        try:
+            for case in llm_ledger.attributed(llm_service.stream_test_cases_rag(
+                req.requirement_content, req.module, req.scenario,
+                req.api_key, req.base_url, req.model, req.use_cache, **_retrieval(scope)
+            ), **scope, resolve=False):
+                count += 1
+                yield sse_event("case", case)
+        except LLMCallError as e:
+            yield sse_event("error", {"detail": str(e), "kind": e.kind, "status": e.status_code, "count": count})
+            return
+        yield sse_event("done", {"count": count})
+
+    return StreamingResponse(cancellation.stream(events()), media_type="text/event-stream", headers=SSE_HEADERS)
+
 @router.post("/generate_script")
-def generate_script(req: ScriptRequest):
-    return {"script": llm_service.generate_automation_script(req.test_case, req.api_key, req.base_url, req.model)}
+async def generate_script(req: ScriptRequest, request: Request):
+    script = await _run_llm(
+        request, await _resolve_scope(_scope(req, req.test_case.get("requirement_id"))), llm_service.generate_automation_script,
+        req.test_case, req.api_key, req.base_url, req.model, req.use_cache
+    )
+    return {"script": script}
+
+def _select_script_cases(req: ScriptBatchRequest) -> List[Dict[str, Any]]:
+    query = select(TestCase)
+    if req.version_id:
+        query = query.join(Requirement).where(Requirement.version_id == req.version_id)
+    if req.requirement_id:
+        query = query.where(TestCase.requirement_id == req.requirement_id)
+    if req.case_ids:
+        query = query.where(TestCase.id.in_(req.case_ids))
+    with Session(engine) as session:
+        return [c.dict() for c in session.exec(query.order_by(TestCase.id)).all()]
+
+@router.post("/generate_scripts")
+async def generate_scripts(req: ScriptBatchRequest):
+    """Batch-convert test cases to Playwright scripts, streamed back as JSONL or a zip"""
+    if req.format not in ("jsonl", "zip"):
+        raise HTTPException(status_code=400, detail="format must be jsonl or zip")
+    if not (req.case_ids or req.requirement_id or req.version_id):
+        raise HTTPException(status_code=400, detail="case_ids, requirement_id or version_id is required")
+
+    # A whole version can be thousands of rows; keep the query off the event loop
+    cases = await run_in_threadpool(_select_script_cases, req)
+    if not cases:
+        raise HTTPException(status_code=404, detail="No test cases matched")
+
+    scope = await _resolve_scope(_scope(req))
+
+    async def attributed_results():
+        # Entered inside the generator: the response body runs after this handler returns
+        with llm_ledger.attribute(**scope, resolve=False), cancellation.scope():
+            async for r in pipeline_service.stream_scripts(
+                cases, req.api_key, req.base_url, req.model,
+                max_concurrency=req.max_concurrency, use_cache=req.use_cache
+            ):
+                yield r
+
+    results = attributed_results()
+    if req.format == "zip":
+        return StreamingResponse(
+            _zip_stream(results),
+            media_type="application/zip",
+            headers={"Content-Disposition": "attachment; filename=playwright_scripts.zip"}
+        )
+    return StreamingResponse(
+        (json.dumps(r, ensure_ascii=False) + "\n" async for r in results),
+        media_type="application/x-ndjson"
+    )
+
+class _ZipChunks(io.RawIOBase):
+    """Write-only sink so ZipFile can emit entries as they are added (no seeking)"""
+    def __init__(self):
+        self._chunks = []
+        self._pos = 0
+
+    def writable(self):
+        return True
+
+    def write(self, b):
+        self._chunks.append(bytes(b))
+        self._pos += len(b)
+        return len(b)
+
+    def tell(self):
+        return self._pos
+
+    def take(self) -> bytes:
+        data = b"".join(self._chunks)
+        self._chunks = []
+        return data
+
+async def _zip_stream(results):
+    sink = _ZipChunks()
+    with zipfile.ZipFile(sink, "w", zipfile.ZIP_DEFLATED) as zf:
+        async for r in results:
+            script = r["script"] if not r.get("error") else f"# 生成失败: {r['error']}"
+            zf.writestr(f"test_case_{r['id']}.py", f"# {r['title']}\n{script}\n")
+            yield sink.take()
+    yield sink.take()
+
+@router.post("/prompt_preview")
+def prompt_preview(req: PromptPreviewRequest):
+    """Show the assembled prompt and its token budget report"""
+    with llm_ledger.attribute(**_scope(req)) as scope:
+        return llm_service.preview_prompt(req.requirement_content, req.model, req.module, req.scenario, **_retrieval(scope))
+
+def _requirement_content(requirement_id: int) -> Optional[str]:
+    with Session(engine) as session:
+        requirement = session.get(Requirement, requirement_id)
+        return requirement.content if requirement else None
+
+@router.post("/pipeline")
+async def run_pipeline(req: PipelineRequest, request: Request):
+    """Run modules -> scenarios -> cases in one request, fanning out concurrently"""
+    content = req.requirement_content
+    if req.requirement_id:
+        stored = await run_in_threadpool(_requirement_content, req.requirement_id)
+        if stored is None:
+            raise HTTPException(status_code=404, detail="Requirement not found")
+        content = content or stored
+    if not content:
+        raise HTTPException(status_code=400, detail="requirement_id or requirement_content is required")
+
+    scope = await _resolve_scope(_scope(req))
+    with llm_ledger.attribute(**scope, resolve=False):
+        # Fan-out tasks and their worker threads inherit the cancel token
+        result = await cancellation.guard(request, lambda: pipeline_service.run(
+            req.requirement_id, content, req.api_key, req.base_url, req.model,
+            modules=req.modules, max_concurrency=req.max_concurrency, use_cache=req.use_cache,
+            persist=req.persist and bool(req.requirement_id), **_retrieval(scope)
+        ))
+    if req.persist and req.requirement_id and result["stats"]["cases"]:
+        # Debounced background resync, like every other case edit
+        kb_sync.schedule(req.requirement_id)
+    return result
+
+@router.post("/pipeline/async", response_model=JobRead, status_code=202)
+def submit_pipeline_job(req: PipelineRequest, session: Session = Depends(get_session)):
+    """Queue the pipeline as a background job; poll /jobs/{id} for progress"""
+    if req.requirement_id:
+        if not session.get(Requirement, req.requirement_id):
+            raise HTTPException(status_code=404, detail="Requirement not found")
+    elif not req.requirement_content:
+        raise HTTPException(status_code=400, detail="requirement_id or requirement_content is required")
+    return job_service.submit("pipeline", req.dict(), requirement_id=req.requirement_id)
+
+@router.get("/stats")
+def ai_stats():
+    return {
+        "client_pool": llm_client_pool.stats(),
+        "providers": rate_limiter.stats(),
+        "routing": provider_router.stats(),
+        "usage": usage_meter.stats(),
+        "ledger": llm_ledger.stats(),
+        "cancellation": cancellation.stats(),
+        "singleflight": {
+            "llm": llm_service.flights.stats(),
+            "retrieval": vector_store.flights.stats(),
+        },
+        "response_cache": llm_cache.stats(),
+        "vector_store": vector_store.stats(),
+        "knowledge_index": knowledge_index.stats(),
+        "kb_sync": kb_sync.stats(),
+        "knowledge_rules": llm_service.rules_cache_stats(),
+    }
+
+@router.get("/ledger/summary")
+def ledger_summary(
+    group_by: str = "stage",
+    project_id: Optional[int] = None,
+    version_id: Optional[int] = None,
+    since_hours: Optional[float] = None,
+    session: Session = Depends(get_session)
+):
+    """Cost / tokens / latency from the LLM call ledger, e.g. group_by=project,stage"""
+    keys = [k.strip() for k in group_by.split(",") if k.strip()]
+    unknown = [k for k in keys if k not in GROUP_COLUMNS]
+    if unknown:
+        raise HTTPException(status_code=400, detail=f"group_by must be among {', '.join(GROUP_COLUMNS)}")
+    since = datetime.now() - timedelta(hours=since_hours) if since_hours else None
+    return llm_ledger.summary(session, keys, project_id=project_id, version_id=version_id, since=since)
+
+@router.get("/ledger/calls", response_model=List[LLMCallLog])
+def ledger_calls(
+    stage: Optional[str] = None,
+    requirement_id: Optional[int] = None,
+    limit: int = 100,
+    session: Session = Depends(get_session)
+):
+    """Most recent ledger rows"""
+    query = select(LLMCallLog)
+    if stage:
+        query = query.where(LLMCallLog.stage == stage)
+    if requirement_id:
+        query = query.where(LLMCallLog.requirement_id == requirement_id)
+    return session.exec(query.order_by(LLMCallLog.id.desc()).limit(min(limit, 1000))).all()
+
+@router.delete("/cache")
+def clear_ai_cache():
+    llm_cache.clear()
+    return {"ok": True}
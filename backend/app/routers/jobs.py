@@ -0,0 +1,48 @@
+from fastapi import APIRouter, Depends, HTTPException
+from sqlmodel import Session, select
+from typing import List, Optional
+import json
+from app.core.database import get_session
+from app.models.models import Job, JobRead
+from app.services.job_service import job_service
+
+router = APIRouter()
+
+@router.get("/jobs/", response_model=List[JobRead])
+def read_jobs(
+    status: Optional[str] = None,
+    requirement_id: Optional[int] = None,
+    offset: int = 0,
+    limit: int = 100,
+    session: Session = Depends(get_session)
+):
+    query = select(Job)
+    if status:
+        query = query.where(Job.status == status)
+    if requirement_id:
+        query = query.where(Job.requirement_id == requirement_id)
+    query = query.order_by(Job.id.desc()).offset(offset).limit(limit)
+    return session.exec(query).all()
+
+@router.get("/jobs/{job_id}", response_model=JobRead)
+def read_job(job_id: int, session: Session = Depends(get_session)):
+    job = session.get(Job, job_id)
+    if not job:
+        raise HTTPException(status_code=404, detail="Job not found")
+    return job
+
+@router.get("/jobs/{job_id}/result")
+def read_job_result(job_id: int, session: Session = Depends(get_session)):
+    job = session.get(Job, job_id)
+    if not job:
+        raise HTTPException(status_code=404, detail="Job not found")
+    if job.status != "succeeded":
+        raise HTTPException(status_code=409, detail=f"Job is {job.status}")
+    return json.loads(job.result or "null")
+
+@router.post("/jobs/{job_id}/cancel", response_model=JobRead)
+def cancel_job(job_id: int):
+    job = job_service.cancel(job_id)
+    if not job:
+        raise HTTPException(status_code=404, detail="Job not found")
+    return job
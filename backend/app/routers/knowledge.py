@@ -1,8 +1,10 @@
 from fastapi import APIRouter, Depends, HTTPException
 from sqlmodel import Session, select
-from typing import List
+from typing import List, Optional
 from app.core.database import get_session
+from app.core.lexical_index import knowledge_index, knowledge_doc
 from app.models.models import KnowledgeItem, KnowledgeItemCreate, KnowledgeItemRead
+from app.services.llm_service import llm_service
 
 router = APIRouter()
 
@@ -12,6 +14,8 @@ def create_knowledge_item(item: KnowledgeItemCreate, session: Session = Depends(
     session.add(db_item)
     session.commit()
     session.refresh(db_item)
+    llm_service.invalidate_knowledge_rules()
+    knowledge_index.upsert(*knowledge_doc(db_item))
     return db_item
 
 @router.get("/knowledge/", response_model=List[KnowledgeItemRead])
@@ -27,6 +31,19 @@ def read_knowledge_items(
     items = session.exec(query.offset(offset).limit(limit)).all()
     return items
 
+@router.get("/knowledge/search", response_model=List[KnowledgeItemRead])
+def search_knowledge_items(
+    q: str,
+    category: Optional[str] = None,
+    limit: int = 10,
+    session: Session = Depends(get_session)
+):
+    """Keyword search (BM25 over content and tags), best match first"""
+    hits = knowledge_index.search(q, limit, {"category": category} if category else None)
+    ids = [h["metadata"]["knowledge_id"] for h in hits]
+    items = {i.id: i for i in session.exec(select(KnowledgeItem).where(KnowledgeItem.id.in_(ids))).all()}
+    return [items[i] for i in ids if i in items]
+
 @router.delete("/knowledge/{item_id}")
 def delete_knowledge_item(item_id: int, session: Session = Depends(get_session)):
     item = session.get(KnowledgeItem, item_id)
@@ -34,4 +51,6 @@ def delete_knowledge_item(item_id: int, session: Session = Depends(get_session))
         raise HTTPException(status_code=404, detail="Knowledge item not found")
     session.delete(item)
     session.commit()
+    llm_service.invalidate_knowledge_rules()
+    knowledge_index.remove([str(item_id)])
     return {"ok": True}
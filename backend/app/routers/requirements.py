@@ -1,14 +1,21 @@
 import os
 from fastapi import APIRouter, Depends, HTTPException, UploadFile, File
+from fastapi.responses import StreamingResponse
 from sqlmodel import Session, select
 from typing import List, Optional
 from pydantic import BaseModel
-from app.core.database import get_session
+from app.core.database import get_session, engine
+from app.core.sse import sse_event, SSE_HEADERS
+from app.core.llm_limiter import LLMCallError
+from app.core.llm_ledger import llm_ledger
+from app.core.cancellation import cancellation
 from app.core.vector_store import vector_store
-from app.models.models import Requirement, RequirementCreate, RequirementRead, RequirementUpdate, TestCase, TestCaseRead, KnowledgeItem
+from app.core.lexical_index import knowledge_index, knowledge_doc
+from app.models.models import Requirement, RequirementCreate, RequirementRead, RequirementUpdate, TestCase, TestCaseRead, KnowledgeItem, JobRead
 from app.services.llm_service import llm_service
+from app.services.job_service import job_service
+from app.services.kb_sync_service import kb_sync, sync_req_to_kb
 from datetime import datetime
-import json
 import io
 
 router = APIRouter()
@@ -17,6 +24,7 @@ class GenerateRequest(BaseModel):
     api_key: Optional[str] = None
     base_url: Optional[str] = None
     model: Optional[str] = "deepseek-chat"
+    use_cache: Optional[bool] = None
 
 @router.post("/requirements/import_file")
 async def import_requirements_file(
@@ -80,31 +88,10 @@ def sync_requirement_to_knowledge_base(requirement_id: int, session: Session = D
     if not requirement:
         raise HTTPException(status_code=404, detail="Requirement not found")
     
-    # Get associated test cases
-    cases = session.exec(select(TestCase).where(TestCase.requirement_id == requirement_id)).all()
-    
-    # Convert cases to JSON string for metadata
-    cases_data = []
-    for c in cases:
-        cases_data.append({
-            "title": c.title,
-            "steps": c.steps,
-            "expected": c.expected_result
-        })
-    
-    cases_json = json.dumps(cases_data, ensure_ascii=False)
-    
-    # Add to Vector Store
-    # Doc ID = req_{id}
-    vector_store.add_document(
-        doc_id=f"req_{requirement.id}",
-        text=requirement.content,
-        metadata={
-            "title": requirement.title,
-            "cases_json": cases_json,
-            "source": "qai_db"
-        }
-    )
+    # Add to Vector Store under the same id the case syncs use; cases stay in SQLite
+    sync_req_to_kb(session, requirement.id)
+    # Earlier versions of this endpoint wrote a second copy as req_{id}
+    vector_store.delete_documents([f"req_{requirement.id}"])
     
     # Also sync to KnowledgeItem SQL table for visibility
     # Check if exists to avoid duplicates
@@ -121,6 +108,9 @@ def sync_requirement_to_knowledge_base(requirement_id: int, session: Session = D
     )
     session.add(kb_item)
     session.commit()
+    session.refresh(kb_item)
+    llm_service.invalidate_knowledge_rules()
+    knowledge_index.upsert(*knowledge_doc(kb_item))
     
     return {"message": "同步至知识库成功 (Vector + SQL)"}
 
@@ -168,6 +158,9 @@ def update_requirement(requirement_id: int, requirement: RequirementUpdate, sess
     session.add(db_requirement)
     session.commit()
     session.refresh(db_requirement)
+    if "content" in requirement_data or "version_id" in requirement_data:
+        # Keep the KB text and its project/version scope in step
+        kb_sync.schedule(requirement_id)
     return db_requirement
 
 @router.delete("/requirements/{requirement_id}")
@@ -178,6 +171,12 @@ def delete_requirement(requirement_id: int, session: Session = Depends(get_sessi
     
     session.delete(requirement)
     session.commit()
+    # Drop its KB documents (per-case sync id and manual sync_kb id) so retrieval stops returning it
+    kb_sync.note_written([requirement_id])
+    try:
+        vector_store.delete_documents([str(requirement_id), f"req_{requirement_id}"])
+    except Exception as e:
+        print(f"Remove requirement from KB failed: {e}")
     return {"ok": True}
 
 @router.post("/requirements/{requirement_id}/generate_cases", response_model=List[TestCaseRead])
@@ -191,21 +190,27 @@ def generate_cases_for_requirement(
         raise HTTPException(status_code=404, detail="Requirement not found")
     
     # Call AI Service with dynamic config
-    generated_data = llm_service.generate_test_cases(
-        requirement_content=requirement.content,
-        api_key=gen_config.api_key,
-        base_url=gen_config.base_url,
-        model=gen_config.model
-    )
+    with llm_ledger.attribute(requirement_id, requirement.version_id) as scope:
+        generated_data = llm_service.generate_test_cases(
+            requirement_content=requirement.content,
+            api_key=gen_config.api_key,
+            base_url=gen_config.base_url,
+            model=gen_config.model,
+            use_cache=gen_config.use_cache,
+            project_id=scope["project_id"],
+            version_id=scope["version_id"]
+        )
     
     created_cases = []
     for case_data in generated_data:
+        if not isinstance(case_data, dict) or not case_data.get("title") or not case_data.get("steps"):
+            continue
         test_case = TestCase(
             module=case_data.get("module", "默认模块"),
             title=case_data["title"],
             precondition=case_data.get("precondition"),
             steps=case_data["steps"],
-            expected_result=case_data["expected_result"],
+            expected_result=case_data.get("expected_result", ""),
             priority=case_data.get("priority", "P2"),
             requirement_id=requirement.id
         )
@@ -218,3 +223,66 @@ def generate_cases_for_requirement(
         session.refresh(case)
         
     return created_cases
+
+@router.post("/requirements/{requirement_id}/generate_cases/async", response_model=JobRead, status_code=202)
+def submit_generate_cases_job(
+    requirement_id: int, 
+    gen_config: GenerateRequest,
+    session: Session = Depends(get_session)
+):
+    """Queue generation as a background job and return immediately; poll /jobs/{id}"""
+    if not session.get(Requirement, requirement_id):
+        raise HTTPException(status_code=404, detail="Requirement not found")
+    payload = {"requirement_id": requirement_id, **gen_config.dict()}
+    return job_service.submit("generate_cases", payload, requirement_id=requirement_id)
+
+@router.post("/requirements/{requirement_id}/generate_cases/stream")
+def generate_cases_for_requirement_stream(
+    requirement_id: int, 
+    gen_config: GenerateRequest,
+    session: Session = Depends(get_session)
+):
+    """SSE variant: each case is saved and sent as soon as the model finishes it"""
+    requirement = session.get(Requirement, requirement_id)
+    if not requirement:
+        raise HTTPException(status_code=404, detail="Requirement not found")
+    content = requirement.content
+    scope = llm_ledger.resolve(requirement_id, requirement.version_id)
+
+    def events():
+        count = 0
+        # The request session is closed once the response starts, so stream with our own
+        with Session(engine) as stream_session:
+            try:
+                for case_data in llm_ledger.attributed(llm_service.stream_test_cases(
+                    requirement_content=content,
+                    api_key=gen_config.api_key,
+                    base_url=gen_config.base_url,
+                    model=gen_config.model,
+                    use_cache=gen_config.use_cache,
+                    project_id=scope["project_id"],
+                    version_id=scope["version_id"]
+                ), **scope, resolve=False):
+                    if not case_data.get("title") or not case_data.get("steps"):
+                        continue
+                    test_case = TestCase(
+                        module=case_data.get("module", "默认模块"),
+                        title=case_data["title"],
+                        precondition=case_data.get("precondition"),
+                        steps=case_data["steps"],
+                        expected_result=case_data.get("expected_result", ""),
+                        priority=case_data.get("priority", "P2"),
+                        requirement_id=requirement_id
+                    )
+                    stream_session.add(test_case)
+                    stream_session.commit()
+                    stream_session.refresh(test_case)
+                    count += 1
+                    yield sse_event("case", TestCaseRead.from_orm(test_case).dict())
+            except LLMCallError as e:
+                # Cases already sent are saved; tell the client why the rest is missing
+                yield sse_event("error", {"detail": str(e), "kind": e.kind, "status": e.status_code, "count": count})
+                return
+        yield sse_event("done", {"count": count})
+
+    return StreamingResponse(cancellation.stream(events()), media_type="text/event-stream", headers=SSE_HEADERS)
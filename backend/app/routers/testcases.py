@@ -2,41 +2,15 @@ from fastapi import APIRouter, Depends, HTTPException, UploadFile, File, Query
 from fastapi.responses import StreamingResponse
 from sqlmodel import Session, select
 from typing import List, Optional
-import json
-import pandas as pd
 import io
 from app.core.database import get_session
-from app.models.models import TestCase, TestCaseCreate, TestCaseRead, TestCaseUpdate, Requirement
-from app.core.vector_store import vector_store
+from app.models.models import TestCase, TestCaseCreate, TestCaseRead, TestCaseUpdate, Requirement, JobRead
+from app.services.kb_sync_service import kb_sync, sync_reqs_to_kb, backfill_kb_metadata
+from app.services.job_service import job_service
+from app.services.reindex_service import reindexer
 
 router = APIRouter()
 
-def sync_req_to_kb(session: Session, requirement_id: int):
-    """Helper to sync requirement and its cases to Vector DB"""
-    try:
-        req = session.get(Requirement, requirement_id)
-        if not req: return
-        
-        # Get all cases for this req
-        cases = session.exec(select(TestCase).where(TestCase.requirement_id == requirement_id)).all()
-        # Simple serialization
-        cases_data = []
-        for c in cases:
-            cases_data.append({
-                "module": c.module,
-                "title": c.title,
-                "steps": c.steps,
-                "expected": c.expected_result
-            })
-            
-        vector_store.add_document(
-            doc_id=str(req.id),
-            text=req.content,
-            metadata={"cases_json": json.dumps(cases_data, ensure_ascii=False)}
-        )
-    except Exception as e:
-        print(f"Sync to KB failed: {e}")
-
 @router.get("/testcases/", response_model=List[TestCaseRead])
 def read_test_cases(
     requirement_id: Optional[int] = None, 
@@ -86,7 +60,8 @@ def export_test_cases(
     query = query.order_by(TestCase.id)
     cases = session.exec(query).all()
     
-    # Convert to DataFrame
+    # Convert to DataFrame (pandas is imported on use to keep API startup fast)
+    import pandas as pd
     data = [c.dict() for c in cases]
     df = pd.DataFrame(data)
     
@@ -143,6 +118,7 @@ def export_test_cases(
 
 @router.get("/testcases/template")
 def get_import_template():
+    import pandas as pd
     # Create an empty DataFrame with the required columns
     columns = ["需求ID", "模块", "用例标题", "前置条件", "步骤", "预期结果", "优先级", "实际结果", "备注"]
     df = pd.DataFrame(columns=columns)
@@ -176,6 +152,7 @@ async def import_test_cases(
     file: UploadFile = File(...),
     session: Session = Depends(get_session)
 ):
+    import pandas as pd
     contents = await file.read()
     stream = io.BytesIO(contents)
     
@@ -201,6 +178,14 @@ async def import_test_cases(
         
         count = 0
         req_ids_to_sync = set()
+        # One lookup for every referenced requirement instead of one per row
+        referenced = set()
+        for value in df.get("requirement_id", []):
+            try:
+                referenced.add(int(value))
+            except (TypeError, ValueError):
+                continue
+        existing_req_ids = set(session.exec(select(Requirement.id).where(Requirement.id.in_(referenced))).all()) if referenced else set()
         
         for _, row in df.iterrows():
             # Validate required
@@ -210,7 +195,7 @@ async def import_test_cases(
             try:
                 # Check if requirement exists
                 req_id = int(row["requirement_id"])
-                if not session.get(Requirement, req_id):
+                if req_id not in existing_req_ids:
                     continue # Skip if req not found
                     
                 case_data = {
@@ -235,15 +220,42 @@ async def import_test_cases(
                 
         session.commit()
         
-        # Sync updated requirements to KB
-        for rid in req_ids_to_sync:
-            sync_req_to_kb(session, rid)
+        # Sync updated requirements to KB in a few large batches
+        sync_reqs_to_kb(session, req_ids_to_sync)
             
         return {"message": "Import successful", "count": count}
         
     except Exception as e:
         raise HTTPException(400, f"Parse error: {str(e)}")
 
+@router.post("/testcases/kb_sync/flush")
+def flush_kb_sync():
+    """Push pending background KB syncs now (e.g. before querying the KB in tests or scripts)"""
+    return {"flushed": kb_sync.flush(), **kb_sync.stats()}
+
+@router.post("/testcases/kb_sync/backfill")
+def backfill_kb_sync_metadata(session: Session = Depends(get_session)):
+    """One-off: give older KB documents scope/reference metadata and drop their embedded cases"""
+    return backfill_kb_metadata(session)
+
+@router.post("/testcases/kb_sync/reindex", response_model=JobRead, status_code=202)
+def reindex_kb(fresh: bool = False, restart: bool = False):
+    """
+    Rebuild the KB index from the database as a background job (poll /jobs/{id}).
+    fresh=true builds a new collection and swaps it in; restart=true ignores the
+    checkpoint of an interrupted run instead of resuming it.
+    """
+    return job_service.submit("reindex", {"fresh": fresh, "restart": restart})
+
+@router.get("/testcases/kb_sync/reindex")
+def reindex_kb_checkpoint():
+    """Checkpoint of an unfinished reindex (null when none is pending)"""
+    return reindexer.load_checkpoint()
+
+@router.get("/testcases/kb_sync/stats")
+def kb_sync_stats():
+    return kb_sync.stats()
+
 @router.get("/testcases/{case_id}", response_model=TestCaseRead)
 def read_test_case(case_id: int, session: Session = Depends(get_session)):
     case = session.get(TestCase, case_id)
@@ -258,8 +270,8 @@ def create_test_case(test_case: TestCaseCreate, session: Session = Depends(get_s
     session.commit()
     session.refresh(db_case)
     
-    # Sync to KB
-    sync_req_to_kb(session, db_case.requirement_id)
+    # Sync to KB in the background (edits to one requirement are coalesced)
+    kb_sync.schedule(db_case.requirement_id)
     
     return db_case
 
@@ -277,8 +289,8 @@ def update_test_case(case_id: int, test_case: TestCaseUpdate, session: Session =
     session.commit()
     session.refresh(db_case)
     
-    # Sync to KB
-    sync_req_to_kb(session, db_case.requirement_id)
+    # Sync to KB in the background (edits to one requirement are coalesced)
+    kb_sync.schedule(db_case.requirement_id)
     
     return db_case
 
@@ -315,11 +327,15 @@ def batch_delete_test_cases(
         
     cases = session.exec(query).all()
     count = len(cases)
+    req_ids_to_sync = {c.requirement_id for c in cases}
     
     for c in cases:
         session.delete(c)
         
     session.commit()
+    # Drop the deleted cases from the KB copies too (debounced, like single deletes)
+    for rid in req_ids_to_sync:
+        kb_sync.schedule(rid)
     return {"message": f"Deleted {count} test cases"}
 
 @router.delete("/testcases/{case_id}")
@@ -332,7 +348,7 @@ def delete_test_case(case_id: int, session: Session = Depends(get_session)):
     session.delete(case)
     session.commit()
     
-    # Sync to KB
-    sync_req_to_kb(session, req_id)
+    # Sync to KB in the background
+    kb_sync.schedule(req_id)
     
     return {"ok": True}
@@ -0,0 +1,321 @@
+import asyncio
+import json
+import os
+import threading
+import traceback
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from typing import Any, Callable, Dict, Optional
+from sqlmodel import Session, select
+from app.core.database import engine
+from app.core.cancellation import CancelToken, RequestCancelled, cancellation
+from app.core.llm_ledger import llm_ledger
+from app.core.llm_router import provider_router, ROUTE_AUTO
+from app.models.models import Job, Requirement
+from app.services.llm_service import llm_service
+from app.services.pipeline_service import pipeline_service
+from app.services.kb_sync_service import kb_sync
+from app.services.reindex_service import reindexer
+
+JOB_WORKERS = int(os.getenv("QAI_JOB_WORKERS", "4"))
+
+ACTIVE_STATUSES = ("queued", "running")
+FINAL_STATUSES = ("succeeded", "failed", "cancelled")
+# Payload fields kept in memory only, never written to the job table
+SECRET_FIELDS = ("api_key",)
+
+
+class JobCancelled(Exception):
+    pass
+
+
+class JobContext:
+    """Handed to job handlers for progress reporting and cooperative cancellation"""
+
+    def __init__(self, service: "JobService", job_id: int, scope: Optional[Dict[str, Optional[int]]] = None):
+        self.service = service
+        self.job_id = job_id
+        # Resolved requirement/version/project of the job: ledger attribution and retrieval scope
+        self.scope = scope or {}
+
+    @property
+    def retrieval(self) -> Dict[str, Optional[int]]:
+        return {"project_id": self.scope.get("project_id"), "version_id": self.scope.get("version_id")}
+
+    def progress(self, fraction: Optional[float] = None, message: Optional[str] = None):
+        fields: Dict[str, Any] = {}
+        if fraction is not None:
+            fields["progress"] = round(min(max(fraction, 0.0), 1.0), 3)
+        if message is not None:
+            fields["progress_message"] = message
+        if fields:
+            self.service._update(self.job_id, **fields)
+
+    def check_cancelled(self):
+        if self.service._is_cancel_requested(self.job_id):
+            raise JobCancelled()
+
+
+class JobService:
+    """
+    SQLite-backed job queue drained by a local thread pool.
+    Jobs survive restarts: anything still queued or running when the process
+    stopped is re-queued by start(). Handlers must therefore be safe to re-run,
+    which is why they only write their results once, at the end. API keys
+    are never persisted: a job resumed after a restart uses the provider
+    pool if one is configured and fails otherwise.
+    """
+
+    def __init__(self, workers: int = JOB_WORKERS):
+        self.workers = workers
+        self._executor: Optional[ThreadPoolExecutor] = None
+        self._handlers: Dict[str, Callable[[JobContext, Dict[str, Any]], Any]] = {}
+        # Trips the running job's in-flight provider calls, limiter waits and backoffs
+        self._cancel_tokens: Dict[int, CancelToken] = {}
+        # job id -> SECRET_FIELDS of its payload; lost on restart by design
+        self._secrets: Dict[int, Dict[str, Any]] = {}
+        self._lock = threading.Lock()
+        self._stopping = False
+
+    def register(self, kind: str, handler: Callable[[JobContext, Dict[str, Any]], Any]):
+        self._handlers[kind] = handler
+
+    def start(self):
+        self._stopping = False
+        self._executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="qai-job")
+        with Session(engine) as session:
+            pending = session.exec(
+                select(Job).where(Job.status.in_(ACTIVE_STATUSES)).order_by(Job.id)
+            ).all()
+            for job in pending:
+                if job.cancel_requested:
+                    job.status = "cancelled"
+                    job.finished_at = datetime.now()
+                else:
+                    job.status = "queued"
+                session.add(job)
+            session.commit()
+            resume_ids = [j.id for j in pending if j.status == "queued"]
+        if resume_ids:
+            print(f"Resuming {len(resume_ids)} background jobs: {resume_ids}")
+        for job_id in resume_ids:
+            self._enqueue(job_id)
+
+    def shutdown(self):
+        if self._executor:
+            # Abort in-flight LLM calls so the worker threads can exit. The jobs are not marked
+            # cancelled: they stay 'running' in the DB and are picked up again on next start
+            with self._lock:
+                self._stopping = True
+                tokens = list(self._cancel_tokens.values())
+            for token in tokens:
+                token.cancel()
+            self._executor.shutdown(wait=False, cancel_futures=True)
+            self._executor = None
+
+    def submit(self, kind: str, payload: Dict[str, Any], requirement_id: Optional[int] = None) -> Job:
+        if kind not in self._handlers:
+            raise ValueError(f"Unknown job kind: {kind}")
+        secrets = {k: payload[k] for k in SECRET_FIELDS if payload.get(k)}
+        stored = {k: v for k, v in payload.items() if k not in SECRET_FIELDS}
+        if secrets:
+            # Lets a run after a restart tell "no key given" from "key lost"
+            stored["secrets_dropped"] = sorted(secrets)
+        with Session(engine) as session:
+            job = Job(kind=kind, payload=json.dumps(stored, ensure_ascii=False), requirement_id=requirement_id)
+            session.add(job)
+            session.commit()
+            session.refresh(job)
+        if secrets:
+            with self._lock:
+                self._secrets[job.id] = secrets
+        self._enqueue(job.id)
+        return job
+
+    def cancel(self, job_id: int) -> Optional[Job]:
+        with Session(engine) as session:
+            job = session.get(Job, job_id)
+            if not job:
+                return None
+            if job.status in FINAL_STATUSES:
+                return job
+            job.cancel_requested = True
+            if job.status == "queued":
+                # Not started yet: the worker will skip it
+                job.status = "cancelled"
+                job.finished_at = datetime.now()
+            session.add(job)
+            session.commit()
+            session.refresh(job)
+        with self._lock:
+            token = self._cancel_tokens.get(job_id)
+        if token:
+            token.cancel()
+        return job
+
+    def _enqueue(self, job_id: int):
+        if self._executor is None:
+            raise RuntimeError("JobService is not started")
+        self._executor.submit(self._run, job_id)
+
+    def _run(self, job_id: int):
+        with Session(engine) as session:
+            job = session.get(Job, job_id)
+            if not job or job.status != "queued":
+                return
+            job.status = "running"
+            job.started_at = datetime.now()
+            job.attempts += 1
+            job.progress = 0.0
+            session.add(job)
+            session.commit()
+            kind, payload = job.kind, json.loads(job.payload or "{}")
+            requirement_id = job.requirement_id
+
+        token = CancelToken()
+        with self._lock:
+            self._cancel_tokens[job_id] = token
+            secrets = self._secrets.get(job_id, {})
+        try:
+            payload = self._with_secrets(payload, secrets)
+            with llm_ledger.attribute(requirement_id, project_id=payload.get("project_id")) as scope, cancellation.bind(token):
+                result = self._handlers[kind](JobContext(self, job_id, scope), payload)
+            if token.cancelled:
+                raise JobCancelled()
+            self._update(
+                job_id, status="succeeded", progress=1.0, finished_at=datetime.now(),
+                result=json.dumps(result, ensure_ascii=False, default=str)
+            )
+        except (JobCancelled, RequestCancelled):
+            # RequestCancelled: raised by the LLM layer mid-call once the token tripped
+            self._finish_cancelled(job_id)
+        except Exception as e:
+            if token.cancelled:
+                # Aborting a call can surface as any error; the job was cancelled either way
+                self._finish_cancelled(job_id)
+                return
+            traceback.print_exc()
+            self._update(job_id, status="failed", error=str(e), finished_at=datetime.now())
+        finally:
+            with self._lock:
+                self._cancel_tokens.pop(job_id, None)
+                if not self._stopping:
+                    # Kept across shutdown() so a restart within this process can resume the job
+                    self._secrets.pop(job_id, None)
+
+    def _finish_cancelled(self, job_id: int):
+        if self._stopping:
+            # Aborted by shutdown(), not by the user: leave it 'running' so start() resumes it
+            print(f"Job {job_id} interrupted by shutdown")
+            return
+        self._update(job_id, status="cancelled", finished_at=datetime.now())
+
+    def _with_secrets(self, payload: Dict[str, Any], secrets: Dict[str, Any]) -> Dict[str, Any]:
+        """Re-attach the in-memory secrets; a job resumed after a restart has lost them"""
+        dropped = payload.pop("secrets_dropped", [])
+        payload.update(secrets)
+        if "api_key" in dropped and not payload.get("api_key"):
+            if not provider_router.enabled:
+                raise ValueError("任务的 API Key 不会持久化，服务重启后无法继续；请重新提交任务（或配置 QAI_LLM_PROVIDERS 供应商池）")
+            print("Job API key was lost on restart; routing its calls through the provider pool")
+            payload["base_url"] = ROUTE_AUTO
+        return payload
+
+    def _is_cancel_requested(self, job_id: int) -> bool:
+        with self._lock:
+            token = self._cancel_tokens.get(job_id)
+        return bool(token and token.cancelled)
+
+    def _update(self, job_id: int, **fields):
+        with Session(engine) as session:
+            job = session.get(Job, job_id)
+            if not job:
+                return
+            for key, value in fields.items():
+                setattr(job, key, value)
+            session.add(job)
+            session.commit()
+
+
+# --- Job handlers ---
+
+def _load_requirement_content(requirement_id: int) -> str:
+    with Session(engine) as session:
+        requirement = session.get(Requirement, requirement_id)
+        if not requirement:
+            raise ValueError(f"Requirement {requirement_id} not found")
+        return requirement.content
+
+
+def run_generate_cases_job(ctx: JobContext, payload: Dict[str, Any]) -> Any:
+    """One-shot generation for a requirement; cases are saved in one transaction at the end"""
+    requirement_id = payload["requirement_id"]
+    content = _load_requirement_content(requirement_id)
+    ctx.progress(0.05, "正在生成用例")
+    cases = []
+    for case in llm_service.stream_test_cases(
+        requirement_content=content,
+        api_key=payload.get("api_key"),
+        base_url=payload.get("base_url"),
+        model=payload.get("model") or "deepseek-chat",
+        use_cache=payload.get("use_cache"),
+        **ctx.retrieval
+    ):
+        ctx.check_cancelled()
+        if case.get("title") and case.get("steps"):
+            cases.append(case)
+            ctx.progress(message=f"已生成 {len(cases)} 条用例")
+    ctx.check_cancelled()
+    ctx.progress(0.95, "正在保存")
+    return pipeline_service.persist_cases(requirement_id, cases) if cases else []
+
+
+def run_pipeline_job(ctx: JobContext, payload: Dict[str, Any]) -> Any:
+    """Full modules -> scenarios -> cases pipeline; persisted once every branch is done"""
+    requirement_id = payload.get("requirement_id")
+    content = payload.get("requirement_content") or _load_requirement_content(requirement_id)
+
+    last = [0.0]
+
+    def on_progress(stats: Dict[str, Any]):
+        # No cancel check here: cancel() trips the job's token, which aborts every branch's LLM call
+        # The plan grows as stages finish; keep the bar monotonic and leave room for later stages
+        planned = stats["llm_calls_planned"] + (2 if stats["llm_calls_done"] <= 1 else 0)
+        last[0] = max(last[0], 0.95 * stats["llm_calls_done"] / max(planned, 1))
+        ctx.progress(last[0], f"LLM 调用 {stats['llm_calls_done']}/{stats['llm_calls_planned']}")
+
+    result = asyncio.run(pipeline_service.run(
+        requirement_id, content, payload.get("api_key"), payload.get("base_url"),
+        payload.get("model") or "deepseek-chat",
+        modules=payload.get("modules"),
+        max_concurrency=payload.get("max_concurrency"),
+        persist=False,
+        use_cache=payload.get("use_cache"),
+        on_progress=on_progress,
+        **ctx.retrieval
+    ))
+    ctx.check_cancelled()
+    if requirement_id and payload.get("persist", True):
+        scenarios = [s for module in result["modules"] for s in module["scenarios"] if s["cases"]]
+        # One transaction for the whole run: a job re-queued after a crash must not find half of it saved
+        saved = pipeline_service.persist_cases(requirement_id, [c for s in scenarios for c in s["cases"]]) if scenarios else []
+        for scenario in scenarios:
+            scenario["cases"], saved = saved[:len(scenario["cases"])], saved[len(scenario["cases"]):]
+        if result["stats"]["cases"]:
+            kb_sync.schedule(requirement_id)
+    return result
+
+
+def run_reindex_job(ctx: JobContext, payload: Dict[str, Any]) -> Any:
+    """Full KB rebuild; progress is checkpointed, so a re-queued job resumes instead of starting over"""
+    def on_progress(state: Dict[str, Any]):
+        ctx.check_cancelled()
+        ctx.progress(0.9 * state["indexed"] / max(state["total"], 1), f"已索引 {state['indexed']}/{state['total']} 条需求")
+
+    return reindexer.run(fresh=payload.get("fresh", False), restart=payload.get("restart", False), on_progress=on_progress)
+
+
+job_service = JobService()
+job_service.register("generate_cases", run_generate_cases_job)
+job_service.register("pipeline", run_pipeline_job)
+job_service.register("reindex", run_reindex_job)
@@ -0,0 +1,371 @@
+import ast
+import json
+import re
+from typing import Any, List, Optional
+
+# Characters that may follow an opening bracket in real JSON; used to skip
+# brackets that appear in leading prose such as "[注意] 以下是结果".
+_ARRAY_NEXT = set("{[\"'-0123456789tfnTFN]/")
+_OBJECT_NEXT = set("\"'}/")
+_CLOSERS = {"{": "}", "[": "]"}
+_ROOT_START = re.compile(r"[\[{]")
+_DQ_SPECIAL = re.compile(r'["\\]')
+_SQ_SPECIAL = re.compile(r"['\"\\]")
+# Keys of a test case / module answer: an object carrying them is an item, never a wrapper
+_ITEM_KEYS = ("title", "steps", "expected_result", "scenarios")
+_FIRST_KEY = re.compile(r'^\{\s*"([^"]*)"\s*:\s*$')
+_FENCE = re.compile(r"^```[A-Za-z]*\s*\n([\s\S]*?)\n?\s*```$")
+
+
+def _wrapped_items(value: dict) -> Optional[List[Any]]:
+    """
+    The wrapped array of {"total": 3, "cases": [{...}]} or {"modules": ["登录", ...]};
+    None if the object is an item itself (has case keys, several lists, or a mixed list)
+    """
+    if any(k in value for k in _ITEM_KEYS):
+        return None
+    lists = [v for v in value.values() if isinstance(v, list)]
+    if len(lists) != 1:
+        return None
+    items = lists[0]
+    if all(isinstance(v, dict) for v in items) or not any(isinstance(v, (dict, list)) for v in items):
+        return items
+    return None
+
+
+class JsonArrayStreamParser:
+    """
+    Single-pass, tolerant extractor for the JSON arrays LLMs return.
+
+    Feed chunks as they arrive; each top-level array element is returned as soon
+    as it is complete. While scanning it:
+    - skips leading prose and code fences, and ignores anything after the array
+    - drops // and /* */ comments outside strings (URLs inside strings survive)
+    - removes trailing commas and accepts 'single-quoted' strings
+    - unwraps {"cases": [{...}]} / {"modules": [...]} style wrappers; any other object (a single case) is one element
+    - on close(), repairs a truncated final element by keeping its complete members
+    Malformed elements are skipped on their own; every other element is still recovered.
+    """
+
+    def __init__(self):
+        self._pending = ""         # unscanned tail kept for one char of lookahead
+        self._state = "seek"       # seek -> scan -> done
+        self._stack: List[str] = []
+        self._elem_depth = 1       # stack depth at which elements live
+        self._root_commas = 0      # commas seen directly inside an object root
+        self._out: List[str] = []  # cleaned text of the current element
+        self._active = False       # inside an element
+        self._scalar = False       # current element is a bare number/literal/string
+        self._safe = 0             # len(_out) after the last complete member of the element
+        self._unwrap_undo = None   # (_out, _safe) of the wrapper while its first array element is unseen
+        self._in_str = False
+        self._quote = '"'
+        self._escape = False
+        self._comment: Optional[str] = None
+        self._star = False
+        self.recovered = 0
+        self.dropped = 0
+        self.repaired = 0
+
+    def feed(self, chunk: str) -> List[Any]:
+        if not chunk or self._state == "done":
+            return []
+        buf = self._pending + chunk
+        self._pending = ""
+        items: List[Any] = []
+        i, n = 0, len(buf)
+        while i < n and self._state != "done":
+            ch = buf[i]
+
+            if self._state == "seek":
+                m = _ROOT_START.search(buf, i)
+                if not m:
+                    break
+                i = m.start()
+                j = i + 1
+                while j < n and buf[j].isspace():
+                    j += 1
+                if j >= n:
+                    # Need the next significant char to decide; wait for more input
+                    self._pending = buf[i:]
+                    return items
+                if buf[j] in (_ARRAY_NEXT if buf[i] == "[" else _OBJECT_NEXT):
+                    self._start_root(buf[i])
+                i += 1
+                continue
+
+            if self._comment == "line":
+                if ch == "\n":
+                    self._comment = None
+                i += 1
+                continue
+            if self._comment == "block":
+                if self._star and ch == "/":
+                    self._comment = None
+                self._star = ch == "*"
+                i += 1
+                continue
+
+            if self._in_str:
+                if not self._escape:
+                    # Copy the plain run up to the next quote/backslash in one slice
+                    m = (_DQ_SPECIAL if self._quote == '"' else _SQ_SPECIAL).search(buf, i)
+                    j = m.start() if m else n
+                    if j > i:
+                        self._out.append(buf[i:j])
+                        i = j
+                        continue
+                self._string_char(ch, items)
+                i += 1
+                continue
+
+            if ch == "/":
+                if i + 1 >= n:
+                    self._pending = buf[i:]
+                    return items
+                nxt = buf[i + 1]
+                if nxt in "/*":
+                    self._comment = "line" if nxt == "/" else "block"
+                    self._star = False
+                    i += 2
+                    continue
+            self._structural_char(ch, items)
+            i += 1
+        return items
+
+    def close(self) -> List[Any]:
+        """End of input: flush a trailing scalar and repair a truncated element."""
+        items: List[Any] = []
+        if self._state == "scan" and self._active:
+            if self._scalar:
+                if not self._in_str:
+                    self._emit(items)
+                else:
+                    self.dropped += 1
+            else:
+                self._repair(items)
+        self._state = "done"
+        return items
+
+    # --- internals ---
+
+    def _start_root(self, ch: str):
+        self._state = "scan"
+        self._stack = [ch]
+        if ch == "[":
+            self._elem_depth = 1
+        else:
+            # Object root: the object itself is the element unless it wraps an array
+            self._elem_depth = 0
+            self._begin_element(ch, scalar=False)
+
+    def _begin_element(self, first: str, scalar: bool):
+        self._active = True
+        self._scalar = scalar
+        self._out = [first]
+        self._safe = 1
+
+    def _string_char(self, ch: str, items: List[Any]):
+        if self._escape:
+            self._escape = False
+            if self._quote == "'" and ch == "'":
+                self._out.append("'")
+            else:
+                self._out.append("\\" + ch)
+            return
+        if ch == "\\":
+            self._escape = True
+            return
+        if ch == self._quote:
+            self._in_str = False
+            self._out.append('"')
+            if self._scalar and len(self._stack) == self._elem_depth:
+                self._emit(items)
+            return
+        if ch == '"':
+            # Inside a single-quoted string
+            self._out.append('\\"')
+            return
+        self._out.append(ch)
+
+    def _structural_char(self, ch: str, items: List[Any]):
+        depth = len(self._stack)
+        if ch.isspace():
+            return
+
+        if ch in "\"'":
+            if depth == self._elem_depth and not self._active and not self._undo_unwrap():
+                self._begin_element('"', scalar=True)
+            else:
+                self._out.append('"')
+            self._in_str = True
+            self._quote = ch
+            self._escape = False
+            return
+
+        if ch in "{[":
+            if (self._elem_depth == 0 and depth == 1 and ch == "[" and self._root_commas == 0
+                    and self._wrapper_key()):
+                # {"cases": [...]}: stream the wrapped array instead of the wrapper
+                self._unwrap_undo = (self._out + [ch], self._safe)
+                self._elem_depth = 2
+                self._active = False
+                self._out = []
+                self._stack.append(ch)
+                return
+            if depth == self._elem_depth and not self._active:
+                if ch == "{":
+                    self._unwrap_undo = None
+                    self._begin_element(ch, scalar=False)
+                elif self._undo_unwrap():
+                    self._out.append(ch)
+                else:
+                    self._begin_element(ch, scalar=False)
+            elif self._active:
+                self._out.append(ch)
+            self._stack.append(ch)
+            return
+
+        if ch in "}]":
+            if depth == self._elem_depth and self._active and self._scalar:
+                self._emit(items)
+            self._strip_trailing_comma()
+            self._stack.pop()
+            depth -= 1
+            if self._active:
+                self._out.append(ch)
+            if depth < self._elem_depth:
+                if self._active and self._elem_depth == 0:
+                    self._emit(items)
+                self._state = "done"
+            elif depth == self._elem_depth and self._active:
+                self._emit(items)
+            return
+
+        if ch == ",":
+            if depth == self._elem_depth:
+                if self._active and self._scalar:
+                    self._emit(items)
+                return
+            if depth == 1 and self._elem_depth == 0:
+                self._root_commas += 1
+            if self._active:
+                if depth == self._elem_depth + 1:
+                    self._safe = len(self._out)
+                self._out.append(ch)
+            return
+
+        # Literal / number / colon
+        if depth == self._elem_depth and not self._active and not self._undo_unwrap():
+            self._begin_element(ch, scalar=True)
+        elif self._active:
+            self._out.append(ch)
+
+    def _wrapper_key(self) -> bool:
+        """The root object's first member is opening an array: is its key a wrapper key like "cases"?"""
+        m = _FIRST_KEY.match("".join(self._out))
+        return bool(m) and m.group(1) not in _ITEM_KEYS
+
+    def _undo_unwrap(self) -> bool:
+        """
+        The wrapped array holds scalars or arrays, not objects: go back to treating the root
+        object as the item. _emit() still unwraps a scalar list once the whole object is known.
+        """
+        if self._unwrap_undo is None:
+            return False
+        self._out, self._safe = self._unwrap_undo
+        self._unwrap_undo = None
+        self._elem_depth = 0
+        self._active = True
+        self._scalar = False
+        return True
+
+    def _strip_trailing_comma(self):
+        if self._out and self._out[-1] == ",":
+            self._out.pop()
+
+    def _emit(self, items: List[Any], text: Optional[str] = None):
+        if text is None:
+            text = "".join(self._out)
+        self._active = False
+        self._scalar = False
+        self._out = []
+        value = _loads(text)
+        if value is _FAILED:
+            self.dropped += 1
+            print(f"Skip malformed JSON element: {text[:200]}")
+            return
+        if self._elem_depth == 0 and isinstance(value, dict):
+            # Unwrap {"total": 3, "cases": [...]}; a single case or module is kept whole
+            wrapped = _wrapped_items(value)
+            if wrapped is not None:
+                self.recovered += len(wrapped)
+                items.extend(wrapped)
+                return
+        self.recovered += 1
+        items.append(value)
+
+    def _repair(self, items: List[Any]):
+        open_containers = self._stack[self._elem_depth:]
+        closers = "".join(_CLOSERS[c] for c in reversed(open_containers))
+        text = "".join(self._out).rstrip(",")
+        # 1. The stream stopped between members: just close what is open
+        if not self._in_str and not text.endswith(":"):
+            value = _loads(text + closers)
+            if value is not _FAILED:
+                self.repaired += 1
+                self._emit(items, json.dumps(value, ensure_ascii=False))
+                return
+        # 2. Roll back to the last complete member of the element
+        cut = "".join(self._out[:self._safe]).rstrip(",")
+        value = _loads(cut + _CLOSERS[open_containers[0]])
+        if value is _FAILED or not value:
+            self.dropped += 1
+            return
+        self.repaired += 1
+        self._emit(items, json.dumps(value, ensure_ascii=False))
+
+
+_FAILED = object()
+
+
+def _loads(text: str) -> Any:
+    try:
+        return json.loads(text, strict=False)
+    except ValueError:
+        pass
+    try:
+        # Python-style literals (True/None) occasionally show up
+        return ast.literal_eval(text)
+    except (ValueError, SyntaxError, MemoryError, RecursionError):
+        return _FAILED
+
+
+def _parse_clean(content: str) -> Optional[List[Any]]:
+    """json.loads fast path for well-formed answers (optionally fenced); None if it needs the scanner"""
+    text = content.strip()
+    m = _FENCE.match(text)
+    if m:
+        text = m.group(1).strip()
+    if not text.startswith(("[", "{")):
+        return None
+    try:
+        value = json.loads(text, strict=False)
+    except ValueError:
+        return None
+    if isinstance(value, list):
+        return value
+    wrapped = _wrapped_items(value)
+    return wrapped if wrapped is not None else [value]
+
+
+def parse_json_items(content: str) -> List[Any]:
+    """Parse a complete LLM answer into the list of array elements it contains."""
+    items = _parse_clean(content or "")
+    if items is not None:
+        return items
+    # Prose, comments, trailing commas, truncation...: the tolerant scanner
+    parser = JsonArrayStreamParser()
+    items = parser.feed(content or "")
+    items.extend(parser.close())
+    return items
@@ -0,0 +1,259 @@
+import os
+import re
+import threading
+import time
+from collections import Counter
+from typing import Any, Dict, Iterable, List, Optional
+from sqlmodel import Session, select
+from app.core.database import engine
+from app.core.vector_store import vector_store
+from app.models.models import ProjectVersion, Requirement, TestCase
+
+# Quiet period after the last edit of a requirement before it is resynced
+DEBOUNCE_SECONDS = float(os.getenv("QAI_KB_SYNC_DEBOUNCE", "1.0"))
+# Upper bound on how long a continuously edited requirement can stay stale
+MAX_DELAY_SECONDS = float(os.getenv("QAI_KB_SYNC_MAX_DELAY", "5.0"))
+
+
+# KB document ids: "{id}"; older manual sync_kb calls wrote a duplicate "req_{id}"
+_DOC_ID = re.compile(r"^(?:req_)?(\d+)$")
+
+
+def kb_doc_id(requirement_id: int) -> str:
+    """Canonical KB document id of a requirement"""
+    return str(requirement_id)
+
+
+def requirement_id_of(doc_id: str) -> Optional[int]:
+    """Requirement a KB document belongs to (canonical or legacy id), None for foreign ids"""
+    match = _DOC_ID.match(doc_id)
+    return int(match.group(1)) if match else None
+
+
+def kb_metadata(session: Session, reqs: List[Requirement], modules_by_req: Dict[int, List[str]]) -> Dict[int, Dict[str, Any]]:
+    """
+    Reference metadata for each requirement's KB document: its id, case count and
+    project/version/module scope (module = most common case module). The cases
+    themselves stay in SQLite and are loaded when a prompt needs them. None values
+    make Chroma drop the key, which also clears the cases_json copies of older syncs.
+    """
+    version_ids = {r.version_id for r in reqs if r.version_id}
+    projects = {}
+    if version_ids:
+        rows = session.exec(select(ProjectVersion.id, ProjectVersion.project_id).where(ProjectVersion.id.in_(version_ids))).all()
+        projects = dict(rows)
+    metadata = {}
+    for r in reqs:
+        modules = [m for m in modules_by_req.get(r.id, []) if m]
+        metadata[r.id] = {
+            "requirement_id": r.id,
+            "title": r.title,
+            "source": "qai_db",
+            "case_count": len(modules_by_req.get(r.id, [])),
+            "project_id": projects.get(r.version_id),
+            "version_id": r.version_id,
+            "module": Counter(modules).most_common(1)[0][0] if modules else None,
+            "cases_json": None,
+        }
+    return metadata
+
+
+def case_modules(session: Session, requirement_ids: Iterable[int]) -> Dict[int, List[str]]:
+    """Module of every case, per requirement (one row per case)"""
+    modules: Dict[int, List[str]] = {rid: [] for rid in requirement_ids}
+    rows = session.exec(
+        select(TestCase.requirement_id, TestCase.module).where(TestCase.requirement_id.in_(list(modules)))
+    ).all()
+    for rid, module in rows:
+        modules[rid].append(module)
+    return modules
+
+
+def sync_req_to_kb(session: Session, requirement_id: int):
+    """Helper to sync requirement and its cases to Vector DB"""
+    sync_reqs_to_kb(session, [requirement_id])
+
+
+def sync_reqs_to_kb(session: Session, requirement_ids: Iterable[int]) -> int:
+    """Sync many requirements at once: two queries and batched embedding instead of one pass each"""
+    ids = sorted({rid for rid in requirement_ids if rid})
+    if not ids:
+        return 0
+    # Noted before writing: a fresh reindex re-syncs these into its new collection after the swap
+    kb_sync.note_written(ids)
+    try:
+        reqs = session.exec(select(Requirement).where(Requirement.id.in_(ids))).all()
+        metadata = kb_metadata(session, reqs, case_modules(session, ids))
+        return vector_store.add_documents([
+            {"id": kb_doc_id(req.id), "text": req.content, "metadata": metadata[req.id]}
+            for req in reqs
+        ])
+    except Exception as e:
+        print(f"Sync to KB failed: {e}")
+        return 0
+
+
+def backfill_kb_metadata(session: Session, page_size: int = 500) -> Dict[str, int]:
+    """
+    Bring KB documents written by older syncs up to date: add the reference and
+    scope fields and drop their embedded cases_json. Metadata-only, no re-embedding.
+    """
+    scanned, updated, offset = 0, 0, 0
+    while True:
+        page = vector_store.collection.get(limit=page_size, offset=offset, include=["metadatas"])
+        if not page["ids"]:
+            break
+        offset += len(page["ids"])
+        scanned += len(page["ids"])
+        targets = {}
+        for doc_id, meta in zip(page["ids"], page["metadatas"]):
+            meta = meta or {}
+            rid = requirement_id_of(doc_id)
+            if rid is not None and ("cases_json" in meta or "requirement_id" not in meta):
+                targets[doc_id] = rid
+        if not targets:
+            continue
+        req_ids = set(targets.values())
+        reqs = session.exec(select(Requirement).where(Requirement.id.in_(req_ids))).all()
+        metadata = kb_metadata(session, reqs, case_modules(session, req_ids))
+        ids = [doc_id for doc_id, rid in targets.items() if rid in metadata]
+        if ids:
+            # Chroma merges updated keys into the existing metadata
+            vector_store.update_metadata(ids, [metadata[targets[doc_id]] for doc_id in ids])
+            updated += len(ids)
+    return {"scanned": scanned, "updated": updated}
+
+
+class KBSyncService:
+    """
+    Debounced background resync of requirements to the vector store.
+    Edits call schedule(); a requirement is synced once it has been quiet for
+    DEBOUNCE_SECONDS (or MAX_DELAY_SECONDS after its first pending edit), and
+    everything due at the same time goes out in one bulk sync. Syncs are
+    serialised, so flush() never races an older snapshot of the same requirement.
+    """
+
+    def __init__(self, debounce: float = DEBOUNCE_SECONDS, max_delay: float = MAX_DELAY_SECONDS):
+        self.debounce = debounce
+        self.max_delay = max_delay
+        # requirement_id -> [first pending edit, last edit] (monotonic)
+        self._pending: Dict[int, List[float]] = {}
+        self._cond = threading.Condition()
+        self._sync_lock = threading.Lock()
+        self._thread: Optional[threading.Thread] = None
+        self._stopping = False
+        # Requirement ids written to the live collection while a fresh reindex builds its replacement
+        self._tracked: Optional[set] = None
+        self.counters = {"scheduled": 0, "coalesced": 0, "synced": 0, "batches": 0, "flushes": 0}
+        self.lag_ms = {"last": 0.0, "max": 0.0, "total": 0.0}
+
+    def schedule(self, requirement_id: Optional[int]):
+        if not requirement_id:
+            return
+        now = time.monotonic()
+        with self._cond:
+            self.counters["scheduled"] += 1
+            entry = self._pending.get(requirement_id)
+            if entry is None:
+                self._pending[requirement_id] = [now, now]
+            else:
+                entry[1] = now
+                self.counters["coalesced"] += 1
+            self._ensure_started()
+            self._cond.notify()
+
+    def flush(self) -> int:
+        """Sync everything pending now, in the caller's thread"""
+        with self._cond:
+            pending, self._pending = self._pending, {}
+            self.counters["flushes"] += 1
+        self._sync(pending)
+        return len(pending)
+
+    def track_writes(self, initial: Iterable[int] = ()):
+        """Start recording which requirements are written to (or removed from) the live collection"""
+        with self._cond:
+            self._tracked = set(initial)
+
+    def note_written(self, requirement_ids: Iterable[int]):
+        with self._cond:
+            if self._tracked is not None:
+                self._tracked.update(rid for rid in requirement_ids if rid)
+
+    def tracked_writes(self) -> List[int]:
+        with self._cond:
+            return sorted(self._tracked or ())
+
+    def stop_tracking(self) -> List[int]:
+        """Stop recording; returns the requirement ids written since track_writes()"""
+        with self._cond:
+            tracked, self._tracked = self._tracked or set(), None
+        return sorted(tracked)
+
+    def _ensure_started(self):
+        if self._thread is None:
+            self._stopping = False
+            self._thread = threading.Thread(target=self._run, name="qai-kb-sync", daemon=True)
+            self._thread.start()
+
+    def _due_at(self, entry: List[float]) -> float:
+        return min(entry[1] + self.debounce, entry[0] + self.max_delay)
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while not self._stopping:
+                    now = time.monotonic()
+                    due = {rid: e for rid, e in self._pending.items() if self._due_at(e) <= now}
+                    if due:
+                        for rid in due:
+                            del self._pending[rid]
+                        break
+                    next_due = min((self._due_at(e) for e in self._pending.values()), default=None)
+                    self._cond.wait(None if next_due is None else next_due - now)
+                if self._stopping:
+                    return
+            self._sync(due)
+
+    def _sync(self, pending: Dict[int, List[float]]):
+        if not pending:
+            return
+        with self._sync_lock:
+            with Session(engine) as session:
+                sync_reqs_to_kb(session, pending.keys())
+            done = time.monotonic()
+        with self._cond:
+            self.counters["synced"] += len(pending)
+            self.counters["batches"] += 1
+            for first, _ in pending.values():
+                lag = (done - first) * 1000
+                self.lag_ms["last"] = lag
+                self.lag_ms["max"] = max(self.lag_ms["max"], lag)
+                self.lag_ms["total"] += lag
+
+    def shutdown(self):
+        """Stop the worker and sync what is still pending"""
+        with self._cond:
+            thread, self._thread = self._thread, None
+            self._stopping = True
+            self._cond.notify_all()
+        if thread is not None:
+            thread.join(timeout=10)
+        self.flush()
+
+    def stats(self) -> Dict[str, Any]:
+        now = time.monotonic()
+        with self._cond:
+            oldest = min((e[0] for e in self._pending.values()), default=None)
+            synced = self.counters["synced"]
+            return {
+                **self.counters,
+                "pending": len(self._pending),
+                "oldest_pending_ms": round((now - oldest) * 1000, 1) if oldest is not None else 0.0,
+                "lag_ms_last": round(self.lag_ms["last"], 1),
+                "lag_ms_max": round(self.lag_ms["max"], 1),
+                "lag_ms_avg": round(self.lag_ms["total"] / synced, 1) if synced else 0.0,
+            }
+
+
+kb_sync = KBSyncService()
@@ -1,117 +1,195 @@
-from typing import List, Dict, Any, Optional
+from typing import List, Dict, Any, Optional, Iterator, Tuple, Callable
+import hashlib
 import json
+import os
 import re
-from langchain_openai import ChatOpenAI
+import threading
+import time
+from contextlib import closing
+from app.core.cancellation import RequestCancelled, cancellation
+from app.core.llm_clients import llm_client_pool
+from app.core.llm_cache import llm_cache
+from app.core.llm_limiter import rate_limiter
+from app.core.llm_router import provider_router, ROUTE_AUTO, ROUTED_ATTEMPTS, ProviderConfig
+from app.core.singleflight import SingleFlight
+from app.core.llm_usage import extract_usage, usage_meter
+from app.core.llm_ledger import llm_ledger
+from app.core.llm_limiter import LLMCallError
 from app.core.vector_store import vector_store
+from app.services.json_stream import JsonArrayStreamParser, parse_json_items
+from app.services.prompt_builder import PromptBuilder, token_counter
 from sqlmodel import Session, select
+from sqlalchemy import func
 from app.core.database import engine
-from app.models.models import KnowledgeItem
+from app.models.models import KnowledgeItem, TestCase
+
+# Per-document token caps for retrieved history (one-shot vs. per-scenario prompts)
+HISTORY_DOC_TOKENS = int(os.getenv("QAI_PROMPT_HISTORY_DOC_TOKENS", "1200"))
+RAG_DOC_TOKENS = int(os.getenv("QAI_PROMPT_RAG_DOC_TOKENS", "400"))
+# Cases loaded per retrieved requirement; the per-document token cap usually stops earlier
+HISTORY_MAX_CASES = int(os.getenv("QAI_PROMPT_HISTORY_MAX_CASES", "20"))
+# Script batching: cases per prompt and input-token cap per prompt
+SCRIPT_BATCH_SIZE = int(os.getenv("QAI_SCRIPT_BATCH_SIZE", "8"))
+SCRIPT_BATCH_TOKENS = int(os.getenv("QAI_SCRIPT_BATCH_TOKENS", "3000"))
+# History retrieved for generation prompts: project (default) | version | global.
+# Scoped by the project/version the call is attributed to; global when unknown.
+RETRIEVAL_SCOPE = os.getenv("QAI_RETRIEVAL_SCOPE", "project")
+# Completion tokens reserved against a provider's TPM budget before the real usage is known
+EXPECTED_OUTPUT_TOKENS = int(os.getenv("QAI_LLM_EXPECTED_OUTPUT_TOKENS", "1000"))
+
+
+def _load_cases(cases_json: Optional[str]) -> List[Dict[str, Any]]:
+    try:
+        cases = json.loads(cases_json or "[]")
+    except ValueError:
+        return []
+    return [c for c in cases if isinstance(c, dict)] if isinstance(cases, list) else []
+
+
+class _RoutedLLM:
+    """Stands in for a client when calls are routed across the provider pool"""
+    model_name = ROUTE_AUTO
+    openai_api_base = ROUTE_AUTO
+    openai_api_key = None
+    temperature = 0.7
+
+
+_ROUTED = _RoutedLLM()
+
+
+def _key_fingerprint(llm) -> str:
+    secret = getattr(llm, "openai_api_key", None)
+    value = secret.get_secret_value() if secret is not None else ""
+    return hashlib.sha256(value.encode()).hexdigest()[:16]
+
 
 class LLMService:
     def __init__(self):
-        pass
+        # Knowledge rules cache: (generation, rendered block)
+        self._rules_generation = 0
+        self._rules_cache: Optional[Tuple[int, str]] = None
+        self._rules_lock = threading.Lock()
+        self._rules_hits = 0
+        self._rules_misses = 0
+        # Identical blocking calls already in flight are shared, not repeated
+        self.flights = SingleFlight("llm")
 
     def _get_llm(self, api_key: str, base_url: str, model: str):
+        if provider_router.wants_routing(api_key, base_url):
+            # Each call then goes to the fastest healthy provider in the pool
+            return _ROUTED
+        if base_url == ROUTE_AUTO:
+            raise LLMCallError("base_url=auto 需要先配置模型服务池 (QAI_LLM_PROVIDERS)", status_code=400, kind="fatal")
         if not api_key and base_url: # Allow custom proxies without key if they support it
              pass 
         elif not api_key:
             return None
             
-        return ChatOpenAI(
-            model=model,
-            openai_api_key=api_key if api_key else "sk-placeholder", # Some local LLMs need non-empty key
-            openai_api_base=base_url,
-            temperature=0.7
-        )
+        # Reuse a pooled client so keep-alive connections survive across calls
+        return llm_client_pool.get(api_key, base_url, model)
 
-    def _parse_json_response(self, content: str) -> Any:
-        try:
-            # 1. Try to find JSON in markdown code blocks
-            match = re.search(r'```(?:json)?\s*([\s\S]*?)\s*```', content)
-            if match:
-                content = match.group(1)
-            else:
-                # 2. Try to find the first '[' or '{' and last ']' or '}'
-                # This handles cases where models output "Sure, here is the JSON: [...]" without markdown
-                content = content.strip()
-                start_bracket = content.find('[')
-                start_brace = content.find('{')
-                
-                start_index = -1
-                end_index = -1
-                
-                # Determine if we are looking for array or object
-                if start_bracket != -1 and (start_brace == -1 or start_bracket < start_brace):
-                    start_index = start_bracket
-                    end_index = content.rfind(']') + 1
-                elif start_brace != -1:
-                    start_index = start_brace
-                    end_index = content.rfind('}') + 1
-                    
-                if start_index != -1 and end_index != -1:
-                    content = content[start_index:end_index]
-
-            # 3. Clean up potential comments or trailing commas (simple approach)
-            # Remove "// ..." comments
-            content = re.sub(r'//.*', '', content)
-            
-            return json.loads(content)
-        except json.JSONDecodeError as e:
-            print(f"JSON Decode Error: {e}, raw content: {content}")
-            # Try a very aggressive fallback: maybe it's valid python dict string?
-            try:
-                import ast
-                return ast.literal_eval(content)
-            except:
-                pass
-            return []
+    def _parse_json_response(self, content: str) -> List[Any]:
+        """Recover every complete JSON element from a (possibly malformed) completion"""
+        items = parse_json_items(content)
+        if not items and content and content.strip():
+            print(f"JSON parse recovered nothing, raw content: {content[:500]}")
+        return items
+
+    def invalidate_knowledge_rules(self):
+        """Call after any write that can change the rules block (KB create/delete/sync)"""
+        with self._rules_lock:
+            self._rules_generation += 1
+
+    def rules_cache_stats(self) -> Dict[str, Any]:
+        with self._rules_lock:
+            cached = self._rules_cache
+            return {
+                "generation": self._rules_generation,
+                "cached": bool(cached and cached[0] == self._rules_generation),
+                "hits": self._rules_hits,
+                "misses": self._rules_misses,
+            }
 
     def _get_knowledge_rules(self) -> str:
-        """Fetch explicit rules from SQL Knowledge Base"""
+        """Rendered rules block, cached until the knowledge base generation changes"""
+        with self._rules_lock:
+            generation = self._rules_generation
+            cached = self._rules_cache
+            if cached and cached[0] == generation:
+                self._rules_hits += 1
+                return cached[1]
+            self._rules_misses += 1
+        # Query outside the lock; the generation check below guards the store
         try:
-            with Session(engine) as session:
-                # Get items from specific categories
-                rules = session.exec(select(KnowledgeItem).where(
-                    KnowledgeItem.category.in_(["业务规则", "历史踩坑", "风险场景"])
-                ).limit(10)).all()
-                
-                if not rules:
-                    return ""
-                
-                content = "【重要：请严格遵守以下团队知识库规则】\n"
-                for r in rules:
-                    content += f"- [{r.category}] {r.content}\n"
-                return content + "\n"
+            content = self._load_knowledge_rules()
         except Exception as e:
             print(f"Fetch knowledge rules failed: {e}")
             return ""
+        with self._rules_lock:
+            # A write may have landed while we were querying; don't cache stale rules
+            if self._rules_generation == generation:
+                self._rules_cache = (generation, content)
+        return content
+
+    def _load_knowledge_rules(self) -> str:
+        """Fetch explicit rules from SQL Knowledge Base"""
+        with Session(engine) as session:
+            # Get items from specific categories
+            rules = session.exec(select(KnowledgeItem).where(
+                KnowledgeItem.category.in_(["业务规则", "历史踩坑", "风险场景"])
+            ).limit(10)).all()
+            
+            if not rules:
+                return ""
+            
+            content = "【重要：请严格遵守以下团队知识库规则】\n"
+            for r in rules:
+                content += f"- [{r.category}] {r.content}\n"
+            return content + "\n"
 
     def generate_test_cases(
         self, 
         requirement_content: str, 
         api_key: Optional[str] = None, 
         base_url: Optional[str] = None, 
-        model: str = "deepseek-chat"
+        model: str = "deepseek-chat",
+        use_cache: Optional[bool] = None,
+        project_id: Optional[int] = None,
+        version_id: Optional[int] = None
     ) -> List[Dict[str, Any]]:
-        """Legacy One-Shot Generation"""
+        """Legacy One-Shot Generation; project_id/version_id scope the knowledge-base retrieval"""
         llm = self._get_llm(api_key, base_url, model)
-        
-        # 1. Retrieve Historical Context (RAG)
-        similar_docs = vector_store.query_similar(requirement_content, n_results=3)
-        context_str = ""
-        if similar_docs:
-            context_str = "参考以下历史相似需求及其测试用例（Knowledge Base）：\n\n"
-            for doc in similar_docs:
-                context_str += f"--- 历史需求 ---\n{doc['content']}\n"
-                context_str += f"--- 关联用例 ---\n{doc['metadata'].get('cases_json', '无')}\n\n"
-        
-        # 2. Add Explicit Rules
-        rules_str = self._get_knowledge_rules()
-        
-        system_prompt = f"""你是一位资深测试工程师。请根据给定的[当前需求]，参考[历史知识库]和[团队规则]，编写详细的测试用例。
-        
-{rules_str}
-        
+        if not llm:
+            return self._mock_fallback(requirement_content)
+        messages, _ = self._build_case_messages(requirement_content, model, project_id, version_id)
+        return self._invoke(llm, messages, use_cache, parse=self._parse_json_response, stage="cases")
+
+    def stream_test_cases(
+        self, 
+        requirement_content: str, 
+        api_key: Optional[str] = None, 
+        base_url: Optional[str] = None, 
+        model: str = "deepseek-chat",
+        use_cache: Optional[bool] = None,
+        project_id: Optional[int] = None,
+        version_id: Optional[int] = None
+    ) -> Iterator[Dict[str, Any]]:
+        """Streaming One-Shot Generation: yield each case as soon as it is complete"""
+        llm = self._get_llm(api_key, base_url, model)
+        if not llm:
+            yield from self._mock_fallback(requirement_content)
+            return
+        yield from self._stream_json_items(
+            llm, lambda: self._build_case_messages(requirement_content, model, project_id, version_id)[0], use_cache, stage="cases"
+        )
+
+    def _build_case_messages(self, requirement_content: str, model: str, project_id: Optional[int] = None,
+                             version_id: Optional[int] = None) -> Tuple[List[Tuple[str, str]], Dict[str, Any]]:
+        # Layout: fixed instructions + rules (shared by every call), then requirement,
+        # then retrieved history; keeps the longest possible prefix cacheable by the provider
+        def render(rules_str: str, context_str: str, requirement: str) -> List[Tuple[str, str]]:
+            system_prompt = f"""你是一位资深测试工程师。请根据给定的[当前需求]，参考[历史知识库]和[团队规则]，编写详细的测试用例。
+
 输出必须是纯 JSON 数组格式，不要包含 Markdown 代码块标记，每个对象包含以下字段：
 - module: 模块名称
 - title: 用例标题
@@ -121,57 +199,52 @@ class LLMService:
 - expected_result: 预期结果
 
 请确保覆盖正常路径、异常路径和边界值。
-"""
-        user_prompt = f"""
-{context_str}
-
-=== 当前需求 ===
-{requirement_content}
+{rules_str}"""
+            user_prompt = f"""=== 当前需求 ===
+{requirement}
 
+{context_str}
 请生成测试用例：
 """
-        if llm:
-            try:
-                messages = [("system", system_prompt), ("human", user_prompt)]
-                response = llm.invoke(messages)
-                return self._parse_json_response(response.content)
-            except Exception as e:
-                print(f"LLM Call failed: {e}")
-                return self._mock_fallback(requirement_content)
-        else:
-            return self._mock_fallback(requirement_content)
+            return [("system", system_prompt), ("human", user_prompt)]
+
+        # Pack by priority: instructions > requirement > rules > historical context
+        builder = PromptBuilder(model)
+        builder.add("instructions", "".join(m[1] for m in render("", "", "")))
+        requirement = builder.fit("requirement", requirement_content, builder.budget // 2)
+        rules_str = self._pack_rules(builder, builder.budget // 5)
+
+        # 1. Retrieve Historical Context (RAG)
+        similar_docs = vector_store.query_similar(
+            requirement_content, n_results=3, where=self._retrieval_where(project_id, version_id)
+        )
+        context_str = self._pack_history(
+            builder, similar_docs, "参考以下历史相似需求及其测试用例（Knowledge Base）：\n\n", HISTORY_DOC_TOKENS
+        )
+        return render(rules_str, context_str, requirement), builder.report()
 
     # --- Sakura-Style 3-Stage Generation ---
 
-    def analyze_modules(self, requirement_content: str, api_key: str, base_url: str, model: str) -> List[str]:
+    def analyze_modules(self, requirement_content: str, api_key: str, base_url: str, model: str, use_cache: Optional[bool] = None) -> List[str]:
         """Step 1: Identify functional modules"""
         llm = self._get_llm(api_key, base_url, model)
         if not llm: return ["默认模块"]
 
         system_prompt = "你是一名产品经理。请分析需求文档，将其拆分为3-6个独立的功能模块。只输出JSON字符串数组，例如 [\"用户登录\", \"订单管理\"]。严禁输出任何解释性文字或Markdown格式之外的内容。"
         user_prompt = f"需求内容：\n{requirement_content}"
-        
-        try:
-            response = llm.invoke([("system", system_prompt), ("human", user_prompt)])
-            return self._parse_json_response(response.content)
-        except Exception as e:
-            print(f"Analyze modules failed: {e}")
-            return ["功能模块A", "功能模块B"]
+        messages = [("system", system_prompt), ("human", user_prompt)]
+        return self._invoke(llm, messages, use_cache, parse=self._parse_json_response, stage="modules")
 
-    def generate_scenarios(self, requirement_content: str, module: str, api_key: str, base_url: str, model: str) -> List[str]:
+    def generate_scenarios(self, requirement_content: str, module: str, api_key: str, base_url: str, model: str, use_cache: Optional[bool] = None) -> List[str]:
         """Step 2: Generate test scenarios for a module"""
         llm = self._get_llm(api_key, base_url, model)
         if not llm: return ["默认场景"]
 
-        system_prompt = f"你是一名测试架构师。针对模块【{module}】，识别2-8个关键测试场景（Test Scenarios/Purposes）。只输出JSON字符串数组，例如 [\"验证手机号登录\", \"验证密码错误提示\"]。严禁输出任何解释性文字。"
-        user_prompt = f"需求内容：\n{requirement_content}"
-
-        try:
-            response = llm.invoke([("system", system_prompt), ("human", user_prompt)])
-            return self._parse_json_response(response.content)
-        except Exception as e:
-            print(f"Generate scenarios failed: {e}")
-            return [f"{module}-场景1", f"{module}-场景2"]
+        # Module goes last so every module of one requirement shares the same prompt prefix
+        system_prompt = "你是一名测试架构师。针对用户指定的模块，识别2-8个关键测试场景（Test Scenarios/Purposes）。只输出JSON字符串数组，例如 [\"验证手机号登录\", \"验证密码错误提示\"]。严禁输出任何解释性文字。"
+        user_prompt = f"需求内容：\n{requirement_content}\n\n目标模块：【{module}】"
+        messages = [("system", system_prompt), ("human", user_prompt)]
+        return self._invoke(llm, messages, use_cache, parse=self._parse_json_response, stage="scenarios")
 
     def generate_test_cases_rag(
         self, 
@@ -180,49 +253,170 @@ class LLMService:
         scenario: str, 
         api_key: str, 
         base_url: str, 
-        model: str
+        model: str,
+        use_cache: Optional[bool] = None,
+        project_id: Optional[int] = None,
+        version_id: Optional[int] = None
     ) -> List[Dict[str, Any]]:
         """Step 3: Generate detailed cases for a scenario with RAG"""
         llm = self._get_llm(api_key, base_url, model)
         if not llm: return self._mock_fallback(requirement_content)[:1]
 
-        # RAG Retrieval focused on the scenario if possible, but we only have reqs indexed
-        similar_docs = vector_store.query_similar(f"{module} {scenario}", n_results=2)
-        context_str = ""
-        if similar_docs:
-            context_str = "参考历史经验（注意历史中的边界值和坑）：\n"
-            for doc in similar_docs:
-                context_str += f"- 历史需求: {doc['content'][:100]}...\n- 关联用例片段: {doc['metadata'].get('cases_json', '')[:200]}...\n"
-
-        # Add Explicit Rules
-        rules_str = self._get_knowledge_rules()
-
-        system_prompt = f"""你是一名高级测试工程师。针对模块【{module}】下的场景【{scenario}】，编写详细测试用例。
-{rules_str}
+        messages, _ = self._build_rag_case_messages(requirement_content, module, scenario, model, project_id, version_id)
+        return self._invoke(llm, messages, use_cache, parse=self._parse_json_response, stage="cases")
+
+    def stream_test_cases_rag(
+        self, 
+        requirement_content: str, 
+        module: str, 
+        scenario: str, 
+        api_key: str, 
+        base_url: str, 
+        model: str,
+        use_cache: Optional[bool] = None,
+        project_id: Optional[int] = None,
+        version_id: Optional[int] = None
+    ) -> Iterator[Dict[str, Any]]:
+        """Streaming Step 3: yield each case as soon as its JSON object is complete"""
+        llm = self._get_llm(api_key, base_url, model)
+        if not llm:
+            yield from self._mock_fallback(requirement_content)[:1]
+            return
+        yield from self._stream_json_items(
+            llm, lambda: self._build_rag_case_messages(requirement_content, module, scenario, model, project_id, version_id)[0],
+            use_cache, stage="cases"
+        )
+
+    def _build_rag_case_messages(self, requirement_content: str, module: str, scenario: str, model: str,
+                                 project_id: Optional[int] = None,
+                                 version_id: Optional[int] = None) -> Tuple[List[Tuple[str, str]], Dict[str, Any]]:
+        # Layout, most shared first: instructions + rules (every call), requirement
+        # (every scenario of a run), history (per scenario), then module/scenario
+        def render(rules_str: str, context_str: str, requirement: str) -> List[Tuple[str, str]]:
+            system_prompt = f"""你是一名高级测试工程师。针对用户指定模块下的指定场景，编写详细测试用例。
 必须输出纯 JSON 数组，严禁输出任何解释性文字。字段：
-- module: 固定为 "{module}"
+- module: 固定为用户指定的模块名称
 - title: 用例标题
 - priority: P0/P1/P2
 - precondition: 前置条件
 - steps: 详细步骤
 - expected_result: 预期结果
-"""
-        user_prompt = f"""
+{rules_str}"""
+            user_prompt = f"""=== 当前需求 ===
+{requirement}
+
 {context_str}
+=== 目标 ===
+模块：【{module}】
+场景：【{scenario}】
+请为模块【{module}】下的场景【{scenario}】生成 1-3 个具体的测试用例：
+"""
+            return [("system", system_prompt), ("human", user_prompt)]
 
-=== 当前需求 ===
-{requirement_content}
+        builder = PromptBuilder(model)
+        builder.add("instructions", "".join(m[1] for m in render("", "", "")))
+        requirement = builder.fit("requirement", requirement_content, builder.budget // 2)
+        rules_str = self._pack_rules(builder, builder.budget // 5)
 
-请为场景【{scenario}】生成 1-3 个具体的测试用例：
-"""
-        try:
-            response = llm.invoke([("system", system_prompt), ("human", user_prompt)])
-            return self._parse_json_response(response.content)
-        except Exception as e:
-            print(f"Generate cases RAG failed: {e}")
-            return self._mock_fallback(requirement_content)[:1]
+        # RAG Retrieval focused on the scenario if possible, but we only have reqs indexed
+        similar_docs = vector_store.query_similar(
+            f"{module} {scenario}", n_results=2, where=self._retrieval_where(project_id, version_id)
+        )
+        context_str = self._pack_history(
+            builder, similar_docs, "参考历史经验（注意历史中的边界值和坑）：\n", RAG_DOC_TOKENS
+        )
+        return render(rules_str, context_str, requirement), builder.report()
 
-    def generate_automation_script(self, test_case: Dict, api_key: str, base_url: str, model: str) -> str:
+    def _retrieval_where(self, project_id: Optional[int], version_id: Optional[int]) -> Optional[Dict[str, Any]]:
+        """KB filter for the caller's project/version (global when unknown, see QAI_RETRIEVAL_SCOPE)"""
+        if RETRIEVAL_SCOPE == "version" and version_id:
+            return {"version_id": version_id}
+        if RETRIEVAL_SCOPE != "global" and project_id:
+            return {"project_id": project_id}
+        return None
+
+    def preview_prompt(self, requirement_content: str, model: str, module: Optional[str] = None, scenario: Optional[str] = None,
+                       project_id: Optional[int] = None, version_id: Optional[int] = None) -> Dict[str, Any]:
+        """Build the case-generation prompt without calling the model, with per-section token counts"""
+        if module and scenario:
+            messages, report = self._build_rag_case_messages(requirement_content, module, scenario, model, project_id, version_id)
+        else:
+            messages, report = self._build_case_messages(requirement_content, model, project_id, version_id)
+        return {"report": report, "messages": [{"role": r, "content": c} for r, c in messages]}
+
+    def _pack_rules(self, builder: PromptBuilder, max_tokens: int) -> str:
+        """Keep as many knowledge-base rules as fit, in stored order"""
+        block = self._get_knowledge_rules().strip()
+        if not block:
+            return ""
+        header, *rules = block.splitlines()
+        packed = builder.pack("rules", [r + "\n" for r in rules], max_tokens)
+        if not packed:
+            return ""
+        return builder.add("rules", header + "\n") + "".join(packed) + "\n"
+
+    def _pack_history(self, builder: PromptBuilder, docs: List[Dict[str, Any]], header: str, doc_tokens: int) -> str:
+        """Render retrieved requirements (most relevant first) into the remaining budget"""
+        if not docs:
+            return ""
+        cases = self._history_cases(docs, HISTORY_MAX_CASES)
+        blocks = [self._render_history(doc, cases.get(doc["id"], []), builder.model, doc_tokens) for doc in docs]
+        packed = builder.pack("context", blocks)
+        if not packed:
+            return ""
+        return builder.add("context", header) + "".join(packed)
+
+    def _history_cases(self, docs: List[Dict[str, Any]], limit: int) -> Dict[str, List[Dict[str, Any]]]:
+        """
+        Cases for retrieved KB documents, keyed by document id. KB documents only
+        reference their requirement, so this is one SQLite query for the first
+        `limit` cases of each, selecting just the fields the prompt renders.
+        """
+        by_doc: Dict[str, List[Dict[str, Any]]] = {}
+        req_ids: Dict[str, int] = {}
+        for doc in docs:
+            meta = doc.get("metadata") or {}
+            if meta.get("cases_json"):
+                # Synced before cases moved out of Chroma (until backfilled)
+                by_doc[doc["id"]] = _load_cases(meta["cases_json"])[:limit]
+            elif meta.get("requirement_id"):
+                req_ids[doc["id"]] = int(meta["requirement_id"])
+        if not req_ids:
+            return by_doc
+
+        ranked = select(
+            TestCase.requirement_id, TestCase.title, TestCase.steps, TestCase.expected_result,
+            func.row_number().over(partition_by=TestCase.requirement_id, order_by=TestCase.id).label("rank")
+        ).where(TestCase.requirement_id.in_(set(req_ids.values()))).subquery()
+        per_req: Dict[int, List[Dict[str, Any]]] = {}
+        with Session(engine) as session:
+            rows = session.exec(
+                select(ranked.c.requirement_id, ranked.c.title, ranked.c.steps, ranked.c.expected_result)
+                .where(ranked.c.rank <= limit)
+                .order_by(ranked.c.requirement_id, ranked.c.rank)
+            ).all()
+        for rid, title, steps, expected in rows:
+            per_req.setdefault(rid, []).append({"title": title, "steps": steps, "expected": expected})
+        for doc_id, rid in req_ids.items():
+            by_doc[doc_id] = per_req.get(rid, [])
+        return by_doc
+
+    def _render_history(self, doc: Dict[str, Any], cases: List[Dict[str, Any]], model: str, max_tokens: int) -> str:
+        """One historical requirement plus as many of its cases as fit in max_tokens"""
+        content = token_counter.truncate(doc["content"], max_tokens // 2, model)
+        block = f"--- 历史需求 ---\n{content}\n--- 关联用例 ---\n"
+        spent = token_counter.count(block, model)
+        lines = []
+        for case in cases:
+            line = f"- {case.get('title', '')}：{case.get('steps', '')} => {case.get('expected', '')}\n"
+            tokens = token_counter.count(line, model)
+            if spent + tokens > max_tokens:
+                break
+            lines.append(line)
+            spent += tokens
+        return block + ("".join(lines) or "无\n") + "\n"
+
+    def generate_automation_script(self, test_case: Dict, api_key: str, base_url: str, model: str, use_cache: Optional[bool] = None) -> str:
         """Generate Playwright Python script"""
         llm = self._get_llm(api_key, base_url, model)
         if not llm: return "# No LLM configured"
@@ -230,7 +424,56 @@ class LLMService:
         system_prompt = """你是一个自动化测试专家。将给定的测试用例步骤转换为 Python Playwright (Sync API) 代码。
 只输出代码内容，不要Markdown标记。假设已有 page 对象。不要包含 browser 启动代码，只包含测试步骤逻辑。
 """
-        user_prompt = f"""
+        user_prompt = self._render_script_case(test_case)
+        content = self._invoke(llm, [("system", system_prompt), ("human", user_prompt)], use_cache, stage="script")
+        return self._clean_script(content)
+
+    def generate_automation_scripts(self, test_cases: List[Dict], api_key: str, base_url: str, model: str, use_cache: Optional[bool] = None) -> Dict[Any, str]:
+        """Generate Playwright scripts for several cases in one prompt, keyed by case id"""
+        if len(test_cases) == 1:
+            case = test_cases[0]
+            return {case.get("id"): self.generate_automation_script(case, api_key, base_url, model, use_cache)}
+        llm = self._get_llm(api_key, base_url, model)
+        if not llm: return {c.get("id"): "# No LLM configured" for c in test_cases}
+
+        system_prompt = """你是一个自动化测试专家。将下面的每条测试用例分别转换为 Python Playwright (Sync API) 代码。
+假设已有 page 对象。不要包含 browser 启动代码，只包含测试步骤逻辑。
+必须输出纯 JSON 数组，每条用例一个对象：{"id": 用例ID, "script": "代码"}。严禁输出任何解释性文字。
+"""
+        user_prompt = "\n".join(self._render_script_case(c, with_id=True) for c in test_cases)
+        by_id = {str(c.get("id")): c.get("id") for c in test_cases}
+        scripts: Dict[Any, str] = {}
+        items = self._invoke(
+            llm, [("system", system_prompt), ("human", user_prompt)], use_cache,
+            parse=self._parse_json_response, stage="script_batch"
+        )
+        for item in items:
+            if isinstance(item, dict) and str(item.get("id")) in by_id and item.get("script"):
+                scripts[by_id[str(item["id"])]] = self._clean_script(str(item["script"]))
+
+        # Anything the batch answer dropped is retried on its own
+        for case in test_cases:
+            if case.get("id") not in scripts:
+                scripts[case.get("id")] = self.generate_automation_script(case, api_key, base_url, model, use_cache)
+        return scripts
+
+    def plan_script_batches(self, test_cases: List[Dict], model: str, max_cases: int = SCRIPT_BATCH_SIZE, max_tokens: int = SCRIPT_BATCH_TOKENS) -> List[List[Dict]]:
+        """Split cases into prompts of at most max_cases cases / max_tokens input tokens"""
+        batches, current, spent = [], [], 0
+        for case in test_cases:
+            tokens = token_counter.count(self._render_script_case(case, with_id=True), model)
+            if current and (len(current) >= max_cases or spent + tokens > max_tokens):
+                batches.append(current)
+                current, spent = [], 0
+            current.append(case)
+            spent += tokens
+        if current:
+            batches.append(current)
+        return batches
+
+    def _render_script_case(self, test_case: Dict, with_id: bool = False) -> str:
+        header = f"\n用例ID: {test_case.get('id')}" if with_id else ""
+        return f"""{header}
 用例标题: {test_case.get('title')}
 前置条件: {test_case.get('precondition')}
 步骤:
@@ -238,22 +481,185 @@ class LLMService:
 预期结果:
 {test_case.get('expected_result')}
 """
+
+    def _clean_script(self, content: str) -> str:
+        # 1. Try to find Python code in markdown code blocks
+        match = re.search(r'```(?:python)?\s*([\s\S]*?)\s*```', content)
+        if match:
+            content = match.group(1)
+        else:
+            # 2. Heuristic: Remove lines that don't look like code (simplified)
+            # Or just strip typical "Here is the code:" prefixes
+            content = re.sub(r'^[\s\S]*?import ', 'import ', content) # Start from first import if possible
+            content = re.sub(r'^[\s\S]*?from ', 'from ', content)
+        
+        return content.strip()
+
+    def _invoke(self, llm, messages: List[Tuple[str, str]], use_cache: Optional[bool] = None,
+                parse: Optional[Callable[[str], Any]] = None, stage: str = "chat") -> Any:
+        """
+        Single choke point for blocking completions.
+        Serves from the response cache when enabled; with `parse`, returns the parsed
+        value and only caches responses that parse to something non-empty.
+        Concurrent identical calls (same provider, key, prompt and parser) are
+        coalesced into one provider call. Provider calls go through the
+        per-provider rate limiter, which retries transient failures and raises
+        LLMCallError once they are exhausted.
+        """
+        cache_key = self._cache_key(llm, messages)
+        use = llm_cache.should_use(use_cache)
+        flight_key = (cache_key, llm.openai_api_base, _key_fingerprint(llm), use, parse)
+        return self.flights.do(flight_key, lambda: self._invoke_once(llm, messages, cache_key if use else None, parse, stage))
+
+    def _invoke_once(self, llm, messages: List[Tuple[str, str]], cache_key: Optional[str],
+                     parse: Optional[Callable[[str], Any]], stage: str) -> Any:
+        start = time.perf_counter()
+        if cache_key:
+            cached = llm_cache.get(cache_key)
+            if cached is not None:
+                result = parse(cached) if parse else cached
+                llm_ledger.record(
+                    stage, llm.model_name, llm.openai_api_base, {}, time.perf_counter() - start,
+                    parse_ok=bool(result) if parse else None, cached=True
+                )
+                return result
+
+        call: Dict[str, Any] = {}
         try:
-            response = llm.invoke([("system", system_prompt), ("human", user_prompt)])
-            content = response.content
-            # 1. Try to find Python code in markdown code blocks
-            match = re.search(r'```(?:python)?\s*([\s\S]*?)\s*```', content)
-            if match:
-                content = match.group(1)
-            else:
-                # 2. Heuristic: Remove lines that don't look like code (simplified)
-                # Or just strip typical "Here is the code:" prefixes
-                content = re.sub(r'^[\s\S]*?import ', 'import ', content) # Start from first import if possible
-                content = re.sub(r'^[\s\S]*?from ', 'from ', content)
-            
-            return content.strip()
-        except Exception as e:
-            return f"# Generate script failed: {e}"
+            content = self._complete(llm, messages, stage, call).content
+        except LLMCallError:
+            self._record_call(llm, stage, call, start, status="error")
+            raise
+        except RequestCancelled:
+            self._record_call(llm, stage, call, start, status="cancelled")
+            raise
+        result = parse(content) if parse else content
+        self._record_call(llm, stage, call, start, parse_ok=bool(result) if parse else None)
+        if cache_key and content and (result if parse else True):
+            llm_cache.set(cache_key, content)
+        return result
+
+    def _record_call(self, llm, stage: str, call: Dict[str, Any], start: float, **fields):
+        """Ledger row for one provider call; `call` is filled in by _call_provider/_stream_provider"""
+        llm_ledger.record(
+            stage, call.get("model", llm.model_name), call.get("provider", llm.openai_api_base),
+            call.get("usage", {}), time.perf_counter() - start, **fields
+        )
+
+    def _cache_key(self, llm, messages: List[Tuple[str, str]]) -> str:
+        system_prompt = "\n".join(m[1] for m in messages if m[0] == "system")
+        user_prompt = "\n".join(m[1] for m in messages if m[0] != "system")
+        return llm_cache.make_key(llm.model_name, system_prompt, user_prompt, llm.temperature)
+
+    def _complete(self, llm, messages: List[Tuple[str, str]], stage: str, call: Dict[str, Any]):
+        """One rate-limited completion, routed across the provider pool if requested"""
+        est_tokens = self._estimate_tokens(llm, messages)
+        if llm is _ROUTED:
+            # A hedged call runs two attempts at once: each fills its own dict and
+            # only the winner's provider/usage reaches the ledger row
+            def attempt(p: ProviderConfig):
+                attempt_call: Dict[str, Any] = {}
+                response = self._call_provider(
+                    self._provider_llm(p), p.base_url, messages, est_tokens, attempt_call, ROUTED_ATTEMPTS
+                )
+                return response, attempt_call
+
+            response, winner = provider_router.call(stage, attempt)
+            call.update(winner)
+            return response
+        return self._call_provider(llm, llm.openai_api_base, messages, est_tokens, call)
+
+    def _open_stream(self, llm, messages: List[Tuple[str, str]], stage: str, call: Dict[str, Any]) -> Iterator[Any]:
+        est_tokens = self._estimate_tokens(llm, messages)
+        if llm is _ROUTED:
+            return provider_router.stream(stage, lambda p: self._stream_provider(
+                self._provider_llm(p), p.base_url, messages, est_tokens, call, ROUTED_ATTEMPTS
+            ))
+        return self._stream_provider(llm, llm.openai_api_base, messages, est_tokens, call)
+
+    def _call_provider(self, llm, base_url: str, messages: List[Tuple[str, str]], est_tokens: int,
+                       call: Dict[str, Any], attempts: Optional[int] = None):
+        response = rate_limiter.call(base_url, lambda: self._request(llm, messages), est_tokens, attempts=attempts)
+        usage = extract_usage(response)
+        usage_meter.record(base_url, usage)
+        call.update(provider=base_url, model=llm.model_name, usage=usage)
+        return response
+
+    def _request(self, llm, messages: List[Tuple[str, str]]):
+        if not cancellation.active():
+            return llm.invoke(messages)
+        # A client is waiting on this call: stream it so a disconnect can drop the
+        # provider request mid-answer, and hand back the merged message
+        from langchain_core.messages import AIMessageChunk
+        response = AIMessageChunk(content="")
+        with closing(llm.stream(messages)) as chunks:
+            for chunk in chunks:
+                cancellation.check()
+                response = response + chunk
+        return response
+
+    def _stream_provider(self, llm, base_url: str, messages: List[Tuple[str, str]], est_tokens: int,
+                         call: Dict[str, Any], attempts: Optional[int] = None) -> Iterator[Any]:
+        # Usage (including cache hits) arrives on the final chunk when stream_usage is on
+        usage_chunk = None
+        call.update(provider=base_url, model=llm.model_name)
+        for chunk in rate_limiter.stream(base_url, lambda: llm.stream(messages), est_tokens, attempts=attempts):
+            if getattr(chunk, "usage_metadata", None):
+                usage_chunk = chunk
+            yield chunk
+        usage = extract_usage(usage_chunk)
+        usage_meter.record(base_url, usage)
+        call["usage"] = usage
+
+    def _provider_llm(self, provider: ProviderConfig):
+        return llm_client_pool.get(provider.api_key, provider.base_url, provider.model)
+
+    def _estimate_tokens(self, llm, messages: List[Tuple[str, str]]) -> int:
+        prompt = sum(token_counter.count(m[1], llm.model_name) for m in messages)
+        return prompt + EXPECTED_OUTPUT_TOKENS
+
+    def _stream_json_items(self, llm, build_messages, use_cache: Optional[bool] = None, stage: str = "chat") -> Iterator[Dict[str, Any]]:
+        """
+        Stream tokens from the model and yield array elements as they complete.
+        Raises LLMCallError if the provider fails; elements already yielded stand.
+        """
+        parser = JsonArrayStreamParser()
+        emitted = 0
+        start = time.perf_counter()
+        messages = build_messages()
+        cache_key, cached = None, None
+        if llm_cache.should_use(use_cache):
+            cache_key = self._cache_key(llm, messages)
+            cached = llm_cache.get(cache_key)
+        call: Dict[str, Any] = {}
+        if cached is not None:
+            # Replay through the parser so hits and misses share one code path
+            chunks = iter([cached])
+            cache_key = None
+        else:
+            chunks = (c.content if isinstance(c.content, str) else "" for c in self._open_stream(llm, messages, stage, call))
+
+        parts = []
+        try:
+            for text in chunks:
+                parts.append(text)
+                for item in parser.feed(text):
+                    if isinstance(item, dict):
+                        emitted += 1
+                        yield item
+            for item in parser.close():
+                if isinstance(item, dict):
+                    emitted += 1
+                    yield item
+        except LLMCallError:
+            self._record_call(llm, stage, call, start, status="error", streamed=True)
+            raise
+        except RequestCancelled:
+            self._record_call(llm, stage, call, start, status="cancelled", streamed=True)
+            raise
+        self._record_call(llm, stage, call, start, parse_ok=emitted > 0, cached=cached is not None, streamed=True)
+        if cache_key and emitted:
+            llm_cache.set(cache_key, "".join(parts))
 
     def _mock_fallback(self, requirement_content: str):
         cases = []
@@ -0,0 +1,182 @@
+import asyncio
+import contextvars
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import List, Dict, Any, Optional, AsyncIterator, Callable
+from sqlmodel import Session
+from app.core.database import engine
+from app.core.cancellation import RequestCancelled
+from app.core.llm_limiter import LLMCallError
+from app.core.llm_usage import usage_meter
+from app.models.models import TestCase
+from app.services.llm_service import llm_service
+
+DEFAULT_CONCURRENCY = int(os.getenv("QAI_PIPELINE_CONCURRENCY", "6"))
+MAX_CONCURRENCY = int(os.getenv("QAI_PIPELINE_MAX_CONCURRENCY", "32"))
+
+
+class PipelineService:
+    """
+    Runs the 3-stage wizard (modules -> scenarios -> cases) as a DAG.
+    Each module's scenario call starts as soon as modules are known, and each
+    scenario's case call starts as soon as its own scenarios are known, so the
+    wall-clock time is roughly depth x single-call latency instead of N calls.
+    """
+
+    def __init__(self):
+        # LLMService is blocking, so calls run on a dedicated pool sized for the max fan-out
+        self._executor = ThreadPoolExecutor(max_workers=MAX_CONCURRENCY, thread_name_prefix="qai-pipeline")
+
+    async def run(
+        self,
+        requirement_id: Optional[int],
+        requirement_content: str,
+        api_key: Optional[str],
+        base_url: Optional[str],
+        model: str,
+        modules: Optional[List[str]] = None,
+        max_concurrency: Optional[int] = None,
+        persist: bool = True,
+        use_cache: Optional[bool] = None,
+        on_progress: Optional[Callable[[Dict[str, Any]], None]] = None,
+        project_id: Optional[int] = None,
+        version_id: Optional[int] = None,
+    ) -> Dict[str, Any]:
+        """project_id/version_id scope the knowledge-base retrieval of the case stage"""
+        limit = max(1, min(max_concurrency or DEFAULT_CONCURRENCY, MAX_CONCURRENCY))
+        semaphore = asyncio.Semaphore(limit)
+        loop = asyncio.get_running_loop()
+        started = time.perf_counter()
+        # llm_calls_planned grows as each stage reveals how many children it has
+        stats = {"llm_calls": 0, "llm_calls_done": 0, "llm_calls_planned": 0 if modules else 1, "cases": 0, "errors": 0, "concurrency": limit}
+
+        async def call(fn, *args):
+            try:
+                async with semaphore:
+                    stats["llm_calls"] += 1
+                    # Run with this task's context so token usage lands in the run's scope
+                    ctx = contextvars.copy_context()
+                    return await loop.run_in_executor(self._executor, ctx.run, fn, *args)
+            finally:
+                stats["llm_calls_done"] += 1
+                if on_progress:
+                    on_progress(stats)
+
+        async def run_scenario(module: str, scenario: str) -> Dict[str, Any]:
+            try:
+                cases = await call(
+                    llm_service.generate_test_cases_rag,
+                    requirement_content, module, scenario, api_key, base_url, model, use_cache, project_id, version_id
+                )
+            except LLMCallError as e:
+                # A failed branch is reported in place; its siblings keep going
+                stats["errors"] += 1
+                return {"scenario": scenario, "cases": [], "error": str(e)}
+            cases = [c for c in cases if isinstance(c, dict)] if isinstance(cases, list) else []
+            if persist and requirement_id and cases:
+                # Persist per scenario so finished work survives a later failure
+                cases = await loop.run_in_executor(self._executor, self.persist_cases, requirement_id, cases)
+            stats["cases"] += len(cases)
+            return {"scenario": scenario, "cases": cases}
+
+        async def run_module(module: str) -> Dict[str, Any]:
+            try:
+                scenarios = _as_str_list(await call(
+                    llm_service.generate_scenarios,
+                    requirement_content, module, api_key, base_url, model, use_cache
+                ))
+            except LLMCallError as e:
+                stats["errors"] += 1
+                return {"module": module, "scenarios": [], "error": str(e)}
+            stats["llm_calls_planned"] += len(scenarios)
+            results = await asyncio.gather(*(run_scenario(module, s) for s in scenarios))
+            return {"module": module, "scenarios": list(results)}
+
+        with usage_meter.scope() as usage:
+            if not modules:
+                modules = _as_str_list(await call(
+                    llm_service.analyze_modules,
+                    requirement_content, api_key, base_url, model, use_cache
+                ))
+
+            stats["llm_calls_planned"] += len(modules)
+            results = await asyncio.gather(*(run_module(m) for m in modules))
+        stats["elapsed_ms"] = round((time.perf_counter() - started) * 1000, 1)
+        # Provider-side prefix cache effectiveness for this run
+        stats["usage"] = usage.snapshot()
+        return {"requirement_id": requirement_id, "modules": list(results), "stats": stats}
+
+    async def stream_scripts(
+        self,
+        test_cases: List[Dict[str, Any]],
+        api_key: Optional[str],
+        base_url: Optional[str],
+        model: str,
+        max_concurrency: Optional[int] = None,
+        use_cache: Optional[bool] = None,
+    ) -> AsyncIterator[Dict[str, Any]]:
+        """Convert many cases to Playwright scripts, packing several per prompt; yields as batches finish"""
+        limit = max(1, min(max_concurrency or DEFAULT_CONCURRENCY, MAX_CONCURRENCY))
+        semaphore = asyncio.Semaphore(limit)
+        loop = asyncio.get_running_loop()
+
+        async def run_batch(batch: List[Dict[str, Any]]):
+            async with semaphore:
+                try:
+                    scripts = await loop.run_in_executor(
+                        self._executor, contextvars.copy_context().run, llm_service.generate_automation_scripts,
+                        batch, api_key, base_url, model, use_cache
+                    )
+                except (LLMCallError, RequestCancelled) as e:
+                    # Cancelled batches finish after the client is gone; nothing reads them
+                    return batch, {}, str(e)
+                except Exception as e:
+                    # Anything else would end the response mid-stream; report it on the batch's items
+                    print(f"Script batch failed: {e!r}")
+                    return batch, {}, f"脚本生成失败: {e}"
+            return batch, scripts or {}, None
+
+        batches = llm_service.plan_script_batches(test_cases, model)
+        for done in asyncio.as_completed([run_batch(b) for b in batches]):
+            batch, scripts, error = await done
+            for case in batch:
+                item = {"id": case.get("id"), "title": case.get("title"), "script": scripts.get(case.get("id"), "")}
+                if error:
+                    item["error"] = error
+                yield item
+
+    def persist_cases(self, requirement_id: int, cases: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+        with Session(engine) as session:
+            db_cases = [_to_test_case(c, requirement_id) for c in cases]
+            session.add_all(db_cases)
+            session.commit()
+            for c in db_cases:
+                session.refresh(c)
+            return [c.dict() for c in db_cases]
+
+
+def _as_str_list(value: Any) -> List[str]:
+    if not isinstance(value, list):
+        return []
+    return [str(v) for v in value if v]
+
+
+def _to_test_case(case_data: Dict[str, Any], requirement_id: int) -> TestCase:
+    # Same sanitising the wizard applies before saving
+    steps = case_data.get("steps") or ""
+    if isinstance(steps, list):
+        steps = "\n".join(str(s) for s in steps)
+    priority = case_data.get("priority")
+    return TestCase(
+        module=case_data.get("module") or "默认模块",
+        title=case_data.get("title") or "未命名用例",
+        precondition=case_data.get("precondition") or "",
+        steps=str(steps),
+        expected_result=str(case_data.get("expected_result") or ""),
+        priority=priority if priority in ["P0", "P1", "P2", "P3"] else "P2",
+        requirement_id=requirement_id
+    )
+
+
+pipeline_service = PipelineService()
@@ -0,0 +1,198 @@
+import os
+import re
+from typing import List, Dict, Any, Optional
+
+try:
+    import tiktoken
+except ImportError:  # Optional: fall back to per-family estimates
+    tiktoken = None
+
+# Upper bound on prompt tokens for any model (cost control); smaller context windows get less
+DEFAULT_PROMPT_BUDGET = int(os.getenv("QAI_PROMPT_TOKEN_BUDGET", "6000"))
+# Tokens left free in the context window for the model's answer
+OUTPUT_TOKEN_RESERVE = int(os.getenv("QAI_PROMPT_OUTPUT_RESERVE", "4096"))
+
+# Context window (tokens) per model family, used when the model name carries no size
+_FAMILY_CONTEXT = {
+    "openai": 128000,
+    "deepseek": 64000,
+    "moonshot": 8192,   # moonshot-v1-8k; the 32k/128k variants are read from the name
+    "qwen": 32768,
+    "minimax": 245760,
+    "glm": 128000,
+    "default": 8192,    # Unknown model: assume a small window
+}
+# Models whose window differs from their family's (matched by prefix, in order)
+_MODEL_CONTEXT = {
+    "gpt-3.5": 16385,
+    "gpt-4-": 128000,
+    "gpt-4o": 128000,
+    "gpt-4.1": 1047576,
+    "gpt-4": 8192,
+    "kimi-k2": 131072,
+}
+_CONTEXT_IN_NAME = re.compile(r"(\d+)k\b")
+
+# Rough tokens-per-character for providers whose tokenizer we don't ship,
+# as (CJK char, other char). DeepSeek documents ~0.6 / ~0.3.
+_FAMILY_RATIOS = {
+    "deepseek": (0.6, 0.3),
+    "moonshot": (0.6, 0.3),
+    "qwen": (0.7, 0.3),
+    "minimax": (0.7, 0.3),
+    "glm": (0.7, 0.3),
+    "default": (1.0, 0.35),  # Unknown model: over-estimate rather than overflow
+}
+_FAMILY_ALIASES = {
+    "kimi": "moonshot",
+    "abab": "minimax",
+    "chatglm": "glm",
+}
+_OPENAI_PREFIXES = ("gpt-", "o1", "o3", "o4", "chatgpt")
+
+
+def _is_cjk(ch: str) -> bool:
+    code = ord(ch)
+    return (
+        0x4E00 <= code <= 0x9FFF or 0x3400 <= code <= 0x4DBF
+        or 0x3000 <= code <= 0x303F or 0xFF00 <= code <= 0xFFEF
+    )
+
+
+class TokenCounter:
+    """Counts tokens per model family: tiktoken for OpenAI models, calibrated estimates otherwise"""
+
+    def __init__(self):
+        self._encodings: Dict[str, Any] = {}
+
+    def family(self, model: Optional[str]) -> str:
+        name = (model or "").lower()
+        if name.startswith(_OPENAI_PREFIXES):
+            return "openai"
+        for alias, family in _FAMILY_ALIASES.items():
+            if alias in name:
+                return family
+        for family in _FAMILY_RATIOS:
+            if family in name:
+                return family
+        return "default"
+
+    def _encoding(self, model: str):
+        if tiktoken is None:
+            return None
+        name = "o200k_base" if ("4o" in model or model.startswith(("o1", "o3", "o4", "gpt-4.1", "gpt-5"))) else "cl100k_base"
+        if name not in self._encodings:
+            try:
+                self._encodings[name] = tiktoken.get_encoding(name)
+            except Exception as e:
+                print(f"Load tiktoken encoding {name} failed: {e}")
+                self._encodings[name] = None
+        return self._encodings[name]
+
+    def count(self, text: str, model: Optional[str]) -> int:
+        if not text:
+            return 0
+        family = self.family(model)
+        if family == "openai":
+            enc = self._encoding(model.lower())
+            if enc is not None:
+                return len(enc.encode(text, disallowed_special=()))
+            family = "default"
+        cjk_ratio, other_ratio = _FAMILY_RATIOS[family]
+        cjk = sum(1 for ch in text if _is_cjk(ch))
+        return int(cjk * cjk_ratio + (len(text) - cjk) * other_ratio + 0.999)
+
+    def context_window(self, model: Optional[str]) -> int:
+        name = (model or "").lower()
+        # moonshot-v1-32k, qwen-long-128k, ...
+        match = _CONTEXT_IN_NAME.search(name)
+        if match:
+            return int(match.group(1)) * 1024
+        for prefix, size in _MODEL_CONTEXT.items():
+            if name.startswith(prefix):
+                return size
+        return _FAMILY_CONTEXT[self.family(model)]
+
+    def budget(self, model: Optional[str]) -> int:
+        """Context window minus the answer reserve, capped at DEFAULT_PROMPT_BUDGET"""
+        return max(min(DEFAULT_PROMPT_BUDGET, self.context_window(model) - OUTPUT_TOKEN_RESERVE), 1024)
+
+    def truncate(self, text: str, max_tokens: int, model: Optional[str]) -> str:
+        if max_tokens <= 0 or not text:
+            return ""
+        if self.count(text, model) <= max_tokens:
+            return text
+        family = self.family(model)
+        if family == "openai":
+            enc = self._encoding(model.lower())
+            if enc is not None:
+                return enc.decode(enc.encode(text, disallowed_special=())[:max_tokens]) + "..."
+            family = "default"
+        cjk_ratio, other_ratio = _FAMILY_RATIOS[family]
+        used = 0.0
+        for i, ch in enumerate(text):
+            used += cjk_ratio if _is_cjk(ch) else other_ratio
+            if used > max_tokens:
+                return text[:i] + "..."
+        return text
+
+
+token_counter = TokenCounter()
+
+
+class PromptBuilder:
+    """
+    Packs prompt sections into a token budget, by default the model's own
+    (token_counter.budget, derived from its context window).
+    Add required sections first, then fill the rest by relevance; every section's
+    token count is kept in `report` so callers can log or return it.
+    """
+
+    def __init__(self, model: Optional[str], budget: Optional[int] = None):
+        self.model = model
+        self.budget = budget or token_counter.budget(model)
+        self.used = 0
+        self.sections: Dict[str, int] = {}
+
+    @property
+    def remaining(self) -> int:
+        return max(self.budget - self.used, 0)
+
+    def _record(self, name: str, tokens: int):
+        self.used += tokens
+        self.sections[name] = self.sections.get(name, 0) + tokens
+
+    def add(self, name: str, text: str) -> str:
+        """Required section: always included, even if it overruns the budget"""
+        self._record(name, token_counter.count(text, self.model))
+        return text
+
+    def fit(self, name: str, text: str, max_tokens: Optional[int] = None) -> str:
+        """Include as much of `text` as fits into max_tokens and the remaining budget"""
+        limit = self.remaining if max_tokens is None else min(max_tokens, self.remaining)
+        text = token_counter.truncate(text, limit, self.model)
+        self._record(name, token_counter.count(text, self.model))
+        return text
+
+    def pack(self, name: str, items: List[str], max_tokens: Optional[int] = None) -> List[str]:
+        """Greedily take items in the given (relevance) order while they fit"""
+        limit = self.remaining if max_tokens is None else min(max_tokens, self.remaining)
+        packed, spent = [], 0
+        for item in items:
+            tokens = token_counter.count(item, self.model)
+            if spent + tokens > limit:
+                continue
+            packed.append(item)
+            spent += tokens
+        self._record(name, spent)
+        return packed
+
+    def report(self) -> Dict[str, Any]:
+        return {
+            "model": self.model,
+            "family": token_counter.family(self.model),
+            "context_window": token_counter.context_window(self.model),
+            "budget": self.budget,
+            "used": self.used,
+            "sections": dict(self.sections),
+        }
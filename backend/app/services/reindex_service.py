@@ -0,0 +1,201 @@
+import json
+import os
+import threading
+import time
+from datetime import datetime
+from typing import Any, Callable, Dict, List, Optional
+from sqlalchemy import func
+from sqlmodel import Session, select
+from app.core.database import BASE_DIR, engine
+from app.core.vector_store import vector_store, COLLECTION_NAME, EMBED_BATCH_SIZE
+from app.models.models import Requirement
+from app.services.kb_sync_service import kb_sync, kb_metadata, case_modules, kb_doc_id, requirement_id_of, sync_reqs_to_kb
+
+# Requirements read from SQLite (and written to the index) per batch; progress is checkpointed after each
+REINDEX_BATCH_SIZE = int(os.getenv("QAI_REINDEX_BATCH_SIZE", "200"))
+CHECKPOINT_PATH = os.getenv("QAI_REINDEX_CHECKPOINT", os.path.join(BASE_DIR, "reindex_checkpoint.json"))
+# --fresh builds here and is swapped in as the live collection when complete
+STAGING_COLLECTION_NAME = COLLECTION_NAME + "__reindex"
+
+
+class Reindexer:
+    """
+    Rebuilds the KB vector index from database.db.
+    Requirements are streamed in id order, REINDEX_BATCH_SIZE at a time, and
+    embedded in bulk (through the embedding cache, so unchanged text is not
+    re-embedded). The last indexed id is checkpointed after every batch, so
+    an interrupted run resumes where it stopped. Afterwards the target is
+    compacted: legacy req_{id} duplicates and documents of deleted
+    requirements are removed. In fresh mode the index is built into a staging
+    collection and swapped in only once it is complete; requirements the
+    server writes to the live collection meanwhile (case edits, pipeline
+    syncs, deletions) are recorded by kb_sync and re-synced after the swap.
+    """
+
+    def __init__(self, batch_size: int = REINDEX_BATCH_SIZE, checkpoint_path: str = CHECKPOINT_PATH):
+        self.batch_size = max(1, batch_size)
+        self.checkpoint_path = checkpoint_path
+        self._running = threading.Lock()
+
+    def run(self, fresh: bool = False, restart: bool = False,
+            on_progress: Optional[Callable[[Dict[str, Any]], None]] = None) -> Dict[str, Any]:
+        if not self._running.acquire(blocking=False):
+            raise RuntimeError("重建索引已在进行中")
+        try:
+            return self._run(fresh, restart, on_progress)
+        finally:
+            kb_sync.stop_tracking()
+            self._running.release()
+
+    def _run(self, fresh: bool, restart: bool, on_progress: Optional[Callable[[Dict[str, Any]], None]]) -> Dict[str, Any]:
+        start = time.perf_counter()
+        state = None if restart else self.load_checkpoint()
+        if state and state.get("fresh") != fresh:
+            print("Reindex checkpoint is for a different mode; starting over")
+            state = None
+        if state is None:
+            if fresh:
+                vector_store.drop_collection(STAGING_COLLECTION_NAME)
+            state = {"fresh": fresh, "last_id": 0, "indexed": 0, "started_at": datetime.now().isoformat()}
+            self._save_checkpoint(state)
+        else:
+            print(f"Resuming reindex after requirement {state['last_id']} ({state['indexed']} already indexed)")
+        target = None
+        if fresh:
+            target = vector_store.staging_collection(STAGING_COLLECTION_NAME)
+            # Writes recorded before an interruption are kept in the checkpoint
+            kb_sync.track_writes(state.get("live_writes", []))
+
+        with Session(engine) as session:
+            total = session.exec(select(func.count()).select_from(Requirement)).one()
+            while True:
+                reqs = session.exec(
+                    select(Requirement).where(Requirement.id > state["last_id"]).order_by(Requirement.id).limit(self.batch_size)
+                ).all()
+                if not reqs:
+                    break
+                self._index(session, reqs, target)
+                state["last_id"] = reqs[-1].id
+                state["indexed"] += len(reqs)
+                self._save_checkpoint(state)
+                # Keep the session's identity map from growing with the whole table
+                session.expunge_all()
+                if on_progress:
+                    on_progress({**state, "total": total})
+            caught_up = self._catch_up(session, state, target)
+
+        removed = self.compact(target)
+        resynced = 0
+        if fresh:
+            vector_store.swap_collection(STAGING_COLLECTION_NAME)
+            # Now that the new collection is live: re-sync what was written to the old one during
+            # the build, then land pending debounced edits
+            resynced = self._resync(kb_sync.stop_tracking())
+            kb_sync.flush()
+        self.clear_checkpoint()
+        result = {
+            "fresh": fresh,
+            "indexed": state["indexed"],
+            "caught_up": caught_up,
+            "resynced": resynced,
+            **removed,
+            "seconds": round(time.perf_counter() - start, 2),
+        }
+        print(f"Reindex finished: {result}")
+        return result
+
+    def _index(self, session: Session, reqs: List[Requirement], target=None) -> int:
+        metadata = kb_metadata(session, reqs, case_modules(session, [r.id for r in reqs]))
+        docs = [{"id": kb_doc_id(r.id), "text": r.content, "metadata": metadata[r.id]} for r in reqs]
+        if target is None:
+            # In place: unchanged text only gets its metadata refreshed
+            return vector_store.add_documents(docs)
+        for i in range(0, len(docs), EMBED_BATCH_SIZE):
+            batch = docs[i:i + EMBED_BATCH_SIZE]
+            target.upsert(
+                ids=[d["id"] for d in batch],
+                documents=[d["text"] for d in batch],
+                metadatas=[d["metadata"] for d in batch],
+                embeddings=vector_store.embed([d["text"] for d in batch]),
+            )
+        return len(docs)
+
+    def _catch_up(self, session: Session, state: Dict[str, Any], target=None) -> int:
+        """Re-index requirements edited after their batch was written (possible on long or resumed runs)"""
+        since = datetime.fromisoformat(state["started_at"])
+        reqs = session.exec(
+            select(Requirement).where(Requirement.id <= state["last_id"], Requirement.updated_at >= since)
+        ).all()
+        for i in range(0, len(reqs), self.batch_size):
+            self._index(session, reqs[i:i + self.batch_size], target)
+        return len(reqs)
+
+    def _resync(self, requirement_ids: List[int]) -> int:
+        """Bring requirements written to the replaced collection up to date in the live one"""
+        if not requirement_ids:
+            return 0
+        with Session(engine) as session:
+            existing = set(session.exec(select(Requirement.id).where(Requirement.id.in_(requirement_ids))).all())
+            sync_reqs_to_kb(session, existing)
+        deleted = [rid for rid in requirement_ids if rid not in existing]
+        if deleted:
+            vector_store.delete_documents([doc_id for rid in deleted for doc_id in (kb_doc_id(rid), f"req_{rid}")])
+        return len(requirement_ids)
+
+    def compact(self, target=None, page_size: int = 1000) -> Dict[str, int]:
+        """Delete legacy req_{id} duplicates and documents whose requirement no longer exists"""
+        collection = target if target is not None else vector_store.collection
+        doc_ids, offset = [], 0
+        while True:
+            page = collection.get(limit=page_size, offset=offset, include=[])
+            if not page["ids"]:
+                break
+            doc_ids.extend(page["ids"])
+            offset += len(page["ids"])
+        with Session(engine) as session:
+            existing = set(session.exec(select(Requirement.id)).all())
+        duplicates, orphans = [], []
+        for doc_id in doc_ids:
+            rid = requirement_id_of(doc_id)
+            if rid is None:
+                # Not written by our sync paths; leave it alone
+                continue
+            if rid not in existing:
+                orphans.append(doc_id)
+            elif doc_id != kb_doc_id(rid):
+                duplicates.append(doc_id)
+        stale = duplicates + orphans
+        for i in range(0, len(stale), page_size):
+            if target is None:
+                vector_store.delete_documents(stale[i:i + page_size])
+            else:
+                target.delete(ids=stale[i:i + page_size])
+        return {"scanned": len(doc_ids), "duplicates_removed": len(duplicates), "orphans_removed": len(orphans)}
+
+    def load_checkpoint(self) -> Optional[Dict[str, Any]]:
+        try:
+            with open(self.checkpoint_path, encoding="utf-8") as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return None
+        except (OSError, ValueError) as e:
+            print(f"Ignoring unreadable reindex checkpoint: {e}")
+            return None
+
+    def _save_checkpoint(self, state: Dict[str, Any]):
+        # Write-then-rename, so a crash never leaves a half-written checkpoint
+        tmp = self.checkpoint_path + ".tmp"
+        if state.get("fresh"):
+            state["live_writes"] = kb_sync.tracked_writes()
+        with open(tmp, "w", encoding="utf-8") as f:
+            json.dump({**state, "updated_at": datetime.now().isoformat()}, f)
+        os.replace(tmp, self.checkpoint_path)
+
+    def clear_checkpoint(self):
+        try:
+            os.remove(self.checkpoint_path)
+        except FileNotFoundError:
+            pass
+
+
+reindexer = Reindexer()
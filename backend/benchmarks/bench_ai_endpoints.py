@@ -0,0 +1,214 @@
+"""
+End-to-end benchmark for the AI endpoints, driven through the mock LLM.
+
+Starts mock_llm_server on a local port (or uses --mock-url), then fires
+--requests calls per scenario at a running QAI server with --concurrency
+clients and reports p50/p95 latency, throughput and parse-failure rate.
+A call counts as a parse failure when it returns 2xx but no usable items.
+
+Scenarios:
+  analyze       POST /ai/analyze_modules
+  scenarios     POST /ai/generate_scenarios
+  cases         POST /ai/generate_cases
+  cases_stream  POST /ai/generate_cases/stream   (also reports time to first case)
+  script        POST /ai/generate_script
+  requirement   POST /requirements/{id}/generate_cases  (on a temporary requirement)
+  pipeline      POST /ai/pipeline                 (persist=false)
+
+Usage (from backend/, with the app running on :8000):
+    python benchmarks/bench_ai_endpoints.py --requests 30 --concurrency 8 \\
+        --latency 0.5 --malformed-rate 0.1 --rate-limit-rate 0.05
+"""
+import argparse
+import json
+import os
+import statistics
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Dict, List, Optional, Tuple
+
+import httpx
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from mock_llm_server import MockConfig, MockLLMServer  # noqa: E402
+
+REQUIREMENT = """用户登录模块：
+1. 支持手机号 + 验证码登录，验证码 60 秒内有效，每个手机号每天最多发送 10 次。
+2. 支持账号密码登录，密码连续错误 5 次锁定账号 30 分钟。
+3. 登录成功后跳转到首页，并记录登录日志。"""
+SCENARIOS = ("analyze", "scenarios", "cases", "cases_stream", "script", "requirement", "pipeline")
+
+
+def _percentile(values: List[float], pct: float) -> float:
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    k = (len(ordered) - 1) * pct
+    lo, hi = int(k), min(int(k) + 1, len(ordered) - 1)
+    return ordered[lo] + (ordered[hi] - ordered[lo]) * (k - lo)
+
+
+def _items(response: httpx.Response) -> int:
+    data = response.json()
+    if isinstance(data, dict):
+        if "script" in data:
+            return 1 if data["script"].strip() else 0
+        if "modules" in data:
+            return sum(len(s["cases"]) for m in data["modules"] for s in m["scenarios"])
+    return len(data) if isinstance(data, list) else 0
+
+
+class Bench:
+    def __init__(self, target: str, llm: Dict[str, Any], timeout: float):
+        self.api = target.rstrip("/") + "/api/v1"
+        self.llm = llm
+        self.client = httpx.Client(timeout=timeout)
+        self.requirement_id: Optional[int] = None
+
+    def setup(self):
+        r = self.client.post(f"{self.api}/requirements/", json={"title": "[bench] 登录需求", "content": REQUIREMENT})
+        r.raise_for_status()
+        self.requirement_id = r.json()["id"]
+
+    def teardown(self):
+        if self.requirement_id:
+            # Cascades to the generated test cases
+            self.client.delete(f"{self.api}/requirements/{self.requirement_id}")
+
+    def call(self, scenario: str) -> Tuple[int, int, Optional[float]]:
+        """Returns (status, items, time-to-first-item) for one request"""
+        base = {"requirement_content": REQUIREMENT, **self.llm}
+        if scenario == "analyze":
+            r = self.client.post(f"{self.api}/ai/analyze_modules", json=base)
+        elif scenario == "scenarios":
+            r = self.client.post(f"{self.api}/ai/generate_scenarios", json={**base, "module": "用户登录"})
+        elif scenario == "cases":
+            r = self.client.post(f"{self.api}/ai/generate_cases", json={**base, "module": "用户登录", "scenario": "验证码登录"})
+        elif scenario == "cases_stream":
+            return self._stream({**base, "module": "用户登录", "scenario": "验证码登录"})
+        elif scenario == "script":
+            case = {"title": "验证码登录成功", "precondition": "已注册", "steps": "1. 输入手机号\n2. 输入验证码\n3. 点击登录", "expected_result": "跳转首页"}
+            r = self.client.post(f"{self.api}/ai/generate_script", json={**self.llm, "test_case": case})
+        elif scenario == "requirement":
+            r = self.client.post(f"{self.api}/requirements/{self.requirement_id}/generate_cases", json=self.llm)
+        elif scenario == "pipeline":
+            r = self.client.post(f"{self.api}/ai/pipeline", json={**base, "persist": False})
+        else:
+            raise ValueError(f"Unknown scenario: {scenario}")
+        return r.status_code, (_items(r) if r.is_success else 0), None
+
+    def _stream(self, payload: Dict[str, Any]) -> Tuple[int, int, Optional[float]]:
+        start = time.perf_counter()
+        first, items, event = None, 0, None
+        with self.client.stream("POST", f"{self.api}/ai/generate_cases/stream", json=payload) as r:
+            if not r.is_success:
+                return r.status_code, 0, None
+            for line in r.iter_lines():
+                if line.startswith("event:"):
+                    event = line[6:].strip()
+                elif line.startswith("data:") and event == "case":
+                    items += 1
+                    if first is None:
+                        first = time.perf_counter() - start
+                elif line.startswith("data:") and event == "error":
+                    return json.loads(line[5:]).get("status", 502), items, first
+        return 200, items, first
+
+
+def run_scenario(bench: Bench, scenario: str, requests: int, concurrency: int) -> Dict[str, Any]:
+    def one(_: int):
+        start = time.perf_counter()
+        try:
+            status, items, ttfb = bench.call(scenario)
+        except httpx.HTTPError:
+            status, items, ttfb = 0, 0, None
+        return time.perf_counter() - start, status, items, ttfb
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        results = list(pool.map(one, range(requests)))
+    wall = time.perf_counter() - started
+
+    ok = [r for r in results if 200 <= r[1] < 300]
+    latencies = [r[0] for r in ok]
+    ttfbs = [r[3] for r in ok if r[3] is not None]
+    return {
+        "scenario": scenario,
+        "requests": requests,
+        "ok": len(ok),
+        "errors": len(results) - len(ok),
+        "parse_fail_rate": round(sum(1 for r in ok if r[2] == 0) / max(len(ok), 1), 3),
+        "p50_ms": round(_percentile(latencies, 0.5) * 1000, 1),
+        "p95_ms": round(_percentile(latencies, 0.95) * 1000, 1),
+        "mean_items": round(statistics.mean(r[2] for r in ok), 2) if ok else 0,
+        "ttfb_p50_ms": round(_percentile(ttfbs, 0.5) * 1000, 1) if ttfbs else None,
+        "rps": round(len(results) / wall, 2),
+    }
+
+
+def main():
+    ap = argparse.ArgumentParser(description="Benchmark QAI AI endpoints against the mock LLM")
+    ap.add_argument("--target", default="http://127.0.0.1:8000", help="running QAI server")
+    ap.add_argument("--mock-url", default=None, help="use an already running mock instead of starting one")
+    ap.add_argument("--mock-port", type=int, default=18555)
+    ap.add_argument("--scenarios", default=",".join(SCENARIOS))
+    ap.add_argument("--requests", type=int, default=20, help="requests per scenario")
+    ap.add_argument("--concurrency", type=int, default=4)
+    ap.add_argument("--model", default="deepseek-chat")
+    ap.add_argument("--cache", action="store_true", help="allow the server-side response cache")
+    ap.add_argument("--timeout", type=float, default=300)
+    ap.add_argument("--json", dest="json_out", default=None, help="also write results to this file")
+    # Mock knobs (ignored with --mock-url)
+    ap.add_argument("--latency", type=float, default=0.3)
+    ap.add_argument("--jitter", type=float, default=0.1)
+    ap.add_argument("--tokens-per-sec", type=float, default=200)
+    ap.add_argument("--error-rate", type=float, default=0.0)
+    ap.add_argument("--rate-limit-rate", type=float, default=0.0)
+    ap.add_argument("--malformed-rate", type=float, default=0.0)
+    ap.add_argument("--seed", type=int, default=1)
+    args = ap.parse_args()
+
+    mock = None
+    mock_url = args.mock_url
+    if not mock_url:
+        mock = MockLLMServer("127.0.0.1", args.mock_port, MockConfig(
+            latency=args.latency, jitter=args.jitter, tokens_per_sec=args.tokens_per_sec,
+            error_rate=args.error_rate, rate_limit_rate=args.rate_limit_rate,
+            malformed_rate=args.malformed_rate, retry_after=0.2, seed=args.seed,
+        )).start()
+        mock_url = mock.url
+
+    llm = {"api_key": "sk-bench", "base_url": mock_url, "model": args.model, "use_cache": args.cache}
+    bench = Bench(args.target, llm, args.timeout)
+    scenarios = [s.strip() for s in args.scenarios.split(",") if s.strip()]
+    rows = []
+    try:
+        if "requirement" in scenarios:
+            bench.setup()
+        header = f"{'scenario':<14}{'n':>5}{'ok':>5}{'err':>5}{'parse_fail':>11}{'p50 ms':>10}{'p95 ms':>10}{'ttfb ms':>9}{'items':>7}{'req/s':>8}"
+        print(header)
+        for scenario in scenarios:
+            row = run_scenario(bench, scenario, args.requests, args.concurrency)
+            rows.append(row)
+            ttfb = "-" if row["ttfb_p50_ms"] is None else f"{row['ttfb_p50_ms']:.0f}"
+            print(
+                f"{scenario:<14}{row['requests']:>5}{row['ok']:>5}{row['errors']:>5}"
+                f"{row['parse_fail_rate'] * 100:>10.1f}%{row['p50_ms']:>10.0f}{row['p95_ms']:>10.0f}"
+                f"{ttfb:>9}{row['mean_items']:>7}{row['rps']:>8}"
+            )
+    finally:
+        bench.teardown()
+        mock_stats = bench.client.get(mock_url.rstrip("/") + "/_stats").json() if mock_url else {}
+        if mock:
+            mock.stop()
+
+    print(f"\nmock: {mock_stats}")
+    if args.json_out:
+        with open(args.json_out, "w", encoding="utf-8") as f:
+            json.dump({"args": vars(args), "results": rows, "mock": mock_stats}, f, ensure_ascii=False, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,115 @@
+"""
+Micro-benchmark for the LLM JSON extractor.
+
+Runs every sample in corpus/llm_json_outputs.jsonl through:
+  - legacy:   the old regex + json.loads + ast fallback from LLMService
+  - parser:   parse_json_items on the full completion
+  - stream:   JsonArrayStreamParser fed in 16-char chunks (like SSE tokens)
+and reports recovered elements vs. expected plus per-call latency.
+
+Usage (from backend/):
+    python benchmarks/bench_json_parser.py [--repeat 2000]
+"""
+import argparse
+import ast
+import json
+import os
+import re
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from app.services.json_stream import JsonArrayStreamParser, parse_json_items  # noqa: E402
+
+CORPUS = os.path.join(os.path.dirname(os.path.abspath(__file__)), "corpus", "llm_json_outputs.jsonl")
+
+
+def legacy_parse(content):
+    """The pre-rewrite _parse_json_response, kept here as the baseline"""
+    try:
+        match = re.search(r'```(?:json)?\s*([\s\S]*?)\s*```', content)
+        if match:
+            content = match.group(1)
+        else:
+            content = content.strip()
+            start_bracket = content.find('[')
+            start_brace = content.find('{')
+            start_index = -1
+            end_index = -1
+            if start_bracket != -1 and (start_brace == -1 or start_bracket < start_brace):
+                start_index = start_bracket
+                end_index = content.rfind(']') + 1
+            elif start_brace != -1:
+                start_index = start_brace
+                end_index = content.rfind('}') + 1
+            if start_index != -1 and end_index != -1:
+                content = content[start_index:end_index]
+        content = re.sub(r'//.*', '', content)
+        return json.loads(content)
+    except json.JSONDecodeError:
+        try:
+            return ast.literal_eval(content)
+        except Exception:
+            pass
+        return []
+
+
+def stream_parse(content, chunk_size=16):
+    parser = JsonArrayStreamParser()
+    items = []
+    for i in range(0, len(content), chunk_size):
+        items.extend(parser.feed(content[i:i + chunk_size]))
+    items.extend(parser.close())
+    return items
+
+
+def count(result):
+    if isinstance(result, list):
+        return len(result)
+    return 1 if result else 0
+
+
+def bench(fn, raw, repeat):
+    start = time.perf_counter()
+    for _ in range(repeat):
+        fn(raw)
+    return (time.perf_counter() - start) / repeat * 1e6
+
+
+def main():
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--repeat", type=int, default=2000)
+    args = ap.parse_args()
+
+    with open(CORPUS, encoding="utf-8") as f:
+        samples = [json.loads(line) for line in f if line.strip()]
+
+    impls = [("legacy", legacy_parse), ("parser", parse_json_items), ("stream", stream_parse)]
+    totals = {name: {"ok": 0, "us": 0.0} for name, _ in impls}
+
+    # Malformed samples print a skip line per call; keep the table readable
+    devnull = open(os.devnull, "w")
+    print(f"{'sample':<30}{'expect':>7}" + "".join(f"{name:>10}{'us':>9}" for name, _ in impls))
+    for s in samples:
+        row = f"{s['name']:<30}{s['expect']:>7}"
+        for name, fn in impls:
+            stdout, sys.stdout = sys.stdout, devnull
+            try:
+                got = count(fn(s["raw"]))
+                us = bench(fn, s["raw"], args.repeat)
+            finally:
+                sys.stdout = stdout
+            ok = got == s["expect"]
+            totals[name]["ok"] += ok
+            totals[name]["us"] += us
+            row += f"{(str(got) + ('' if ok else '!')):>10}{us:>9.1f}"
+        print(row)
+
+    print()
+    for name, t in totals.items():
+        print(f"{name:<8} correct {t['ok']}/{len(samples)}  mean {t['us'] / len(samples):.1f} us/call")
+
+
+if __name__ == "__main__":
+    main()
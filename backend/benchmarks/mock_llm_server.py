@@ -0,0 +1,333 @@
+"""
+OpenAI-compatible stand-in LLM for benchmarks and local development.
+
+Serves POST /v1/chat/completions (blocking and stream=true) with canned answers
+picked from the system prompt, so every LLMService stage gets a plausible reply:
+modules, scenarios, cases, single Playwright scripts and batched scripts.
+
+Knobs (all optional):
+  --latency         seconds before the first token (default 0.3)
+  --jitter          +/- uniform noise on latency (default 0.1)
+  --tokens-per-sec  streaming / generation rate, 0 = instant (default 200)
+  --error-rate      fraction of calls answered with HTTP 500
+  --rate-limit-rate fraction of calls answered with HTTP 429 + Retry-After
+  --malformed-rate  fraction of answers mangled (fenced prose, trailing comma,
+                    truncated, or no JSON at all)
+
+Prompt prefixes are cached like DeepSeek's context cache (64-token blocks), and
+usage reports prompt_cache_hit_tokens / prompt_tokens_details.cached_tokens.
+
+GET /_stats returns call/injection/cache counters; POST /_reset clears them.
+
+Usage (from backend/):
+    python benchmarks/mock_llm_server.py --port 18555 --latency 0.5
+then point the app at base_url http://127.0.0.1:18555/v1 with any api_key.
+"""
+import argparse
+import json
+import random
+import re
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Any, Dict, List, Optional
+
+CHARS_PER_TOKEN = 2  # Rough CJK-heavy average; only used for pacing and usage numbers
+CACHE_BLOCK_TOKENS = 64  # Prefix cache granularity, as on DeepSeek
+MALFORMED_KINDS = ("fenced", "trailing_comma", "truncated", "prose")
+
+
+class MockConfig:
+    def __init__(
+        self,
+        latency: float = 0.3,
+        jitter: float = 0.1,
+        tokens_per_sec: float = 200,
+        error_rate: float = 0.0,
+        rate_limit_rate: float = 0.0,
+        malformed_rate: float = 0.0,
+        retry_after: float = 1.0,
+        seed: Optional[int] = None,
+    ):
+        self.latency = latency
+        self.jitter = jitter
+        self.tokens_per_sec = tokens_per_sec
+        self.error_rate = error_rate
+        self.rate_limit_rate = rate_limit_rate
+        self.malformed_rate = malformed_rate
+        self.retry_after = retry_after
+        self.random = random.Random(seed)
+
+
+def _canned_cases(module: str, count: int = 3) -> List[Dict[str, Any]]:
+    return [
+        {
+            "module": module,
+            "title": f"{module}-用例{i + 1}",
+            "priority": ["P0", "P1", "P2"][i % 3],
+            "precondition": "用户已登录",
+            "steps": "1. 打开页面\n2. 输入数据\n3. 点击提交",
+            "expected_result": "操作成功并提示",
+        }
+        for i in range(count)
+    ]
+
+
+def canned_answer(system_prompt: str, user_prompt: str) -> str:
+    """Pick a realistic reply for whichever LLMService prompt this is"""
+    if "功能模块" in system_prompt:
+        return json.dumps(["用户登录", "订单管理", "支付结算"], ensure_ascii=False)
+    if "测试场景" in system_prompt:
+        return json.dumps(["正常流程", "异常输入", "边界值"], ensure_ascii=False)
+    if '"script"' in system_prompt:
+        ids = re.findall(r"用例ID: (\S+)", user_prompt)
+        return json.dumps(
+            [{"id": int(i) if i.isdigit() else i, "script": f"page.goto('https://example.com/case/{i}')\npage.click('#submit')"} for i in ids],
+            ensure_ascii=False,
+        )
+    if "Playwright" in system_prompt:
+        return "```python\npage.goto('https://example.com')\npage.fill('#name', 'qa')\npage.click('#submit')\n```"
+    match = re.search(r"模块：【(.+?)】", user_prompt) or re.search(r"模块【(.+?)】", system_prompt + user_prompt)
+    return json.dumps(_canned_cases(match.group(1) if match else "默认模块"), ensure_ascii=False, indent=2)
+
+
+def mangle(content: str, kind: str) -> str:
+    if kind == "fenced":
+        return f"好的，以下是结果：\n```json\n{content}\n```\n如需调整请告诉我。"
+    if kind == "trailing_comma":
+        return re.sub(r"([}\]\"])(\s*)([}\]])", r"\1,\2\3", content)
+    if kind == "truncated":
+        return content[: max(1, int(len(content) * 0.7))]
+    return "抱歉，我暂时无法按要求输出结果。"
+
+
+class _QuietHTTPServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def handle_error(self, request, client_address):
+        # Clients dropping keep-alive sockets is routine under load
+        pass
+
+
+class MockLLMServer:
+    """Runs the mock on a background thread; usable from benchmarks or as a CLI"""
+
+    def __init__(self, host: str = "127.0.0.1", port: int = 18555, config: Optional[MockConfig] = None):
+        self.config = config or MockConfig()
+        self.stats: Dict[str, int] = {}
+        self._prefixes = set()
+        self._lock = threading.Lock()
+        self._httpd = _QuietHTTPServer((host, port), self._handler())
+        self._thread: Optional[threading.Thread] = None
+
+    @property
+    def url(self) -> str:
+        host, port = self._httpd.server_address[:2]
+        return f"http://{host}:{port}/v1"
+
+    def start(self) -> "MockLLMServer":
+        self._thread = threading.Thread(target=self._httpd.serve_forever, name="mock-llm", daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._httpd.shutdown()
+        self._httpd.server_close()
+
+    def serve_forever(self):
+        self._httpd.serve_forever()
+
+    def count(self, key: str):
+        with self._lock:
+            self.stats[key] = self.stats.get(key, 0) + 1
+
+    def reset(self):
+        with self._lock:
+            self.stats = {}
+            self._prefixes = set()
+
+    def prefix_cache(self, prompt: str) -> int:
+        """Tokens of `prompt` served from cache: the longest previously seen block-aligned prefix"""
+        block = CACHE_BLOCK_TOKENS * CHARS_PER_TOKEN
+        hit = 0
+        with self._lock:
+            for end in range(block, len(prompt) + 1, block):
+                key = hash(prompt[:end])
+                if key in self._prefixes:
+                    hit = end
+                else:
+                    self._prefixes.add(key)
+            self.stats["prompt_tokens"] = self.stats.get("prompt_tokens", 0) + len(prompt) // CHARS_PER_TOKEN
+            self.stats["cache_hit_tokens"] = self.stats.get("cache_hit_tokens", 0) + hit // CHARS_PER_TOKEN
+        return hit // CHARS_PER_TOKEN
+
+    def _roll(self, rate: float) -> bool:
+        with self._lock:
+            return rate > 0 and self.config.random.random() < rate
+
+    def _handler(self):
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def log_message(self, *args):
+                pass
+
+            def _send_json(self, status: int, payload: Any, headers: Optional[Dict[str, str]] = None):
+                body = json.dumps(payload, ensure_ascii=False).encode()
+                self.send_response(status)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(body)))
+                for key, value in (headers or {}).items():
+                    self.send_header(key, value)
+                self.end_headers()
+                self.wfile.write(body)
+
+            def _write_chunk(self, data: str):
+                raw = data.encode()
+                self.wfile.write(b"%x\r\n%s\r\n" % (len(raw), raw))
+                self.wfile.flush()
+
+            def do_GET(self):
+                if self.path.rstrip("/").endswith("/_stats"):
+                    with server._lock:
+                        self._send_json(200, dict(server.stats))
+                elif self.path.rstrip("/").endswith("/models"):
+                    self._send_json(200, {"object": "list", "data": [{"id": "mock-chat", "object": "model"}]})
+                else:
+                    self._send_json(404, {"error": {"message": "not found"}})
+
+            def do_POST(self):
+                length = int(self.headers.get("Content-Length") or 0)
+                body = json.loads(self.rfile.read(length) or b"{}")
+                if self.path.rstrip("/").endswith("/_reset"):
+                    server.reset()
+                    self._send_json(200, {"ok": True})
+                    return
+                if not self.path.rstrip("/").endswith("/chat/completions"):
+                    self._send_json(404, {"error": {"message": "not found"}})
+                    return
+                self._chat(body)
+
+            def _chat(self, body: Dict[str, Any]):
+                cfg = server.config
+                server.count("calls")
+                if server._roll(cfg.rate_limit_rate):
+                    server.count("injected_429")
+                    self._send_json(
+                        429, {"error": {"message": "Rate limit reached (mock)", "type": "rate_limit_error"}},
+                        {"Retry-After": str(cfg.retry_after)},
+                    )
+                    return
+                if server._roll(cfg.error_rate):
+                    server.count("injected_500")
+                    self._send_json(500, {"error": {"message": "Internal error (mock)", "type": "server_error"}})
+                    return
+
+                messages = body.get("messages") or []
+                system_prompt = "\n".join(m.get("content", "") for m in messages if m.get("role") == "system")
+                user_prompt = "\n".join(m.get("content", "") for m in messages if m.get("role") != "system")
+                content = canned_answer(system_prompt, user_prompt)
+                if server._roll(cfg.malformed_rate):
+                    kind = cfg.random.choice(MALFORMED_KINDS)
+                    server.count(f"malformed_{kind}")
+                    content = mangle(content, kind)
+
+                with server._lock:
+                    delay = cfg.latency + cfg.random.uniform(-cfg.jitter, cfg.jitter)
+                time.sleep(max(delay, 0))
+
+                prompt_text = "".join(m.get("content", "") for m in messages)
+                prompt_tokens = len(prompt_text) // CHARS_PER_TOKEN
+                hit_tokens = server.prefix_cache(prompt_text)
+                completion_tokens = max(1, len(content) // CHARS_PER_TOKEN)
+                usage = {
+                    "prompt_tokens": prompt_tokens,
+                    "completion_tokens": completion_tokens,
+                    "total_tokens": prompt_tokens + completion_tokens,
+                    "prompt_cache_hit_tokens": hit_tokens,
+                    "prompt_cache_miss_tokens": prompt_tokens - hit_tokens,
+                    "prompt_tokens_details": {"cached_tokens": hit_tokens},
+                }
+                model = body.get("model") or "mock-chat"
+                if body.get("stream"):
+                    self._stream(content, model, usage)
+                else:
+                    if cfg.tokens_per_sec > 0:
+                        time.sleep(completion_tokens / cfg.tokens_per_sec)
+                    self._send_json(200, {
+                        "id": "chatcmpl-mock",
+                        "object": "chat.completion",
+                        "created": int(time.time()),
+                        "model": model,
+                        "choices": [{"index": 0, "message": {"role": "assistant", "content": content}, "finish_reason": "stop"}],
+                        "usage": usage,
+                    })
+
+            def _stream(self, content: str, model: str, usage: Dict[str, int]):
+                self.send_response(200)
+                self.send_header("Content-Type", "text/event-stream")
+                self.send_header("Transfer-Encoding", "chunked")
+                self.end_headers()
+                step = CHARS_PER_TOKEN * 4  # ~4 tokens per SSE chunk
+                pause = (4 / server.config.tokens_per_sec) if server.config.tokens_per_sec > 0 else 0
+
+                def chunk(delta: Dict[str, Any], finish: Optional[str] = None, extra: Optional[Dict[str, Any]] = None) -> str:
+                    payload = {
+                        "id": "chatcmpl-mock", "object": "chat.completion.chunk",
+                        "created": int(time.time()), "model": model,
+                        "choices": [{"index": 0, "delta": delta, "finish_reason": finish}],
+                    }
+                    payload.update(extra or {})
+                    return "data: " + json.dumps(payload, ensure_ascii=False) + "\n\n"
+
+                try:
+                    for i in range(0, len(content), step):
+                        self._write_chunk(chunk({"content": content[i:i + step]}))
+                        if pause:
+                            time.sleep(pause)
+                    self._write_chunk(chunk({}, "stop"))
+                    # Like OpenAI's stream_options.include_usage: a final chunk with no choices
+                    self._write_chunk("data: " + json.dumps({
+                        "id": "chatcmpl-mock", "object": "chat.completion.chunk",
+                        "created": int(time.time()), "model": model, "choices": [], "usage": usage,
+                    }) + "\n\n")
+                    self._write_chunk("data: [DONE]\n\n")
+                    self.wfile.write(b"0\r\n\r\n")
+                    self.wfile.flush()
+                except (BrokenPipeError, ConnectionResetError):
+                    server.count("client_disconnects")
+
+        return Handler
+
+
+def main():
+    ap = argparse.ArgumentParser(description="OpenAI-compatible mock LLM server")
+    ap.add_argument("--host", default="127.0.0.1")
+    ap.add_argument("--port", type=int, default=18555)
+    ap.add_argument("--latency", type=float, default=0.3)
+    ap.add_argument("--jitter", type=float, default=0.1)
+    ap.add_argument("--tokens-per-sec", type=float, default=200)
+    ap.add_argument("--error-rate", type=float, default=0.0)
+    ap.add_argument("--rate-limit-rate", type=float, default=0.0)
+    ap.add_argument("--malformed-rate", type=float, default=0.0)
+    ap.add_argument("--retry-after", type=float, default=1.0)
+    ap.add_argument("--seed", type=int, default=None)
+    args = ap.parse_args()
+
+    config = MockConfig(
+        latency=args.latency, jitter=args.jitter, tokens_per_sec=args.tokens_per_sec,
+        error_rate=args.error_rate, rate_limit_rate=args.rate_limit_rate,
+        malformed_rate=args.malformed_rate, retry_after=args.retry_after, seed=args.seed,
+    )
+    server = MockLLMServer(args.host, args.port, config)
+    print(f"Mock LLM listening on {server.url}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    main()
@@ -1,19 +1,58 @@
-from fastapi import FastAPI
+from fastapi import FastAPI, Request
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi.staticfiles import StaticFiles
-from fastapi.responses import FileResponse
+from fastapi.responses import FileResponse, JSONResponse
 from app.core.database import init_db
-from app.routers import requirements, testcases, ai, projects, knowledge
+from app.core.llm_clients import llm_client_pool
+from app.core.llm_limiter import LLMCallError
+from app.core.llm_ledger import llm_ledger
+from app.core.cancellation import RequestCancelled
+from app.core.vector_store import vector_store
+from app.routers import requirements, testcases, ai, projects, knowledge, jobs
+from app.services.job_service import job_service
+from app.services.kb_sync_service import kb_sync
 from contextlib import asynccontextmanager
 import os
+import sys
+import threading
+import time
+
+# Open Chroma, load the embedding model and import the LLM client in the background
+# at startup, so CRUD is served immediately and the first AI request finds them warm
+WARMUP = os.getenv("QAI_WARMUP", "1").lower() in ("1", "true", "yes")
+STARTED_AT = time.monotonic()
+
+def warm_up():
+    vector_store.warm_up()
+    try:
+        llm_client_pool.warm_up()
+    except Exception as e:
+        print(f"LLM client warm-up failed: {e}")
 
 @asynccontextmanager
 async def lifespan(app: FastAPI):
     init_db()
+    job_service.start()
+    if WARMUP:
+        threading.Thread(target=warm_up, name="qai-warmup", daemon=True).start()
     yield
+    job_service.shutdown()
+    kb_sync.shutdown()
+    llm_ledger.close()
+    await llm_client_pool.aclose()
 
 app = FastAPI(title="QAI API", lifespan=lifespan)
 
+@app.exception_handler(LLMCallError)
+async def llm_call_error_handler(request: Request, exc: LLMCallError):
+    # Provider failures surface as 429/502/504 instead of placeholder data
+    return JSONResponse(status_code=exc.status_code, content={"detail": str(exc), "kind": exc.kind})
+
+@app.exception_handler(RequestCancelled)
+async def request_cancelled_handler(request: Request, exc: RequestCancelled):
+    # The client has already gone; 499 (nginx's "client closed request") keeps access logs honest
+    return JSONResponse(status_code=499, content={"detail": str(exc), "kind": "cancelled"})
+
 # CORS setup
 app.add_middleware(
     CORSMiddleware,
@@ -23,11 +62,32 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
+def warm_status():
+    return {
+        "uptime_seconds": round(time.monotonic() - STARTED_AT, 3),
+        "warmup": WARMUP,
+        "vector_store": vector_store.status(),
+        "llm_client_loaded": "langchain_openai" in sys.modules,
+    }
+
+@app.get("/api/v1/health")
+def health():
+    """Liveness: the process is up and serving; warm-up may still be running"""
+    return {"status": "ok", **warm_status()}
+
+@app.get("/api/v1/ready")
+def ready():
+    """Readiness: 503 until the background warm-up has finished (always ready when it is disabled)"""
+    status = warm_status()
+    is_ready = not WARMUP or (status["vector_store"]["state"] == "ready" and status["llm_client_loaded"])
+    return JSONResponse(status_code=200 if is_ready else 503, content={"ready": is_ready, **status})
+
 app.include_router(requirements.router, prefix="/api/v1", tags=["requirements"])
 app.include_router(testcases.router, prefix="/api/v1", tags=["testcases"])
 app.include_router(ai.router, prefix="/api/v1/ai", tags=["ai"])
 app.include_router(projects.router, prefix="/api/v1", tags=["projects"])
 app.include_router(knowledge.router, prefix="/api/v1", tags=["knowledge"])
+app.include_router(jobs.router, prefix="/api/v1", tags=["jobs"])
 
 # Mount frontend static files
 # Assume frontend is at ../frontend relative to backend
@@ -0,0 +1,47 @@
+"""
+Rebuild / compact the knowledge-base vector index from database.db.
+
+Streams requirements in batches, embeds them in bulk, drops legacy req_{id}
+duplicates and documents of deleted requirements. Progress is checkpointed
+(QAI_REINDEX_CHECKPOINT), so re-running after an interruption resumes.
+
+--fresh builds into a separate collection and swaps it in when complete.
+Run it with the API server stopped: a running server keeps a handle on the
+collection being replaced. Use POST /api/v1/testcases/kb_sync/reindex?fresh=true
+to rebuild inside a running server instead.
+
+Usage (from backend/):
+    python reindex.py                   # in place, resuming any unfinished run
+    python reindex.py --fresh           # build a new collection, then swap
+    python reindex.py --restart         # ignore the checkpoint and start over
+    python reindex.py --compact-only    # only remove duplicates and orphans
+"""
+import argparse
+
+from app.core.database import engine
+from app.services.reindex_service import REINDEX_BATCH_SIZE, Reindexer
+
+
+def main():
+    ap = argparse.ArgumentParser(description="Rebuild the QAI knowledge-base vector index")
+    ap.add_argument("--fresh", action="store_true", help="build into a new collection and swap it in")
+    ap.add_argument("--restart", action="store_true", help="ignore the checkpoint of an interrupted run")
+    ap.add_argument("--compact-only", action="store_true", help="only remove duplicates and orphans")
+    ap.add_argument("--batch-size", type=int, default=REINDEX_BATCH_SIZE)
+    args = ap.parse_args()
+
+    # SQL echo would drown the progress lines
+    engine.echo = False
+    reindexer = Reindexer(batch_size=args.batch_size)
+    if args.compact_only:
+        print(reindexer.compact())
+        return
+
+    def on_progress(state):
+        print(f"indexed {state['indexed']}/{state['total']} (last id {state['last_id']})")
+
+    reindexer.run(fresh=args.fresh, restart=args.restart, on_progress=on_progress)
+
+
+if __name__ == "__main__":
+    main()